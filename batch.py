@@ -0,0 +1,193 @@
+""" Many independent boards stepped at once, for heuristic tuning and Monte
+Carlo evaluation. Needs numpy.
+
+The boards live in one bool array of shape (count, height, width), row 0 at
+the bottom, and every step places one block on every board that is still in
+play: the landing rows, the full row test, scoring and the spawn check are
+array ops over the whole batch. Blocks are hard dropped straight down from
+above the stack in the orientation and column asked for, so a placement is
+(orientation, x) with x the block's location as in tetris_engine.Block.
+
+Line clears use gravity 'sticky' (the same sticky collapse and cascades as
+TetrisBoard, run per board through collapse.resolve_rows, only for the boards
+that cleared something) or 'naive' (rows above a cleared row move down by one
+per cleared row, done for the whole batch at once).
+"""
+
+import numpy as np
+
+import collapse
+import tetrofactory
+
+def _geometry():
+    """ Offsets of the four cells of every block in every orientation, as
+    (7, 4, 4) arrays indexed [block, orientation, cell]. Blocks are indexed
+    as in tetrofactory.blockmap.
+    """
+    names = tetrofactory.blockmap
+    dx = np.array([[[x for x, y in cells] for cells in tetrofactory.rotation_table[name]]
+                   for name in names])
+    dy = np.array([[[y for x, y in cells] for cells in tetrofactory.rotation_table[name]]
+                   for name in names])
+    return dx, dy
+
+_dx, _dy = _geometry()
+_block_index = {name: i for i, name in enumerate(tetrofactory.blockmap)}
+
+
+class BatchBoards:
+    """ count boards of width x height. Board i deals its blocks from a
+    PieceGenerator seeded with seeds[i] (i by default), so a batch is as
+    reproducible as a single TetrisBoard.
+    """
+
+    gravities = ('sticky', 'naive')
+
+    count = None
+    width = None
+    height = None
+    gravity = None
+    cells = None        # bool (count, height, width), True where occupied
+    pieces = None       # index into tetrofactory.blockmap of every board's block
+    score = None        # lines cleared by every board
+    game_over = None    # bool per board; finished boards are left alone
+    generators = None   # one PieceGenerator per board
+    _spawn_x = None     # spawn location of every block on boards of this size
+    _spawn_y = None
+
+    def __init__(self, count, width=10, height=22, seeds=None, policy='bag',
+                 gravity='sticky'):
+        if gravity not in self.gravities:
+            raise ValueError('unknown gravity %r' % gravity)
+        if seeds is None:
+            seeds = range(count)
+        self.count = count
+        self.width = width
+        self.height = height
+        self.gravity = gravity
+        spawn = np.array([tetrofactory.spawn_point(name, width, height)
+                          for name in tetrofactory.blockmap])
+        self._spawn_x, self._spawn_y = spawn[:, 0], spawn[:, 1]
+        self.cells = np.zeros((count, height, width), dtype=bool)
+        self.pieces = np.zeros(count, dtype=np.intp)
+        self.score = np.zeros(count, dtype=np.int64)
+        self.game_over = np.zeros(count, dtype=bool)
+        self.generators = [tetrofactory.PieceGenerator(seed, policy) for seed in seeds]
+        if len(self.generators) != count:
+            raise ValueError('need one seed per board')
+        self._deal(np.ones(count, dtype=bool))
+
+    #---------------------------------------------------------------------------
+    #       Public
+    #---------------------------------------------------------------------------
+
+    @property
+    def names(self):
+        """ Name of every board's current block """
+        return [tetrofactory.blockmap[p] for p in self.pieces]
+
+    def column_heights(self):
+        """ (count, width) array, 1 + the y of the topmost square of every
+        column, 0 if empty
+        """
+        filled = self.cells.any(axis=1)
+        top = self.height - np.argmax(self.cells[:, ::-1, :], axis=1)
+        return np.where(filled, top, 0)
+
+    def x_range(self, orientations):
+        """ Lowest and highest x (inclusive) the current blocks can be placed
+        at in the given orientations, as two arrays
+        """
+        dx = _dx[self.pieces, orientations]
+        return -dx.min(axis=1), self.width - 1 - dx.max(axis=1)
+
+    def place(self, orientations, xs):
+        """ Hard drop every board's block in orientations[i] at x xs[i], then
+        clear lines and deal the next block. Boards whose block doesn't fit
+        under the ceiling, or whose next block can't spawn, are over. Returns
+        the lines every board cleared.
+        """
+        orientations = np.asarray(orientations) % 4
+        xs = np.asarray(xs)
+        live = ~self.game_over
+        dx = _dx[self.pieces, orientations]
+        dy = _dy[self.pieces, orientations]
+        columns = xs[:, None] + dx
+        outside = (columns < 0) | (columns >= self.width)
+        if (outside.any(axis=1) & live).any():
+            raise ValueError('placement outside the board')
+        columns = np.clip(columns, 0, self.width - 1)
+
+        heights = np.take_along_axis(self.column_heights(), columns, axis=1)
+        ys = (heights - dy).max(axis=1)
+        cell_ys = ys[:, None] + dy
+        overflow = live & (cell_ys.max(axis=1) >= self.height)
+        placing = live & ~overflow
+
+        boards = np.nonzero(placing)[0]
+        self.cells[boards[:, None], cell_ys[boards], columns[boards]] = True
+        lines = self._resolve(placing)
+        self.score += lines
+
+        self.game_over |= overflow
+        self._deal(placing)
+        return lines
+
+    def rows(self, i):
+        """ Board i as one int per row, bit x set if column x is taken, like
+        TetrisBoard's bitboard rows
+        """
+        packed = np.packbits(self.cells[i], axis=1, bitorder='little')
+        return [int.from_bytes(row.tobytes(), 'little') for row in packed]
+
+    def set_rows(self, i, rows):
+        """ Overwrite board i from one int per row """
+        size = (self.width + 7) // 8
+        data = b''.join(row.to_bytes(size, 'little') for row in rows)
+        packed = np.frombuffer(data, dtype=np.uint8).reshape(self.height, size)
+        self.cells[i] = np.unpackbits(packed, axis=1, count=self.width, bitorder='little')
+
+    #---------------------------------------------------------------------------
+    #       Private
+    #---------------------------------------------------------------------------
+
+    def _deal(self, mask):
+        """ Give every board in mask its next block, and end the game of any
+        board where that block's spawn cells are taken
+        """
+        boards = np.nonzero(mask)[0]
+        if not len(boards):
+            return
+        generators = self.generators
+        self.pieces[boards] = [_block_index[generators[i].next()] for i in boards]
+
+        pieces = self.pieces[boards]
+        xs = self._spawn_x[pieces][:, None] + _dx[pieces, 0]
+        ys = self._spawn_y[pieces][:, None] + _dy[pieces, 0]
+        blocked = self.cells[boards[:, None], ys, xs].any(axis=1)
+        self.game_over[boards[blocked]] = True
+
+    def _resolve(self, mask):
+        """ Clear the full rows of the boards in mask. Returns lines per board """
+        full = self.cells.all(axis=2) & mask[:, None]
+        lines = full.sum(axis=1)
+        boards = np.nonzero(lines)[0]
+        if not len(boards):
+            return lines
+
+        if self.gravity == 'naive':
+            # A stable sort on the full flags moves the full rows to the top
+            # and keeps the others in order; then empty the top rows
+            order = np.argsort(full[boards], axis=1, kind='stable')
+            moved = np.take_along_axis(self.cells[boards], order[:, :, None], axis=1)
+            keep = np.arange(self.height)[None, :] < (self.height - lines[boards])[:, None]
+            self.cells[boards] = moved & keep[:, :, None]
+            return lines
+
+        # Sticky collapse has no array form, so run the clears and cascades
+        # of each board that needs them on its row ints
+        for i in boards:
+            after, steps = collapse.resolve_rows(self.rows(i), self.width)
+            self.set_rows(i, after)
+            lines[i] = sum(steps)
+        return lines
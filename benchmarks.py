@@ -0,0 +1,311 @@
+""" Micro and macro benchmarks for the headless game core.
+
+    python3 benchmarks.py                         run and print the results
+    python3 benchmarks.py --save baseline.json    also store them as JSON
+    python3 benchmarks.py --compare baseline.json flag regressions against a
+                                                  stored run
+
+Every benchmark runs on seeded synthetic boards, so two runs of the same
+commit measure the same work. Results are seconds per operation (lower is
+better) except the *_per_second rates (higher is better). The batch
+simulator is only timed if numpy is installed. Startup is timed up to the
+resource index the renderer builds its layers from, since everything after
+that needs a window.
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import resources
+from tetris_engine import TetrisBoard
+
+try:
+    import batch
+except ImportError:     # numpy isn't installed
+    batch = None
+
+BOARD_KINDS = ['sparse', 'checkerboard', 'tall_tower', 'many_clumps']
+
+#-------------------------------------------------------------------------------
+#       Synthetic boards
+#-------------------------------------------------------------------------------
+
+def synthetic_cells(kind, width, height, seed=0):
+    """ Locked cells for a board of the given kind. The bottom two rows are
+    full, so a lock clears them and collapses whatever sits above.
+    """
+    rng = random.Random(seed)
+    cells = [(x, y) for y in range(2) for x in range(width)]
+    top = height - 4    # leave room for a block to spawn
+    for y in range(2, top):
+        for x in range(width):
+            if kind == 'sparse':
+                taken = rng.random() < 0.2
+            elif kind == 'checkerboard':
+                taken = (x + y) % 2 == 0
+            elif kind == 'tall_tower':
+                taken = x in (0, 1, width // 2, width - 1) or rng.random() < 0.05
+            elif kind == 'many_clumps':
+                # 2x2 clumps separated by empty columns and rows
+                taken = x % 3 != 2 and y % 3 != 1 and rng.random() < 0.9
+            else:
+                raise ValueError('unknown board kind %r' % kind)
+            if taken:
+                cells.append((x, y))
+    return cells
+
+def make_board(kind=None, seed=0, block_name='T', width=None, height=None):
+    board = TetrisBoard(start_block_name=block_name, seed=seed, width=width,
+                        height=height)
+    if kind is not None:
+        rows = {}
+        for x, y in synthetic_cells(kind, board.width, board.height, seed):
+            rows.setdefault(y, []).append((x, y))
+        # A block per row, as a stack of locked pieces would have
+        for cells in rows.values():
+            board.place_locked(cells)
+    board.start()
+    return board
+
+#-------------------------------------------------------------------------------
+#       Timing
+#-------------------------------------------------------------------------------
+
+def time_per_op(setup, op, repeat):
+    """ Median seconds of op(state) over repeat runs, each on a fresh
+    state = setup(i). Setup is not timed.
+    """
+    samples = []
+    for i in range(repeat):
+        state = setup(i)
+        start = time.perf_counter()
+        op(state)
+        samples.append(time.perf_counter() - start)
+    samples.sort()
+    return samples[len(samples) // 2]
+
+def time_loop(op, number):
+    """ Seconds per call of op() averaged over number calls """
+    start = time.perf_counter()
+    for i in range(number):
+        op()
+    return (time.perf_counter() - start) / number
+
+#-------------------------------------------------------------------------------
+#       Benchmarks
+#-------------------------------------------------------------------------------
+
+def bench_block(repeat):
+    board = make_board('sparse')
+    block = board.current_block
+    results = {}
+    results['block.can_move'] = time_loop(lambda: block.can_move('LEFT'), repeat * 100)
+
+    def move():
+        block.move('LEFT') or block.move('RIGHT')
+    results['block.move'] = time_loop(move, repeat * 100)
+
+    def rotate():
+        block.rotate('CLOCKWISE')
+    results['block.rotate'] = time_loop(rotate, repeat * 100)
+    return results
+
+def bench_clear_and_collapse(repeat):
+    results = {}
+    for kind in BOARD_KINDS:
+        def setup(i, kind=kind):
+            board = make_board(kind, seed=i)
+            # Lock the spawned block in place so only the clear is timed
+            board.current_block = None
+            return board
+        results['clear_lines.' + kind] = time_per_op(
+            setup, lambda board: board._clear_lines(), repeat)
+
+        def setup_collapse(i, kind=kind):
+            board = make_board(kind, seed=i)
+            board.current_block = None
+            for y in (0, 1):
+                for x in range(board.width):
+                    board.erase_square(board.squares_matrix[x][y])
+            return board
+        results['collapse.' + kind] = time_per_op(
+            setup_collapse, lambda board: board._collapse([0, 1]), repeat)
+    return results
+
+def bench_hard_drop(repeat):
+    results = {}
+    for kind in BOARD_KINDS:
+        results['hard_drop.' + kind] = time_per_op(
+            lambda i, kind=kind: make_board(kind, seed=i, block_name='I'),
+            lambda board: board.move_block('DROP'), repeat)
+    return results
+
+def bench_huge_board(repeat, size=400):
+    """ Hard drops that clear lines on a size x size board, where anything
+    that scans the whole board or every block shows
+    """
+    return {'huge_drop.many_clumps': time_per_op(
+        lambda i: make_board('many_clumps', seed=i, block_name='I', width=size,
+                             height=size),
+        lambda board: board.move_block('DROP'), min(repeat, 5))}
+
+def bench_snapshot(repeat):
+    results = {}
+    for kind in BOARD_KINDS:
+        board = make_board(kind)
+        state = board.snapshot()
+        results['snapshot.' + kind] = time_loop(board.snapshot, repeat)
+        results['restore.' + kind] = time_loop(lambda: board.restore(state), repeat)
+    return results
+
+def bench_pieces_per_second(pieces):
+    """ Random placements over as many games as it takes """
+    rng = random.Random(0)
+    played = 0
+    start = time.perf_counter()
+    while played < pieces:
+        board = TetrisBoard(seed=played)
+        board.start()
+        while not board.game_over and played < pieces:
+            for i in range(rng.randrange(4)):
+                board.move_block('UP')
+            direction = rng.choice(['LEFT', 'RIGHT'])
+            for i in range(rng.randrange(6)):
+                board.move_block(direction)
+            board.move_block('DROP')
+            played += 1
+    return {'pieces_per_second': played / (time.perf_counter() - start)}
+
+def bench_batch_pieces_per_second(pieces, count=1000):
+    """ Random placements on count boards stepped together by batch.py,
+    over as many batches as it takes
+    """
+    import numpy as np
+    rng = np.random.default_rng(0)
+    played = 0
+    start = time.perf_counter()
+    while played < pieces:
+        boards = batch.BatchBoards(count, seeds=range(played, played + count))
+        while not boards.game_over.all() and played < pieces:
+            orientations = rng.integers(0, 4, count)
+            low, high = boards.x_range(orientations)
+            xs = rng.integers(low, high + 1)
+            played += int((~boards.game_over).sum())
+            boards.place(orientations, xs)
+    return {'batch_pieces_per_second': played / (time.perf_counter() - start)}
+
+def bench_startup(repeat, xmlpath=None):
+    """ Loading tetris.xml's resource index without and with a valid cache.
+    Works on a copy, so the real cache is left alone.
+    """
+    if xmlpath is None:
+        xmlpath = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tetris.xml')
+    with tempfile.TemporaryDirectory() as directory:
+        copy = os.path.join(directory, 'tetris.xml')
+        shutil.copy(xmlpath, copy)
+        index = resources.parse(xmlpath)
+        for file in index.files[1:]:
+            shutil.copy(file, directory)
+        cache_path = resources.default_cache_path(copy)
+
+        def cold(i):
+            if os.path.exists(cache_path):
+                os.remove(cache_path)
+        results = {
+            'startup.parse': time_per_op(
+                cold, lambda state: resources.load(copy), repeat),
+            'startup.cached': time_per_op(
+                lambda i: None, lambda state: resources.load(copy), repeat),
+        }
+    return results
+
+def run(repeat=200, pieces=20000):
+    results = {}
+    results.update(bench_block(repeat))
+    results.update(bench_clear_and_collapse(repeat))
+    results.update(bench_hard_drop(repeat))
+    results.update(bench_huge_board(repeat))
+    results.update(bench_snapshot(repeat))
+    results.update(bench_pieces_per_second(pieces))
+    results.update(bench_startup(repeat))
+    if batch is not None:
+        results.update(bench_batch_pieces_per_second(pieces * 10))
+    return results
+
+#-------------------------------------------------------------------------------
+#       Baselines
+#-------------------------------------------------------------------------------
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(results, baseline, tolerance):
+    """ Names of the benchmarks that got worse than baseline by more than
+    tolerance (0.1 = 10%)
+    """
+    regressions = []
+    for name, value in results.items():
+        old = baseline.get(name)
+        if not old:
+            continue
+        if name.endswith('per_second'):
+            ratio = old / value
+        else:
+            ratio = value / old
+        if ratio > 1 + tolerance:
+            regressions.append(name)
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=200)
+    parser.add_argument('--pieces', type=int, default=20000)
+    parser.add_argument('--save', metavar='FILE', help='write results as JSON')
+    parser.add_argument('--compare', metavar='FILE', help='baseline JSON to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.10)
+    args = parser.parse_args(argv)
+
+    results = run(args.repeat, args.pieces)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+
+    for name in sorted(results):
+        rate = name.endswith('per_second')
+        line = '%-28s %12.3f' % (name, results[name] if rate else results[name] * 1e6)
+        line += '  /s' if rate else '  us'
+        if baseline and baseline.get(name):
+            line += '   (%+.1f%%)' % ((results[name] / baseline[name] - 1) * 100)
+        print(line)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'commit': git_commit(), 'python': platform.python_version(),
+                       'machine': platform.machine(), 'repeat': args.repeat,
+                       'pieces': args.pieces, 'results': results},
+                      f, indent=2, sort_keys=True)
+
+    if baseline:
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print('Regressions: ' + ', '.join(regressions))
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,66 @@
+""" Bitboard backend for the tetris board. Each row of the board is one int,
+bit x set meaning column x of that row is occupied. A piece is a dict of
+row -> mask, so a collision check is a handful of bitwise ops instead of a
+walk over the squares_matrix.
+"""
+
+class BitBoard:
+    """ Occupancy of a width x height board, one int per row. Row 0 is the
+    bottom of the board, bit 0 of a row is the leftmost column.
+    """
+
+    width = None
+    height = None
+    rows = None
+    full_mask = None    # value of a row with every column occupied
+    left_wall = None    # mask of column 0
+    right_wall = None   # mask of column width - 1
+
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+        self.rows = [0] * height
+        self.full_mask = (1 << width) - 1
+        self.left_wall = 1
+        self.right_wall = 1 << (width - 1)
+
+    #---------------------------------------------------------------------------
+    #       Cells
+    #---------------------------------------------------------------------------
+
+    def set(self, x, y):
+        self.rows[y] |= 1 << x
+
+    def unset(self, x, y):
+        self.rows[y] &= ~(1 << x)
+
+    #---------------------------------------------------------------------------
+    #       Pieces
+    #---------------------------------------------------------------------------
+
+    def fits(self, masks, own=None):
+        """ True if the piece given by masks (row -> mask) lies inside the board
+        and doesn't overlap anything. Cells in own (row -> mask, usually the
+        piece's current position) are treated as empty, since the falling piece
+        is itself part of the board.
+        """
+        rows = self.rows
+        height = self.height
+        full = self.full_mask
+        for y, mask in masks.items():
+            if y < 0 or y >= height or mask & ~full:
+                return False
+            row = rows[y]
+            if own is not None:
+                row &= ~own.get(y, 0)
+            if row & mask:
+                return False
+        return True
+
+
+def piece_masks(cells):
+    """ Row -> mask dict for an iterable of (x, y) cells """
+    masks = {}
+    for x, y in cells:
+        masks[y] = masks.get(y, 0) | (1 << x)
+    return masks
@@ -0,0 +1,46 @@
+""" Bot policies. A policy picks one of the placements
+TetrisBoard.enumerate_placements() returns:
+
+    choose(board, placements, rng) -> placements.Placement
+
+rng is a random.Random owned by the game, so a bot playing a seeded board is
+deterministic. Policies are looked up by name in POLICIES.
+"""
+
+def evaluate(rows, width, lines):
+    """ Heuristic value of the board rows (one int per row) left after a
+    placement that cleared lines. Higher is better. Weights are the usual
+    hand tuned ones for height, holes and bumpiness.
+    """
+    heights = [0] * width
+    holes = 0
+    for x in range(width):
+        bit = 1 << x
+        covered = False
+        for y in range(len(rows) - 1, -1, -1):
+            if rows[y] & bit:
+                if not covered:
+                    heights[x] = y + 1
+                    covered = True
+            elif covered:
+                holes += 1
+    bumpiness = sum(abs(a - b) for a, b in zip(heights, heights[1:]))
+    return 0.76 * lines - 0.51 * sum(heights) - 0.36 * holes - 0.18 * bumpiness
+
+def random_policy(board, placements, rng):
+    return rng.choice(placements)
+
+def greedy_policy(board, placements, rng):
+    """ The placement with the best evaluate() score; ties go to the first """
+    width = board.width
+    return max(placements, key=lambda p: evaluate(p.rows, width, sum(p.lines)))
+
+def lowest_policy(board, placements, rng):
+    """ Whatever lands lowest, like a player who only ever hard drops """
+    return min(placements, key=lambda p: (max(y for x, y in p.cells), len(p.path)))
+
+POLICIES = {
+    'random': random_policy,
+    'greedy': greedy_policy,
+    'lowest': lowest_policy,
+}
@@ -0,0 +1,170 @@
+""" Sticky collapse on bitboard rows (one int per row, bit x = column x).
+
+After lines are cleared, every clump (4-connected group of squares) touching
+the row right above a cleared row falls as a rigid body until it rests on the
+floor, on a square that isn't moving, or on another clump that has come to
+rest. Squares in clumps that don't touch a cleared row stay where they are.
+
+The result is the same as dropping the clumps round robin one row at a time
+until none can move (moving one clump never stops another clump that could
+move from moving, so every order ends in the same place). Here each clump is
+flood filled from the squares above a cleared row, whole runs of a row at a
+time, and dropped straight to its final row, bottom-up. Squares that don't
+fall are never looked at, so a clear costs about the same on a board
+thousands of squares wide and tall as on a small one.
+"""
+
+def sticky_collapse(rows, width, rows_cleared):
+    """ Work out where every clump ends up. rows are the board's rows after
+    the cleared rows were emptied; they are not modified. Returns a list of
+    (cells, distance) for each clump that falls, cells being the clump's
+    (x, y) cells before the fall.
+    """
+    if not rows_cleared:
+        return []
+    height = len(rows)
+    # Cleared rows are empty across the whole width, so nothing above the
+    # lowest one can be connected to anything below it
+    floor = min(rows_cleared) + 1
+
+    # Flood each clump from the squares sitting right above a cleared row
+    clumps = []
+    seen = {}   # y -> mask of the cells already in a clump
+    for y in rows_cleared:
+        if y + 1 >= height:
+            continue
+        seeds = rows[y + 1] & ~seen.get(y + 1, 0)
+        while seeds:
+            masks = _flood(rows, floor, y + 1, seeds & -seeds, seen)
+            clumps.append(masks)
+            seeds &= ~masks[y + 1]
+    if not clumps:
+        return []
+
+    falls = _settle(list(rows), clumps)
+
+    result = []
+    for masks, distance in falls:
+        if distance:
+            cells = [(x, y) for y, mask in masks.items() for x in _columns(mask)]
+            result.append((cells, distance))
+    return result
+
+def resolve_rows(rows, width, candidates=None):
+    """ Clear full rows and collapse, over and over until no row is full.
+    Returns the new rows and the number of lines cleared by each step; rows
+    itself is not modified. With candidates, only those rows (eg the ones a
+    piece just locked into) are checked for the first clear; after that only
+    the rows clumps fell into can fill up.
+    """
+    rows = list(rows)
+    full_mask = (1 << width) - 1
+    if candidates is None:
+        candidates = range(len(rows))
+    lines = []
+    while True:
+        full = sorted(y for y in set(candidates) if rows[y] == full_mask)
+        if not full:
+            return rows, lines
+        lines.append(len(full))
+        for y in full:
+            rows[y] = 0
+        falls = sticky_collapse(rows, width, full)
+        for cells, distance in falls:
+            for x, y in cells:
+                rows[y] &= ~(1 << x)
+        candidates = set()
+        for cells, distance in falls:
+            for x, y in cells:
+                rows[y - distance] |= 1 << x
+                candidates.add(y - distance)
+
+def _columns(row):
+    """ Yield the x of every set bit in row, lowest first """
+    while row:
+        low = row & -row
+        yield low.bit_length() - 1
+        row ^= low
+
+def _flood(rows, floor, y, seed, seen):
+    """ The clump (row -> mask) holding the cells of seed in row y, found a
+    row span at a time, so the work grows with the clump's runs of squares
+    rather than with the board. Rows below floor are left out. The clump's
+    cells are added to seen.
+    """
+    height = len(rows)
+    masks = {}
+    pending = [(y, seed)]
+    while pending:
+        y, mask = pending.pop()
+        mask = _runs_through(rows[y], mask) & ~masks.get(y, 0)
+        if not mask:
+            continue
+        masks[y] = masks.get(y, 0) | mask
+        seen[y] = seen.get(y, 0) | mask
+        if y + 1 < height and rows[y + 1] & mask:
+            pending.append((y + 1, rows[y + 1] & mask))
+        if y - 1 >= floor and rows[y - 1] & mask:
+            pending.append((y - 1, rows[y - 1] & mask))
+    return masks
+
+def _runs_through(row, mask):
+    """ Every run of set bits in row that has a bit of mask in it. A
+    Kogge-Stone fill, so log(width) shifts rather than one per column.
+    """
+    up = down = mask & row
+    up_through = down_through = row
+    shift = 1
+    limit = row.bit_length()
+    while shift < limit:
+        up |= up_through & (up << shift)
+        up_through &= up_through << shift
+        down |= down_through & (down >> shift)
+        down_through &= down_through >> shift
+        shift *= 2
+    return up | down
+
+def _settle(occupied, clumps):
+    """ Drop each clump (row -> mask) as far as it goes, lowest clump first.
+    occupied holds every square, including the clumps, and is updated in
+    place. A clump hooked over a lower one can only follow once that one has
+    landed, so passes repeat until nothing falls. Returns (masks, distance)
+    with the clump's original masks.
+    """
+    clumps.sort(key=min)
+    current = [dict(masks) for masks in clumps]
+    distances = [0] * len(clumps)
+    moved = True
+    while moved:
+        moved = False
+        for i, masks in enumerate(current):
+            for y, mask in masks.items():
+                occupied[y] &= ~mask
+            fall = _fall_distance(occupied, masks)
+            if fall:
+                masks = {y - fall: mask for y, mask in masks.items()}
+                current[i] = masks
+                distances[i] += fall
+                moved = True
+            for y, mask in masks.items():
+                occupied[y] |= mask
+    return list(zip(clumps, distances))
+
+def _fall_distance(occupied, masks):
+    """ Rows the clump given by masks can fall through occupied, which must
+    not contain the clump itself
+    """
+    fall = None
+    for y, mask in masks.items():
+        # Only the cells with nothing of the clump right below them can land
+        bottoms = mask & ~masks.get(y - 1, 0)
+        gap = 0
+        while bottoms and y - gap - 1 >= 0 and not occupied[y - gap - 1] & bottoms:
+            gap += 1
+            if fall is not None and gap >= fall:
+                break
+        if bottoms and (fall is None or gap < fall):
+            fall = gap
+            if fall == 0:
+                return 0
+    return fall or 0
@@ -0,0 +1,238 @@
+""" Fixed timestep game clock for real-time play.
+
+GameClock owns the timing rules a TetrisBoard doesn't have: level based
+gravity, lock delay, soft drop and DAS/ARR auto-repeat for held keys. The
+simulation runs in fixed ticks (240 per second by default), independent of
+how often the renderer draws. Key events are queued with the time they
+happened and applied on the tick they fall into, so the latency of a move and
+the timing of repeats don't depend on the frame rate or on scheduler jitter.
+
+Everything the clock does to the board goes through TetrisBoard.apply(), so a
+replay.Recorder timed by GameClock.now sees a coherent action stream: the
+player's moves, 'DOWN' for soft drop steps and 'GRAVITY' for both gravity
+steps and locks.
+"""
+
+import time
+
+def gravity_interval(level):
+    """ Seconds per row of gravity at level (1 and up), the usual guideline
+    curve: 1s at level 1, about 0.36s at level 5, 0.1s at level 10
+    """
+    level = max(level, 1)
+    return (0.8 - (level - 1) * 0.007) ** (level - 1)
+
+
+class GameClock:
+    """ Drives board in real time. Call press() and release() from the key
+    handlers and advance() once per rendered frame.
+    """
+
+    # Actions whose keys repeat while held
+    shift_actions = ('LEFT', 'RIGHT')
+
+    board = None
+    clock = None        # callable returning seconds, time.perf_counter by default
+    tick_rate = 240     # simulation ticks per second
+    start_level = 1
+    lines_per_level = 10
+    das = 0.167         # seconds a LEFT or RIGHT is held before it repeats
+    arr = 0.033         # seconds between repeats, 0 to go straight to the wall
+    lock_delay = 0.5    # seconds a grounded block waits before it locks
+    max_lock_resets = 15    # moves that restart the lock delay, per lowest row
+    soft_drop_factor = 20   # soft drop is this many times faster than gravity
+    ticks = 0           # ticks simulated so far
+
+    _origin = None      # clock() at start()
+    _events = None      # queued (seconds, pressed, action), in time order
+    _held = None        # held actions, last pressed last
+    _shift = None       # (action, tick pressed, repeats done) of the repeating key
+    _gravity = 0.0      # seconds of gravity built up towards the next row
+    _lock_tick = None   # tick the block became grounded, None while airborne
+    _lock_resets = 0
+    _lowest = None      # lowest y the current block has reached
+
+    def __init__(self, board, clock=time.perf_counter, **settings):
+        """ settings override the class defaults, eg das=0.1, arr=0 """
+        for name, value in settings.items():
+            if not hasattr(type(self), name):
+                raise TypeError('unknown setting %r' % name)
+            setattr(self, name, value)
+        self.board = board
+        self.clock = clock
+        self._events = []
+        self._held = []
+        board.add_listener(self)
+
+    #---------------------------------------------------------------------------
+    #       Public
+    #---------------------------------------------------------------------------
+
+    @property
+    def level(self):
+        return self.start_level + self.board.score // self.lines_per_level
+
+    def now(self):
+        """ Simulation time in seconds, ie the time of the current tick """
+        return self.ticks / self.tick_rate
+
+    def start(self):
+        """ Start the clock and the board """
+        self._origin = self.clock()
+        self.board.start()
+
+    def press(self, action, at=None):
+        """ Queue a key press of action (one of TetrisBoard.actions) that
+        happened at clock() time at, now by default
+        """
+        self._queue(True, action, at)
+
+    def release(self, action, at=None):
+        self._queue(False, action, at)
+
+    def advance(self, now=None):
+        """ Simulate every tick up to clock() time now. Returns the number of
+        ticks run.
+        """
+        if now is None:
+            now = self.clock()
+        target = int((now - self._origin) * self.tick_rate)
+        start = self.ticks
+        while self.ticks < target and not self.board.game_over:
+            self.ticks += 1
+            self._tick()
+        if self.board.game_over:
+            self.ticks = max(self.ticks, target)
+        return self.ticks - start
+
+    #---------------------------------------------------------------------------
+    #       Board listener
+    #---------------------------------------------------------------------------
+
+    def on_block_spawned(self, block):
+        self._gravity = 0.0
+        self._lock_tick = None
+        self._lock_resets = 0
+        self._lowest = block.location[1]
+
+    #---------------------------------------------------------------------------
+    #       Private
+    #---------------------------------------------------------------------------
+
+    def _queue(self, pressed, action, at):
+        if at is None:
+            at = self.clock()
+        event = (at - self._origin, pressed, action)
+        events = self._events
+        # Events nearly always arrive in order; keep the queue sorted if not
+        i = len(events)
+        while i and events[i - 1][0] > event[0]:
+            i -= 1
+        events.insert(i, event)
+
+    def _tick(self):
+        tick = self.ticks
+        tick_time = tick / self.tick_rate
+        events = self._events
+        while events and events[0][0] <= tick_time:
+            seconds, pressed, action = events.pop(0)
+            if pressed:
+                self._on_press(action, tick)
+            else:
+                self._on_release(action, tick)
+            if self.board.game_over:
+                return
+
+        self._auto_shift(tick)
+        self._fall()
+        self._lock(tick)
+
+    def _on_press(self, action, tick):
+        if action in self._held:
+            return
+        self._held.append(action)
+        if action in self.shift_actions:
+            self._shift = (action, tick, 0)
+        elif action == 'DOWN':
+            self._gravity = 0.0
+        self._player_move(action)
+
+    def _on_release(self, action, tick):
+        if action not in self._held:
+            return
+        self._held.remove(action)
+        if self._shift is not None and self._shift[0] == action:
+            # Fall back to the other direction if it is still held, with a
+            # fresh delay
+            self._shift = None
+            for other in reversed(self._held):
+                if other in self.shift_actions:
+                    self._shift = (other, tick, 0)
+                    break
+
+    def _auto_shift(self, tick):
+        if self._shift is None:
+            return
+        action, pressed, done = self._shift
+        held = tick - pressed
+        das = round(self.das * self.tick_rate)
+        if held < das:
+            return
+        arr = round(self.arr * self.tick_rate)
+        if arr <= 0:
+            while self._player_move(action):
+                pass
+            return
+        due = (held - das) // arr + 1
+        while done < due:
+            self._player_move(action)
+            done += 1
+        self._shift = (action, pressed, done)
+
+    def _fall(self):
+        """ Gravity, or soft drop while DOWN is held """
+        block = self.board.current_block
+        if block is None or not block.can_move('DOWN'):
+            self._gravity = 0.0
+            return
+        interval = gravity_interval(self.level)
+        action = 'GRAVITY'
+        if 'DOWN' in self._held:
+            interval /= self.soft_drop_factor
+            action = 'DOWN'
+        self._gravity += 1.0 / self.tick_rate
+        while self._gravity >= interval and block.can_move('DOWN'):
+            self._gravity -= interval
+            self.board.apply(action)
+            self._moved_down(block)
+
+    def _lock(self, tick):
+        block = self.board.current_block
+        if block is None:
+            return
+        if block.can_move('DOWN'):
+            self._lock_tick = None
+            return
+        if self._lock_tick is None:
+            self._lock_tick = tick
+        elif tick - self._lock_tick >= round(self.lock_delay * self.tick_rate):
+            # Grounded, so gravity locks it
+            self.board.apply('GRAVITY')
+
+    def _player_move(self, action):
+        board = self.board
+        block = board.current_block
+        moved = board.apply(action)
+        if not moved or board.current_block is not block:
+            return moved
+        if action == 'DOWN':
+            self._moved_down(block)
+        elif self._lock_tick is not None and self._lock_resets < self.max_lock_resets:
+            self._lock_tick = self.ticks
+            self._lock_resets += 1
+        return moved
+
+    def _moved_down(self, block):
+        if block.location[1] < self._lowest:
+            self._lowest = block.location[1]
+            self._lock_resets = 0
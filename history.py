@@ -0,0 +1,334 @@
+""" Undo and rewind.
+
+A History listens to a board and keeps the last N steps of the game, one per
+applied action (see TetrisBoard.apply), locks with their clears and sticky
+collapses included. A step doesn't copy the board. It holds only the locked
+rows the action changed, each as a (before, after) pair of immutable tuples
+of block names, plus the current block, score, game over flag and the name
+the action dealt, before and after. A row that doesn't change is never
+copied, and the tuple a step stores as its after row is the same object the
+next step that touches that row stores as its before row, so a history
+thousands of steps deep mostly holds the rows that locks actually rewrote.
+
+undo() and redo() write just those rows back into the board (and move the
+current block), so stepping costs O(rows changed), not O(board).
+"""
+
+from collections import deque
+
+import tetrofactory
+import tetris_engine
+
+class Step:
+    """ What one action did to the board """
+
+    __slots__ = (
+        'action',       # the applied action, None for changes made outside apply()
+        'rows',         # tuple of (y, row before, row after) for changed locked rows
+        'block_before', # (name, orientation, location) of the current block, or None
+        'block_after',
+        'score_before',
+        'score_after',
+        'game_over_before',
+        'game_over_after',
+        'dealt',        # name the step dealt from the generator, or None
+        'lines',        # lines cleared by each step of the lock's chain, () if none
+    )
+
+    def __init__(self, action, rows, block_before, block_after, score_before,
+                 score_after, game_over_before, game_over_after, dealt, lines):
+        self.action = action
+        self.rows = rows
+        self.block_before = block_before
+        self.block_after = block_after
+        self.score_before = score_before
+        self.score_after = score_after
+        self.game_over_before = game_over_before
+        self.game_over_after = game_over_after
+        self.dealt = dealt
+        self.lines = lines
+
+
+class History:
+    """ Board listener keeping the last size steps. Attach it once the board
+    is set up (squares put there with place_locked() aren't seen as a step),
+    ideally before start(). The board's other listeners aren't told about
+    undo() and redo(), and restored squares have no sprites.
+    """
+
+    size = 1000
+
+    board = None
+    steps = None        # deque of Step, oldest first
+    position = 0        # steps before the board's current state; the rest can be redone
+    _rows = None        # locked rows of the current state, as tuples of names
+    _empty_row = None
+    _top = 0            # rows up to the highest locked square
+    _block = None       # (name, orientation, location) of the current block
+    _score = 0
+    _game_over = False
+    _dealt = 0          # generator.dealt in the current state
+    # The step being recorded
+    _action = None
+    _recording = False
+    _dirty = None       # locked rows that may have changed
+    _moving = None      # the current block, as last seen
+    _moving_rows = ()   # rows _moving was last seen in
+    _lines = ()
+
+    def __init__(self, board, size=None):
+        if size is not None:
+            self.size = size
+        self.board = board
+        self.steps = deque(maxlen=self.size)
+        self._empty_row = (None,) * board.width
+        self._rows = [self._read_row(y) for y in range(board.height)]
+        self._top = board.height
+        self._shrink_top()
+        self._block = _block_state(board.current_block)
+        self._score = board.score
+        self._game_over = board.game_over
+        self._dealt = board.generator.dealt
+        if board.current_block is not None:
+            self._watch(board.current_block)
+        board.add_listener(self)
+
+    def detach(self):
+        self.flush()
+        self.board.remove_listener(self)
+
+    #---------------------------------------------------------------------------
+    #       Public
+    #---------------------------------------------------------------------------
+
+    def undo(self):
+        """ Step back one action. Returns False at the oldest kept state. """
+        self.flush()
+        if not self.position:
+            return False
+        self.position -= 1
+        step = self.steps[self.position]
+        self._restore([(y, before) for y, before, after in step.rows],
+                      step.block_before, step.score_before, step.game_over_before)
+        if step.dealt is not None:
+            self.board.generator.put_back(step.dealt)
+        self._dealt = self.board.generator.dealt
+        return True
+
+    def redo(self):
+        """ Step forward again after undo(). Returns False at the newest state. """
+        self.flush()
+        if self.position == len(self.steps):
+            return False
+        step = self.steps[self.position]
+        self.position += 1
+        if step.dealt is not None:
+            self.board.generator.next()
+        self._dealt = self.board.generator.dealt
+        self._restore([(y, after) for y, before, after in step.rows],
+                      step.block_after, step.score_after, step.game_over_after)
+        return True
+
+    def rewind(self, count):
+        """ Undo up to count actions. Returns how many were undone. """
+        done = 0
+        while done < count and self.undo():
+            done += 1
+        return done
+
+    def flush(self):
+        """ Finish recording the current step. Called for you by the next
+        action, undo() and redo().
+        """
+        if not self._recording:
+            return
+        self._recording = False
+        board = self.board
+        self._locked()
+
+        rows = []
+        top = self._top
+        for y in sorted(self._dirty):
+            after = self._read_row(y)
+            before = self._rows[y]
+            if after != before:
+                rows.append((y, before, after))
+                self._rows[y] = after
+                if after is not self._empty_row and y >= top:
+                    top = y + 1
+        self._top = top
+        self._shrink_top()
+
+        block = _block_state(board.current_block)
+        dealt = board.generator.last if board.generator.dealt != self._dealt else None
+        self._dealt = board.generator.dealt
+        if (not rows and block == self._block and board.score == self._score and
+                board.game_over == self._game_over and dealt is None):
+            return      # eg a move into a wall
+
+        # A new step forgets the undone ones
+        while len(self.steps) > self.position:
+            self.steps.pop()
+        self.steps.append(Step(self._action, tuple(rows), self._block, block,
+                               self._score, board.score, self._game_over,
+                               board.game_over, dealt, self._lines))
+        self.position = len(self.steps)
+        self._block = block
+        self._score = board.score
+        self._game_over = board.game_over
+
+    #---------------------------------------------------------------------------
+    #       Board listener
+    #---------------------------------------------------------------------------
+
+    def on_action(self, action):
+        self.flush()
+        self._begin(action)
+
+    def on_block_spawned(self, block):
+        self._begin(None)
+        self._locked()
+        self._watch(block)
+
+    def on_block_moved(self, block):
+        self._begin(None)
+        self._watch(block)
+
+    def on_lock_resolved(self, result):
+        self._begin(None)
+        self._locked()
+        self._lines = tuple(result.lines)
+        # Squares only leave rows from the lowest cleared one up, but clumps
+        # can fall further than that
+        low = min([square.y for square in result.cleared] +
+                  [to_cell[1] for from_cell, to_cell in result.moves.values()])
+        self._dirty.update(range(low, self._top))
+
+    def on_garbage_added(self, result):
+        self._begin(None)
+        self._dirty.update(range(self._top + result.rows))
+        self._top += result.rows
+        if self.board.current_block is not None:
+            self._watch(self.board.current_block)
+        else:
+            self._moving = None     # pushed off the board, not locked
+
+    def on_game_over(self):
+        self._begin(None)
+        self._locked()
+
+    #---------------------------------------------------------------------------
+    #       Private
+    #---------------------------------------------------------------------------
+
+    def _begin(self, action):
+        """ Start recording a step, unless one is being recorded already """
+        if self._recording:
+            return
+        self._recording = True
+        self._action = action
+        self._dirty = set()
+        self._lines = ()
+
+    def _watch(self, block):
+        self._moving = block
+        self._moving_rows = {square.y for square in block.squares}
+
+    def _locked(self):
+        """ The block being watched may just have locked where it was last seen """
+        if self._moving is not None and self._moving is not self.board.current_block:
+            self._dirty.update(self._moving_rows)
+            # Its rows also bound the stack top for on_lock_resolved
+            self._top = max([self._top] + [y + 1 for y in self._moving_rows])
+            self._moving = None
+
+    def _read_row(self, y):
+        """ Locked row y of the board as a tuple of block names """
+        matrix = self.board.squares_matrix
+        current = self.board.current_block
+        names = tuple(None if square is None or square.block is current else square.block.name
+                      for square in (column[y] for column in matrix))
+        return self._empty_row if names == self._empty_row else names
+
+    def _shrink_top(self):
+        while self._top and self._rows[self._top - 1] is self._empty_row:
+            self._top -= 1
+
+    def _restore(self, rows, block, score, game_over):
+        board = self.board
+        matrix = board.squares_matrix
+        width = board.width
+        # Lift the current block off so only locked squares are in the rows
+        if board.current_block is not None:
+            for square in board.current_block.squares:
+                board.erase_square(square)
+
+        for y, names in rows:
+            blocks = {}     # a block per name per row, like snapshot.restore()
+            for x in range(width):
+                square = matrix[x][y]
+                if square is not None:
+                    board.erase_square(square)
+                    square.block.squares.remove(square)
+                    square.block.bounding_locations_map.pop(square, None)
+                    if not square.block.squares:
+                        board._emptied_blocks += 1
+            for x, name in enumerate(names):
+                if name is not None:
+                    owner = blocks.get(name)
+                    if owner is None:
+                        owner = blocks[name] = tetris_engine.Block(name, board)
+                        board.existing_blocks.append(owner)
+                    square = tetris_engine.Square(owner, (x, y))
+                    owner.squares.append(square)
+                    board.place_square(square)
+            self._rows[y] = names
+            if names is not self._empty_row and y >= self._top:
+                self._top = y + 1
+        self._shrink_top()
+        board._dirty_rows = set()   # no restored row is full
+        board._prune_blocks()
+
+        self._set_block(block)
+        board.score = self._score = score
+        board.game_over = self._game_over = game_over
+
+    def _set_block(self, state):
+        """ Put the current block back on the board as state, reusing the
+        lifted one if it is the same piece
+        """
+        board = self.board
+        block = board.current_block
+        self._block = state
+        if block is not None and (state is None or state[0] != block.name):
+            board.current_block = None
+            board.existing_blocks.remove(block)
+            block = None
+        if state is None:
+            self._moving = None
+            self._moving_rows = ()
+            return
+
+        name, orientation, location = state
+        if block is None:
+            block = tetris_engine.Block(name, board)
+            block.squares = [tetris_engine.Square(block, (x + location[0], y + location[1]))
+                             for x, y in tetrofactory.rotation_table[name][orientation]]
+            board.current_block = block
+            board.existing_blocks.append(block)
+        block.orientation = orientation
+        block.location = location
+        for square, bounding_loc in zip(block.squares,
+                                        tetrofactory.rotation_table[name][orientation]):
+            block.bounding_locations_map[square] = bounding_loc
+            square.x = bounding_loc[0] + location[0]
+            square.y = bounding_loc[1] + location[1]
+            board.place_square(square)
+        block._row_masks = None
+        self._watch(block)
+
+
+def _block_state(block):
+    if block is None:
+        return None
+    return (block.name, block.orientation, block.location)
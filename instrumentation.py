@@ -0,0 +1,225 @@
+""" Input latency and frame time instrumentation.
+
+Every key press is followed through five timestamps:
+
+    key         the renderer got the key event (key_event())
+    applied     the board applied the action (on_action)
+    changed     the board state changed because of it (on_block_moved etc.)
+    committed   the renderer wrote the matching sprite positions
+                (sprites_committed())
+    drawn       the frame showing them was drawn (frame_drawn())
+
+and drawn - key is the press's latency. Only changes made while the board
+applies a pressed action count, not gravity or the repeats of a held key.
+Presses that turn out to change nothing (eg moving into a wall) are dropped
+at the next frame, and presses the board never applies (eg after game over)
+once the frame after the one they were keyed in is drawn.
+
+Frame CPU time is split into named sections (logic, collapse, render, score).
+Sections nest, and each one is charged only for the time not spent in the
+sections inside it. That way the collapse inside a lock inside a logic step
+is counted as collapse, not as logic.
+
+The rolling windows back latency_histogram(), percentile() and summary() for
+an overlay, and with an out file every record is also written as a JSON line.
+"""
+
+import json
+import time
+from collections import deque
+
+# Upper bounds (ms) of the latency histogram buckets; the last one is open
+HISTOGRAM_BUCKETS = (4, 8, 16, 33, 50, 100)
+
+class Instrumentation:
+
+    sections = ('logic', 'collapse', 'render', 'score')
+    window = 1000       # presses and frames kept for the rolling statistics
+
+    clock = None        # callable returning seconds, time.perf_counter by default
+    out = None          # text file JSON lines are written to, or None
+    latencies = None    # rolling latencies of the last presses, in seconds
+    frames = None       # rolling per frame dicts of section -> seconds
+    frame_count = 0
+    board = None
+    _origin = None
+    _pending = None     # presses not drawn yet: dicts of stage -> time, and the
+                        # frame_count when keyed
+    _applying = None    # the press the board is applying, if any
+    _stack = None       # open sections: [name, start, time spent in children]
+    _frame = None       # section -> seconds so far this frame
+
+    def __init__(self, out=None, clock=time.perf_counter):
+        self.out = out
+        self.clock = clock
+        self.latencies = deque(maxlen=self.window)
+        self.frames = deque(maxlen=self.window)
+        self._origin = clock()
+        self._pending = []
+        self._stack = []
+        self._frame = dict.fromkeys(self.sections, 0.0)
+
+    def attach(self, board):
+        """ Listen to board. Its on_collapse_started and on_collapse_finished
+        events time the sticky collapse as 'collapse'. Attach before the
+        renderer adds its own listener, so 'changed' is stamped before the
+        sprites are updated.
+        """
+        self.board = board
+        board.add_listener(self)
+
+    def detach(self):
+        self.board.remove_listener(self)
+
+    #---------------------------------------------------------------------------
+    #       Latency
+    #---------------------------------------------------------------------------
+
+    def key_event(self, action):
+        """ A key for action was pressed, now """
+        self._pending.append({'action': action, 'key': self.clock(),
+                              'frame': self.frame_count})
+
+    def sprites_committed(self):
+        """ The renderer finished writing sprites for the latest changes """
+        now = None
+        for press in self._pending:
+            if 'changed' in press and 'committed' not in press:
+                press['committed'] = now = now or self.clock()
+
+    def on_action(self, action):
+        # Every apply() starts with this, so gravity and held key repeats
+        # clear _applying and their moves aren't taken for a press's
+        self._applying = None
+        for press in self._pending:
+            if 'applied' not in press and press['action'] == action:
+                press['applied'] = self.clock()
+                self._applying = press
+                break
+
+    def _changed(self, *args):
+        press = self._applying
+        if press is not None and 'changed' not in press:
+            press['changed'] = self.clock()
+
+    on_block_moved = on_block_spawned = on_lock_resolved = _changed
+
+    def on_collapse_started(self, rows):
+        self._open('collapse')
+
+    def on_collapse_finished(self, moved):
+        self._close()
+
+    #---------------------------------------------------------------------------
+    #       Frame time
+    #---------------------------------------------------------------------------
+
+    def section(self, name):
+        """ Context manager charging the time inside it to section name """
+        return _Section(self, name)
+
+    def _open(self, name):
+        self._stack.append([name, self.clock(), 0.0])
+
+    def _close(self):
+        stack = self._stack
+        name, start, children = stack.pop()
+        spent = self.clock() - start
+        self._frame[name] += spent - children
+        if stack:
+            stack[-1][2] += spent
+
+    def frame_drawn(self):
+        """ A frame was drawn. Completes the presses it shows and closes the
+        frame's time split.
+        """
+        now = self.clock()
+        still_pending = []
+        for press in self._pending:
+            if 'committed' in press:
+                press['drawn'] = now
+                latency = now - press['key']
+                self.latencies.append(latency)
+                self._write('input', action=press['action'], latency=latency * 1000,
+                            **{stage: (press[stage] - self._origin) * 1000
+                               for stage in ('key', 'applied', 'changed', 'committed', 'drawn')})
+            elif 'changed' in press:
+                still_pending.append(press)
+            elif 'applied' not in press and press['frame'] == self.frame_count:
+                # Keyed since the last frame; the board may apply it next tick
+                still_pending.append(press)
+        self._pending = still_pending
+
+        frame = self._frame
+        self.frames.append(frame)
+        self.frame_count += 1
+        self._write('frame', frame=self.frame_count, time=(now - self._origin) * 1000,
+                    **{name: seconds * 1000 for name, seconds in frame.items()})
+        self._frame = dict.fromkeys(self.sections, 0.0)
+
+    #---------------------------------------------------------------------------
+    #       Statistics
+    #---------------------------------------------------------------------------
+
+    def latency_histogram(self):
+        """ [(upper bound in ms, count)] over the rolling window, the last
+        bucket's bound being None
+        """
+        counts = [0] * (len(HISTOGRAM_BUCKETS) + 1)
+        for latency in self.latencies:
+            ms = latency * 1000
+            i = 0
+            while i < len(HISTOGRAM_BUCKETS) and ms > HISTOGRAM_BUCKETS[i]:
+                i += 1
+            counts[i] += 1
+        return list(zip(HISTOGRAM_BUCKETS + (None,), counts))
+
+    def percentile(self, p):
+        """ pth percentile latency in seconds, None before any press """
+        if not self.latencies:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(int(len(ordered) * p / 100.0), len(ordered) - 1)]
+
+    def frame_times(self, worst=False):
+        """ section -> mean (or worst) seconds per frame over the window """
+        if not self.frames:
+            return dict.fromkeys(self.sections, 0.0)
+        if worst:
+            return {name: max(f[name] for f in self.frames) for name in self.sections}
+        return {name: sum(f[name] for f in self.frames) / len(self.frames)
+                for name in self.sections}
+
+    def summary(self):
+        """ A few lines of text for an overlay """
+        lines = []
+        if self.latencies:
+            lines.append('latency p50 %.1fms p99 %.1fms' % (
+                self.percentile(50) * 1000, self.percentile(99) * 1000))
+            lines.append(' '.join('%s:%d' % ('<%d' % bound if bound else '>%d' % HISTOGRAM_BUCKETS[-1],
+                                              count)
+                                  for bound, count in self.latency_histogram()))
+        mean, worst = self.frame_times(), self.frame_times(worst=True)
+        for name in self.sections:
+            lines.append('%-8s %6.2fms  max %6.2fms' % (name, mean[name] * 1000, worst[name] * 1000))
+        return '\n'.join(lines)
+
+    def _write(self, kind, **record):
+        if self.out is not None:
+            record['type'] = kind
+            self.out.write(json.dumps(record, sort_keys=True) + '\n')
+
+
+class _Section:
+
+    __slots__ = ('instrumentation', 'name')
+
+    def __init__(self, instrumentation, name):
+        self.instrumentation = instrumentation
+        self.name = name
+
+    def __enter__(self):
+        self.instrumentation._open(self.name)
+
+    def __exit__(self, *exc_info):
+        self.instrumentation._close()
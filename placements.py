@@ -0,0 +1,122 @@
+""" Exhaustive placement search for bots.
+
+Finds every final resting place the current block can reach with the moves a
+player has (LEFT, RIGHT, DOWN and UP, ie a clockwise rotation with the same
+wall kicks as Block.rotate), so tucks and spins under overhangs are found
+too. The search runs on the board's rows (one int per row) and the
+precomputed tetrofactory tables, never touching Squares or the
+squares_matrix, and visits each (orientation, x, y) state once.
+
+The block first drops straight down through the empty rows above the stack,
+to a few rows over its top, and the search starts from there. In open space
+every orientation and column is still reachable from that point, so nothing
+is lost, and the work depends on the stack's surface rather than on the
+height of the board.
+"""
+
+from collections import deque
+
+import collapse
+import tetrofactory
+
+class Placement:
+    """ One reachable final position of a block, and the board it leaves """
+
+    name = None
+    orientation = None
+    location = None     # block location (x, y) once landed
+    cells = None        # (x, y) cells the block covers once landed
+    path = None         # actions from the spawn state to here; add 'DROP' to lock
+    rows = None         # board after the lock, clears and collapses, one int per row
+    lines = None        # lines cleared by each step of the chain
+
+    def __init__(self, name, orientation, location, cells, path, rows, lines):
+        self.name = name
+        self.orientation = orientation
+        self.location = location
+        self.cells = cells
+        self.path = path
+        self.rows = rows
+        self.lines = lines
+
+    def __repr__(self):
+        return 'Placement(%s, orientation=%d, location=%r, lines=%r)' % (
+            self.name, self.orientation, self.location, self.lines)
+
+
+# Empty rows left under the block where the search starts, enough for any
+# rotation and kick to play out as it would from the spawn
+open_rows = 4
+
+def enumerate_placements(rows, width, name, orientation, location):
+    """ Every distinct landing spot for block name starting at orientation and
+    location. rows must not contain the block itself. Placements covering the
+    same cells (eg an O in different orientations) are only listed once, with
+    the shortest path.
+    """
+    height = len(rows)
+    table = tetrofactory.rotation_table[name]
+    kicks = tetrofactory.kick_table[name]
+
+    def fits(o, x, y):
+        for bound_x, bound_y in table[o]:
+            cell_x = bound_x + x
+            cell_y = bound_y + y
+            if (cell_x < 0 or cell_x >= width or cell_y < 0 or cell_y >= height or
+                    (rows[cell_y] >> cell_x) & 1):
+                return False
+        return True
+
+    start = (orientation, location[0], location[1])
+    if not fits(*start):
+        return []
+    # Drop through the empty rows, keeping open_rows clear below the block
+    top = height
+    while top and not rows[top - 1]:
+        top -= 1
+    bottom = min(by for bx, by in table[orientation]) + location[1]
+    drop = max(0, bottom - (top + open_rows))
+    start = (orientation, location[0], location[1] - drop)
+    parents = {start: None}     # state -> (previous state, action)
+    queue = deque([start])
+    landings = {}   # frozenset of cells -> state
+
+    def visit(state, parent, action):
+        if state not in parents:
+            parents[state] = (parent, action)
+            queue.append(state)
+
+    while queue:
+        state = queue.popleft()
+        o, x, y = state
+        if fits(o, x - 1, y):
+            visit((o, x - 1, y), state, 'LEFT')
+        if fits(o, x + 1, y):
+            visit((o, x + 1, y), state, 'RIGHT')
+        if fits(o, x, y - 1):
+            visit((o, x, y - 1), state, 'DOWN')
+        else:
+            cells = frozenset((bx + x, by + y) for bx, by in table[o])
+            landings.setdefault(cells, state)
+        to = (o + 1) % 4
+        for kick_x, kick_y in kicks[(o, to)]:
+            if fits(to, x + kick_x, y + kick_y):
+                visit((to, x + kick_x, y + kick_y), state, 'UP')
+                break
+
+    result = []
+    for cells, state in landings.items():
+        path = ['DOWN'] * drop
+        step = state
+        while parents[step] is not None:
+            step, action = parents[step]
+            path.append(action)
+        path[drop:] = reversed(path[drop:])
+
+        locked = list(rows)
+        for x, y in cells:
+            locked[y] |= 1 << x
+        after, lines = collapse.resolve_rows(locked, width, [y for x, y in cells])
+        o, x, y = state
+        result.append(Placement(name, o, (x, y), sorted(cells), path, after, lines))
+    return result
@@ -0,0 +1,228 @@
+""" Recording and replaying games.
+
+A replay is the piece generator's seed and policy plus every action applied
+to the board (see TetrisBoard.apply), each with the time it happened. Since
+the engine is deterministic for a given generator, re-applying the actions to
+a fresh board reproduces the game exactly, either headlessly as fast as
+possible (Replay.run) or paced in real time for a renderer (ReplayPlayer).
+
+Binary format, little endian:
+
+    header   4s  magic b'TRPL'
+             B   format version
+             B   piece policy, index into PieceGenerator.policies
+             q   piece generator seed, so only 64-bit int seeds can be recorded
+             B   start block, index into tetrofactory.blockmap, 255 for none
+             H   board width
+             H   board height
+    events   one unsigned LEB128 varint per action:
+             (milliseconds since the previous action << 3) | action code
+
+so a typical action takes one or two bytes. Version 1 replays have no width
+and height, and are always of a 10x22 board.
+"""
+
+import struct
+import time
+
+import tetrofactory
+from tetris_engine import TetrisBoard
+
+MAGIC = b'TRPL'
+VERSION = 2
+_header = struct.Struct('<4sBBqBHH')
+_header_v1 = struct.Struct('<4sBBqB')
+_no_block = 255
+_action_bits = 3
+
+def _action_codes():
+    return {action: code for code, action in enumerate(TetrisBoard.actions)}
+
+class Recorder:
+    """ Board listener that records every applied action. Attach it before
+    the board is started so the whole game is captured.
+    """
+
+    board = None
+    clock = None    # callable returning seconds, time.perf_counter by default
+    events = None   # list of (seconds since recording started, action)
+    _start = None
+
+    def __init__(self, board, clock=time.perf_counter):
+        seed = board.generator.seed
+        if not isinstance(seed, int) or not -(1 << 63) <= seed < (1 << 63):
+            raise ValueError('only games with a 64-bit int seed can be recorded')
+        if board.generator.dealt:
+            raise ValueError('board already dealt blocks; record before start()')
+        self.board = board
+        self.clock = clock
+        self.events = []
+        self._start = clock()
+        board.add_listener(self)
+
+    def on_action(self, action):
+        self.events.append((self.clock() - self._start, action))
+
+    def detach(self):
+        self.board.remove_listener(self)
+
+    def replay(self):
+        board = self.board
+        return Replay(board.generator.seed, board.generator.policy,
+                      board.start_block_name, list(self.events), board.width,
+                      board.height)
+
+    def to_bytes(self):
+        return self.replay().to_bytes()
+
+    def save(self, path):
+        with open(path, 'wb') as f:
+            f.write(self.to_bytes())
+
+
+class Replay:
+    """ A recorded game: what is needed to rebuild the board, and the actions """
+
+    seed = None
+    policy = None
+    start_block_name = None
+    events = None   # list of (seconds, action)
+    width = TetrisBoard.width
+    height = TetrisBoard.height
+
+    def __init__(self, seed, policy, start_block_name, events, width=None, height=None):
+        self.seed = seed
+        self.policy = policy
+        self.start_block_name = start_block_name
+        self.events = events
+        if width is not None:
+            self.width = width
+        if height is not None:
+            self.height = height
+
+    #---------------------------------------------------------------------------
+    #       Serialization
+    #---------------------------------------------------------------------------
+
+    def to_bytes(self):
+        start = (_no_block if self.start_block_name is None
+                 else tetrofactory.blockmap.index(self.start_block_name))
+        out = bytearray(_header.pack(MAGIC, VERSION,
+                                     tetrofactory.PieceGenerator.policies.index(self.policy),
+                                     self.seed, start, self.width, self.height))
+        codes = _action_codes()
+        previous_ms = 0
+        for seconds, action in self.events:
+            ms = int(round(seconds * 1000))
+            delta = max(ms - previous_ms, 0)
+            previous_ms += delta
+            value = (delta << _action_bits) | codes[action]
+            while value >= 0x80:
+                out.append((value & 0x7f) | 0x80)
+                value >>= 7
+            out.append(value)
+        return bytes(out)
+
+    @classmethod
+    def from_bytes(cls, data):
+        if len(data) < _header_v1.size:
+            raise ValueError('replay is truncated')
+        magic, version, policy, seed, start = _header_v1.unpack_from(data)
+        if magic != MAGIC:
+            raise ValueError('not a replay file')
+        if version == 1:
+            header = _header_v1
+            width = height = None
+        elif version == VERSION:
+            if len(data) < _header.size:
+                raise ValueError('replay is truncated')
+            header = _header
+            width, height = _header.unpack_from(data)[5:]
+        else:
+            raise ValueError('unsupported replay version %d' % version)
+
+        actions = TetrisBoard.actions
+        mask = (1 << _action_bits) - 1
+        events = []
+        ms = 0
+        value = shift = 0
+        for byte in memoryview(data)[header.size:]:
+            value |= (byte & 0x7f) << shift
+            if byte & 0x80:
+                shift += 7
+                continue
+            ms += value >> _action_bits
+            if value & mask >= len(actions):
+                raise ValueError('unknown action code %d' % (value & mask))
+            events.append((ms / 1000.0, actions[value & mask]))
+            value = shift = 0
+        if shift:
+            raise ValueError('replay is truncated')
+
+        if policy >= len(tetrofactory.PieceGenerator.policies):
+            raise ValueError('unknown piece policy %d' % policy)
+        if start != _no_block and start >= len(tetrofactory.blockmap):
+            raise ValueError('unknown start block %d' % start)
+        return cls(seed, tetrofactory.PieceGenerator.policies[policy],
+                   None if start == _no_block else tetrofactory.blockmap[start],
+                   events, width, height)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as f:
+            return cls.from_bytes(f.read())
+
+    #---------------------------------------------------------------------------
+    #       Playback
+    #---------------------------------------------------------------------------
+
+    def new_board(self, **kwargs):
+        """ A fresh, unstarted board dealing the recorded blocks """
+        generator = tetrofactory.PieceGenerator(self.seed, self.policy)
+        kwargs.setdefault('width', self.width)
+        kwargs.setdefault('height', self.height)
+        return TetrisBoard(start_block_name=self.start_block_name,
+                           generator=generator, **kwargs)
+
+    def run(self, board=None):
+        """ Replay every action headlessly, as fast as possible. Returns the
+        board in its final state.
+        """
+        if board is None:
+            board = self.new_board()
+        board.start()
+        apply = board.apply
+        for seconds, action in self.events:
+            apply(action)
+        return board
+
+
+class ReplayPlayer:
+    """ Feeds a replay into a board at the pace it was recorded. Call
+    advance() with the time that passed, eg from a cocos scheduled callback.
+    """
+
+    replay = None
+    board = None
+    elapsed = 0.0
+    _next = 0   # index of the next event to apply
+
+    def __init__(self, replay, board):
+        self.replay = replay
+        self.board = board
+
+    @property
+    def finished(self):
+        return self._next >= len(self.replay.events)
+
+    def advance(self, dt):
+        """ Apply every action due in the next dt seconds. Returns how many
+        were applied.
+        """
+        self.elapsed += dt
+        events = self.replay.events
+        start = self._next
+        while self._next < len(events) and events[self._next][0] <= self.elapsed:
+            self.board.apply(events[self._next][1])
+            self._next += 1
+        return self._next - start
@@ -0,0 +1,173 @@
+""" Index of the tile resources in tetris.xml, cached on disk.
+
+cocos.tiles.load() parses the whole XML file on every launch and builds every
+map layer, tile and image in it before the first frame. The renderer only
+needs a few of them up front, so instead the XML is parsed once, with
+ElementTree, into a ResourceIndex of plain data:
+
+    images   image id -> (file, x, y, width, height) region of an atlas
+    tiles    tile id -> image id
+    maps     map id -> tile size, origin and columns of tile ids
+
+which is saved as JSON in __pycache__ next to the XML file. Later launches
+read the JSON instead, as long as neither the XML file nor any image file it
+refers to changed (same size and mtime, or failing that the same SHA-1). The
+renderer then builds cocos layers and pyglet images from the index only when
+they are first asked for.
+"""
+
+import hashlib
+import json
+import os
+import xml.etree.ElementTree as ElementTree
+
+import tetrofactory
+
+CACHE_VERSION = 1
+
+class ResourceIndex:
+
+    path = None     # the XML file
+    images = None
+    tiles = None
+    maps = None
+
+    def __init__(self, path, images, tiles, maps):
+        self.path = path
+        self.images = images
+        self.tiles = tiles
+        self.maps = maps
+
+    @property
+    def files(self):
+        """ Every file the index was built from """
+        return [self.path] + sorted({image[0] for image in self.images.values()})
+
+    def map_image(self, map_id, x, y):
+        """ Image id of the tile at column x, row y of a map """
+        return self.tiles[self.maps[map_id]['columns'][x][y]]
+
+    def piece_images(self):
+        """ Block name -> image id, from the 'sandbox' palette """
+        return {name: self.map_image('sandbox', 0, index)
+                for name, index in tetrofactory.image_index.items()}
+
+    def digit_images(self):
+        """ Image id of each digit's squares, from the 'atoms' palette """
+        return [self.map_image('atoms', 0, digit) for digit in range(10)]
+
+    def to_json(self):
+        return {'images': self.images, 'tiles': self.tiles, 'maps': self.maps}
+
+    @classmethod
+    def from_json(cls, path, data):
+        images = {id: tuple(region) for id, region in data['images'].items()}
+        return cls(path, images, data['tiles'], data['maps'])
+
+
+def parse(path):
+    """ Build the index of the resource XML file at path """
+    root = ElementTree.parse(path).getroot()
+    if root.tag != 'resource':
+        raise ValueError('document is <%s> instead of <resource>' % root.tag)
+    directory = os.path.dirname(path)
+    images, tiles, maps = {}, {}, {}
+
+    for atlas in root.iter('imageatlas'):
+        file = os.path.join(directory, atlas.get('file'))
+        default = atlas.get('size')
+        for image in atlas.iter('image'):
+            width, height = map(int, (image.get('size') or default).split('x'))
+            x, y = map(int, image.get('offset').split(','))
+            images[image.get('id')] = (file, x, y, width, height)
+
+    for tile in root.iter('tile'):
+        image = tile.find('image')
+        tiles[tile.get('id')] = image.get('ref') if image is not None else None
+
+    for rectmap in root.iter('rectmap'):
+        width, height = map(int, rectmap.get('tile_size').split('x'))
+        origin = rectmap.get('origin')
+        maps[rectmap.get('id')] = {
+            'tile_size': [width, height],
+            'origin': [int(v) for v in origin.split(',')] if origin else None,
+            'columns': [[cell.get('tile') for cell in column.iter('cell')]
+                        for column in rectmap.iter('column')],
+        }
+
+    return ResourceIndex(path, images, tiles, maps)
+
+def default_cache_path(path):
+    directory, name = os.path.split(path)
+    return os.path.join(directory, '__pycache__', name + '.cache.json')
+
+def load(path, cache_path=None):
+    """ The index of the XML file at path, from the cache if it is still
+    valid. Otherwise the file is parsed and the cache rewritten.
+    """
+    if cache_path is None:
+        cache_path = default_cache_path(path)
+
+    cached = _read_cache(cache_path)
+    if cached is not None:
+        index = ResourceIndex.from_json(path, cached['index'])
+        sources = cached['sources']
+        if set(sources) == set(index.files):
+            stamps = _stamps(sources)
+            if stamps is not None:
+                if stamps != sources:
+                    # Touched but maybe not changed; keep the new stamps
+                    _write_cache(cache_path, index, stamps)
+                return index
+
+    index = parse(path)
+    stamps = _stamps({file: None for file in index.files})
+    if stamps is not None:  # else an image is missing, and nothing is cached
+        _write_cache(cache_path, index, stamps)
+    return index
+
+def _read_cache(cache_path):
+    try:
+        with open(cache_path) as f:
+            cached = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(cached, dict) or cached.get('version') != CACHE_VERSION:
+        return None
+    sources = cached.get('sources')
+    if not isinstance(sources, dict) or not all(
+            isinstance(stamp, list) and len(stamp) == 3 for stamp in sources.values()):
+        return None
+    return cached
+
+def _write_cache(cache_path, index, sources):
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        temp = cache_path + '.tmp'
+        with open(temp, 'w') as f:
+            json.dump({'version': CACHE_VERSION, 'sources': sources,
+                       'index': index.to_json()}, f)
+        os.replace(temp, cache_path)
+    except OSError:
+        pass    # a read-only install just parses every time
+
+def _stamps(sources):
+    """ file -> [size, mtime_ns, sha1] for every file in sources, reusing the
+    hash from sources where size and mtime didn't change. None if a file is
+    missing or its contents changed.
+    """
+    stamps = {}
+    for file, old in sources.items():
+        try:
+            stat = os.stat(file)
+        except OSError:
+            return None
+        if old is not None and old[:2] == [stat.st_size, stat.st_mtime_ns]:
+            stamps[file] = old
+            continue
+        with open(file, 'rb') as f:
+            digest = hashlib.sha1(f.read()).hexdigest()
+        if old is not None and old[2] != digest:
+            return None
+        stamps[file] = [stat.st_size, stat.st_mtime_ns, digest]
+    return stamps
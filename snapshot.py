@@ -0,0 +1,300 @@
+""" Full game state snapshots.
+
+A Snapshot holds everything a TetrisBoard needs to carry on exactly where it
+was: the locked cells and the colour (block name) of each, the current block
+with its orientation and location, the piece generator's state, the score
+and whether the game is over. It is immutable, so search and rollout code can
+take one and restore() any number of boards from it, and to_bytes() makes a
+save state or crash recovery file of the same.
+
+Binary format, little endian:
+
+    header     4s  magic b'TSNP'
+               B   format version
+               H   width
+               H   height
+               I   score
+               B   1 if the game is over
+    block      B   current block, index into tetrofactory.blockmap, 255 for none
+               B   orientation
+               h   location x
+               h   location y
+    generator  B   piece policy, index into PieceGenerator.policies
+               q   seed, so only games with a 64-bit int seed can be saved
+               I   blocks dealt so far
+               H   queued names, followed by their blockmap indexes, two to
+                   a byte
+               625I  Mersenne Twister state, then B 1 and d if a gauss is kept
+    rows       (width + 7) // 8 bytes per row, bottom row first, bit x being
+               column x; the current block is not included
+    colours    one tetrofactory.colour_names index per locked cell, two to a
+               byte, in row order then column order
+
+so a board, its piece and the queue fit in about 150 bytes, next to 2.5KB for
+the random generator.
+"""
+
+import struct
+
+import tetrofactory
+import tetris_engine
+
+MAGIC = b'TSNP'
+VERSION = 1
+_header = struct.Struct('<4sBHHIB')
+_block = struct.Struct('<BBhh')
+_generator = struct.Struct('<BqIH')
+_mt_state = struct.Struct('<625I')
+_gauss = struct.Struct('<d')
+_no_block = 255
+
+class Snapshot:
+    """ Immutable copy of a board's game state. Take one with
+    TetrisBoard.snapshot(), restore it with TetrisBoard.restore().
+    """
+
+    __slots__ = (
+        'width',
+        'height',
+        'rows',         # tuple of locked occupancy, one int per row
+        'colours',      # bytes, colour_names index of each locked cell in row order
+        'block',        # (name, orientation, location) of the current block, or None
+        'generator',    # PieceGenerator.getstate()
+        'score',
+        'game_over',
+    )
+
+    def __init__(self, width, height, rows, colours, block, generator, score, game_over):
+        self.width = width
+        self.height = height
+        self.rows = rows
+        self.colours = colours
+        self.block = block
+        self.generator = generator
+        self.score = score
+        self.game_over = game_over
+
+    def cells(self):
+        """ (x, y, block name) of every locked cell, in row order """
+        names = tetrofactory.colour_names
+        colours = self.colours
+        i = 0
+        for y, row in enumerate(self.rows):
+            while row:
+                low = row & -row
+                yield low.bit_length() - 1, y, names[colours[i]]
+                row ^= low
+                i += 1
+
+    def new_board(self, **kwargs):
+        """ A fresh board in this state, with no listeners """
+        kwargs.setdefault('width', self.width)
+        kwargs.setdefault('height', self.height)
+        board = tetris_engine.TetrisBoard(**kwargs)
+        board.restore(self)
+        return board
+
+    #---------------------------------------------------------------------------
+    #       Serialization
+    #---------------------------------------------------------------------------
+
+    def to_bytes(self):
+        out = bytearray(_header.pack(MAGIC, VERSION, self.width, self.height,
+                                     self.score, self.game_over))
+        blockmap = tetrofactory.blockmap
+        if self.block is None:
+            out += _block.pack(_no_block, 0, 0, 0)
+        else:
+            name, orientation, (x, y) = self.block
+            out += _block.pack(blockmap.index(name), orientation, x, y)
+
+        seed, policy, dealt, rng_state, queue = self.generator
+        if not isinstance(seed, int) or not -(1 << 63) <= seed < (1 << 63):
+            raise ValueError('only games with a 64-bit int seed can be saved')
+        out += _generator.pack(tetrofactory.PieceGenerator.policies.index(policy),
+                               seed, dealt, len(queue))
+        out += _pack_nibbles([blockmap.index(name) for name in queue])
+        version, words, gauss = rng_state
+        out += _mt_state.pack(*words)
+        out.append(gauss is not None)
+        if gauss is not None:
+            out += _gauss.pack(gauss)
+
+        row_size = (self.width + 7) // 8
+        for row in self.rows:
+            out += row.to_bytes(row_size, 'little')
+        out += _pack_nibbles(self.colours)
+        return bytes(out)
+
+    @classmethod
+    def from_bytes(cls, data):
+        data = memoryview(data)
+        try:
+            magic, version, width, height, score, game_over = _header.unpack_from(data)
+            if magic != MAGIC:
+                raise ValueError('not a snapshot')
+            if version != VERSION:
+                raise ValueError('unsupported snapshot version %d' % version)
+            offset = _header.size
+
+            blockmap = tetrofactory.blockmap
+            name, orientation, x, y = _block.unpack_from(data, offset)
+            offset += _block.size
+            block = None if name == _no_block else (blockmap[name], orientation, (x, y))
+
+            policy, seed, dealt, queued = _generator.unpack_from(data, offset)
+            offset += _generator.size
+            queue = tuple(blockmap[name]
+                          for name in _unpack_nibbles(data[offset:], queued))
+            offset += (queued + 1) // 2
+            words = _mt_state.unpack_from(data, offset)
+            offset += _mt_state.size
+            gauss = None
+            if data[offset]:
+                gauss, = _gauss.unpack_from(data, offset + 1)
+                offset += _gauss.size
+            offset += 1
+            generator = (seed, tetrofactory.PieceGenerator.policies[policy], dealt,
+                         (3, words, gauss), queue)
+
+            row_size = (width + 7) // 8
+            if len(data) < offset + height * row_size:
+                raise ValueError('snapshot is truncated')
+            rows = tuple(int.from_bytes(data[offset + y * row_size:offset + (y + 1) * row_size],
+                                        'little')
+                         for y in range(height))
+            offset += height * row_size
+            colours = _unpack_nibbles(data[offset:], sum(row.bit_count() for row in rows))
+        except (struct.error, IndexError):
+            raise ValueError('snapshot is truncated')
+
+        # Checked here, since restore() would fail half way through the board
+        if any(row >> width for row in rows):
+            raise ValueError('snapshot has cells outside the board')
+        if colours and max(colours) >= len(tetrofactory.colour_names):
+            raise ValueError('unknown colour %d in snapshot' % max(colours))
+        if block is not None:
+            name, orientation, (x, y) = block
+            table = tetrofactory.rotation_table[name]
+            if orientation >= len(table):
+                raise ValueError('unknown orientation %d in snapshot' % orientation)
+            if not all(0 <= bx + x < width and 0 <= by + y < height
+                       for bx, by in table[orientation]):
+                raise ValueError('snapshot has cells outside the board')
+        return cls(width, height, rows, colours, block, generator, score,
+                   bool(game_over))
+
+    def save(self, path):
+        with open(path, 'wb') as f:
+            f.write(self.to_bytes())
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as f:
+            return cls.from_bytes(f.read())
+
+
+def _pack_nibbles(values):
+    """ values (each under 16) two to a byte, the first in the low bits """
+    out = bytearray(values[0::2])
+    for i, value in enumerate(values[1::2]):
+        out[i] |= value << 4
+    return out
+
+def _unpack_nibbles(data, count):
+    """ The first count values packed into data by _pack_nibbles() """
+    packed = data[:(count + 1) // 2]
+    if len(packed) < (count + 1) // 2:
+        raise ValueError('snapshot is truncated')
+    values = bytearray(count)
+    values[0::2] = bytes(byte & 0xf for byte in packed)
+    values[1::2] = bytes(byte >> 4 for byte in packed[:count // 2])
+    return bytes(values)
+
+
+def take(board):
+    """ Snapshot of board. See TetrisBoard.snapshot() """
+    rows = list(board._occupancy_rows())
+    block = board.current_block
+    if block is not None:
+        for y, mask in block.row_masks.items():
+            rows[y] &= ~mask
+        block = (block.name, block.orientation, block.location)
+
+    index = {name: i for i, name in enumerate(tetrofactory.colour_names)}
+    matrix = board.squares_matrix
+    colours = bytearray()
+    for y, row in enumerate(rows):
+        while row:
+            low = row & -row
+            colours.append(index[matrix[low.bit_length() - 1][y].block.name])
+            row ^= low
+
+    return Snapshot(board.width, board.height, tuple(rows), bytes(colours), block,
+                    board.generator.getstate(), board.score, board.game_over)
+
+def restore(board, snapshot):
+    """ Put board in the state of snapshot. See TetrisBoard.restore() """
+    width, height = board.width, board.height
+    if (snapshot.width, snapshot.height) != (width, height):
+        raise ValueError('snapshot is %dx%d, board is %dx%d' % (
+            snapshot.width, snapshot.height, width, height))
+
+    Block, Square = tetris_engine.Block, tetris_engine.Square
+    # Rebuilt directly rather than through place_square(), which would keep
+    # the bitboard, counts and skyline in sync one square at a time
+    matrix = board.squares_matrix = [[None] * height for x in range(width)]
+    rows = list(snapshot.rows)
+    row_counts = board.row_counts = [row.bit_count() for row in rows]
+    column_heights = board.column_heights = [0] * width
+    board._stale_columns = set()
+    board._dirty_rows = set()
+
+    names = tetrofactory.colour_names
+    colours = snapshot.colours
+    # A block per colour per row, so a clear only ever edits row sized blocks
+    existing = board.existing_blocks = []
+    board._emptied_blocks = 0
+    i = 0
+    for y, row in enumerate(rows):
+        blocks = [None] * len(names)
+        while row:
+            low = row & -row
+            x = low.bit_length() - 1
+            row ^= low
+            block = blocks[colours[i]]
+            if block is None:
+                block = blocks[colours[i]] = Block(names[colours[i]], board)
+                existing.append(block)
+            i += 1
+            square = Square(block, (x, y))
+            block.squares.append(square)
+            matrix[x][y] = square
+            if y >= column_heights[x]:
+                column_heights[x] = y + 1
+
+    board.current_block = None
+    if snapshot.block is not None:
+        name, orientation, location = snapshot.block
+        block = Block(name, board)
+        block.orientation = orientation
+        block.location = location
+        for bounding_loc in tetrofactory.rotation_table[name][orientation]:
+            square = Square(block, (bounding_loc[0] + location[0],
+                                    bounding_loc[1] + location[1]))
+            block.squares.append(square)
+            block.bounding_locations_map[square] = bounding_loc
+            matrix[square.x][square.y] = square
+            rows[square.y] |= 1 << square.x
+            row_counts[square.y] += 1
+        board.current_block = block
+        board.existing_blocks.append(block)
+
+    if board.bitboard is not None:
+        board.bitboard.rows = rows
+    else:
+        board._rows = rows
+    board.generator = tetrofactory.PieceGenerator.from_state(snapshot.generator)
+    board.score = snapshot.score
+    board.game_over = snapshot.game_over
+    board._remember('Restored')
@@ -0,0 +1,463 @@
+""" Spectator streams: a game as a feed of the cells that changed.
+
+    python3 spectator.py demo game.spec --pieces 200
+    python3 spectator.py view game.spec
+
+    python3 spectator.py demo --port 7778 &
+    python3 spectator.py view --port 7778 --every
+
+A Broadcaster listens to a board and, each time tick() is called (eg once per
+simulation step or frame), writes one frame holding only the cells that
+changed since the previous frame: the current block's moves and rotations,
+spawns, clears and collapse moves, and garbage. A frame is a few bytes per
+row touched, so one process can feed dozens of boards to spectators without
+building or sending whole board dumps. A Viewer reads the stream back from a
+file or socket and keeps the board it describes, headlessly.
+
+Stream format, little endian. varint is an unsigned LEB128 number, and a cell
+is 0 when empty, otherwise 1 + its tetrofactory.colour_names index:
+
+    header   4s  magic b'TSPC'
+             B   format version
+             H   width
+             H   height
+    frames   varint  frame size in bytes, then:
+             varint  ticks since the previous frame
+             varint  score
+             B       flags: 1 game over, 2 keyframe (the board was cleared first)
+             varint  rows in the frame, then for each, bottom first:
+                 varint  rows skipped since the previous one in the frame
+                 B       0 for a mask, 1 for runs
+                 mask:   (width + 7) // 8 bytes, bit x set if column x changed,
+                         then the new cells of those columns, two to a byte
+                 runs:   varint runs, then for each run of changed columns:
+                         varint columns skipped, varint length, and the new
+                         cells, two to a byte
+
+Each row is sent in whichever of the two is shorter: a mask on narrow boards,
+runs on wide ones.
+"""
+
+import argparse
+import random
+import socket
+import struct
+import sys
+
+import tetrofactory
+from tetris_engine import TetrisBoard, rows_to_string
+
+MAGIC = b'TSPC'
+VERSION = 1
+_header = struct.Struct('<4sBHH')
+GAME_OVER, KEYFRAME = 1, 2
+_MASK, _RUNS = 0, 1
+
+class Broadcaster:
+    """ Board listener writing a spectator stream to out, anything with a
+    write() method taking bytes: an open file, a socket's makefile('wb'), an
+    io.BytesIO. The header and a keyframe of the current board are written
+    straight away.
+
+    Listeners aren't told about TetrisBoard.restore() or history undos; call
+    keyframe() after those.
+    """
+
+    board = None
+    out = None
+    ticks = 0           # ticks counted by tick()
+    bytes_written = 0
+    _codes = None       # block name -> cell value
+    _cells = None       # the board as last sent, one bytearray of cells per row
+    _dirty = None       # rows that may have changed since the last frame
+    _moving = ()        # rows the current block was last seen in
+    _score = 0
+    _game_over = False
+    _frame_ticks = 0    # ticks at the last frame
+
+    def __init__(self, board, out):
+        self.board = board
+        self.out = out
+        self._codes = {name: i + 1 for i, name in enumerate(tetrofactory.colour_names)}
+        self._dirty = set()
+        self._write(_header.pack(MAGIC, VERSION, board.width, board.height))
+        board.add_listener(self)
+        self.keyframe()
+
+    def detach(self):
+        self.board.remove_listener(self)
+
+    def tick(self, ticks=None):
+        """ Write a frame if anything changed. ticks is the game's own tick
+        count, eg GameClock.ticks; by default each call counts as one tick.
+        Returns the number of bytes written.
+        """
+        self.ticks = self.ticks + 1 if ticks is None else ticks
+        board = self.board
+        if not self._dirty and (board.score, board.game_over) == (self._score,
+                                                                  self._game_over):
+            return 0
+        return self._frame(sorted(self._dirty), 0)
+
+    def keyframe(self):
+        """ Write the whole board, eg so a viewer can join mid game """
+        width = self.board.width
+        self._cells = [bytearray(width) for y in range(self.board.height)]
+        return self._frame(range(self.board.height), KEYFRAME)
+
+    #---------------------------------------------------------------------------
+    #       Board listener
+    #---------------------------------------------------------------------------
+
+    def on_block_spawned(self, block):
+        self._watch(block)
+
+    def on_block_moved(self, block):
+        self._watch(block)
+
+    def on_lock_resolved(self, result):
+        dirty = self._dirty
+        dirty.update(square.y for square in result.cleared)
+        for from_cell, to_cell in result.moves.values():
+            dirty.add(from_cell[1])
+            dirty.add(to_cell[1])
+
+    def on_garbage_added(self, result):
+        dirty = self._dirty
+        dirty.update(range(result.rows))
+        for from_cell, to_cell in result.moves.values():
+            dirty.add(from_cell[1])
+            dirty.add(to_cell[1])
+        if self.board.current_block is not None:
+            self._watch(self.board.current_block)
+
+    #---------------------------------------------------------------------------
+    #       Private
+    #---------------------------------------------------------------------------
+
+    def _watch(self, block):
+        rows = {square.y for square in block.squares}
+        self._dirty.update(self._moving)
+        self._dirty.update(rows)
+        self._moving = rows
+
+    def _frame(self, rows, flags):
+        board = self.board
+        matrix = board.squares_matrix
+        codes = self._codes
+        width = board.width
+        body = bytearray()
+        count = 0
+        previous = -1
+        for y in rows:
+            new = bytearray(0 if column[y] is None else codes[column[y].block.name]
+                            for column in matrix)
+            old = self._cells[y]
+            if new == old:
+                continue
+            changed = [x for x in range(width) if new[x] != old[x]]
+            _put_varint(body, y - previous - 1)
+            body += min(_encode_mask(new, changed, width), _encode_runs(new, changed),
+                        key=len)
+            self._cells[y] = new
+            previous = y
+            count += 1
+
+        self._dirty = set()
+        self._score = board.score
+        self._game_over = board.game_over
+        if board.game_over:
+            flags |= GAME_OVER
+        frame = bytearray()
+        _put_varint(frame, self.ticks - self._frame_ticks)
+        _put_varint(frame, board.score)
+        frame.append(flags)
+        _put_varint(frame, count)
+        frame += body
+        self._frame_ticks = self.ticks
+
+        out = bytearray()
+        _put_varint(out, len(frame))
+        out += frame
+        self._write(out)
+        return len(out)
+
+    def _write(self, data):
+        self.out.write(data)
+        flush = getattr(self.out, 'flush', None)
+        if flush is not None:
+            flush()
+        self.bytes_written += len(data)
+
+
+class Viewer:
+    """ Rebuilds the board of a spectator stream read from stream, anything
+    with a read(size) method returning bytes: an open file, a socket's
+    makefile('rb'), an io.BytesIO.
+    """
+
+    stream = None
+    width = None
+    height = None
+    cells = None        # one bytearray of cells per row, see the module docstring
+    ticks = 0           # ticks up to the latest frame
+    frames = 0
+    score = 0
+    game_over = False
+
+    def __init__(self, stream):
+        self.stream = stream
+        magic, version, self.width, self.height = _header.unpack(
+            self._read(_header.size))
+        if magic != MAGIC:
+            raise ValueError('not a spectator stream')
+        if version != VERSION:
+            raise ValueError('unsupported spectator stream version %d' % version)
+        self.cells = [bytearray(self.width) for y in range(self.height)]
+
+    def read_frame(self):
+        """ Apply the next frame. Returns False at the end of the stream. """
+        size = self._read_size()
+        if size is None:
+            return False
+        frame = _Reader(self._read(size))
+        width, height = self.width, self.height
+        ticks = _get_varint(frame)
+        score = _get_varint(frame)
+        flags = frame.byte()
+        keyframe = flags & KEYFRAME
+        # Changed rows are rebuilt as copies and only put in once the whole
+        # frame has been read, so a bad frame leaves the board as it was
+        changed_rows = {}
+        y = -1
+        for i in range(_get_varint(frame)):
+            y += _get_varint(frame) + 1
+            if y >= height:
+                raise ValueError('spectator frame has a row outside the board')
+            row = bytearray(width) if keyframe else bytearray(self.cells[y])
+            if frame.byte() == _MASK:
+                mask = int.from_bytes(frame.take((width + 7) // 8), 'little')
+                if mask >> width:
+                    raise ValueError('spectator frame has a cell outside the board')
+                changed = []
+                while mask:
+                    low = mask & -mask
+                    changed.append(low.bit_length() - 1)
+                    mask ^= low
+                for x, cell in zip(changed, _unpack_cells(frame, len(changed))):
+                    row[x] = cell
+            else:
+                x = 0
+                for run in range(_get_varint(frame)):
+                    x += _get_varint(frame)
+                    length = _get_varint(frame)
+                    if x + length > width:
+                        raise ValueError('spectator frame has a cell outside the board')
+                    row[x:x + length] = _unpack_cells(frame, length)
+                    x += length
+            changed_rows[y] = row
+
+        if keyframe:
+            self.cells = [bytearray(width) for y in range(height)]
+        for y, row in changed_rows.items():
+            self.cells[y] = row
+        self.ticks += ticks
+        self.score = score
+        self.game_over = bool(flags & GAME_OVER)
+        self.frames += 1
+        return True
+
+    def run(self):
+        """ Read frames until the stream ends. Returns the number read. """
+        count = 0
+        while self.read_frame():
+            count += 1
+        return count
+
+    def cell(self, x, y):
+        """ Block name at x, y, or None """
+        cell = self.cells[y][x]
+        return None if not cell else tetrofactory.colour_names[cell - 1]
+
+    def rows(self):
+        """ Occupancy, one int per row with bit x set for column x """
+        return [sum(1 << x for x, cell in enumerate(row) if cell) for row in self.cells]
+
+    def board_to_string(self, label=None):
+        return rows_to_string(self.rows(), self.width, label)
+
+    def _read(self, size):
+        data = self.stream.read(size)
+        if len(data) < size:
+            raise ValueError('spectator stream is truncated')
+        return data
+
+    def _read_size(self):
+        """ The varint starting the next frame, None at the end of the stream """
+        first = self.stream.read(1)
+        if not first:
+            return None
+        value = shift = 0
+        byte = first[0]
+        while True:
+            value |= (byte & 0x7f) << shift
+            if not byte & 0x80:
+                return value
+            shift += 7
+            byte = self._read(1)[0]
+
+
+class _Reader:
+    """ Cursor over the bytes of one frame """
+
+    def __init__(self, data):
+        self.data = data
+        self.offset = 0
+
+    def byte(self):
+        return self.take(1)[0]
+
+    def take(self, count):
+        if self.offset + count > len(self.data):
+            raise ValueError('spectator frame is truncated')
+        data = self.data[self.offset:self.offset + count]
+        self.offset += count
+        return data
+
+
+def _put_varint(out, value):
+    while value >= 0x80:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+
+def _get_varint(reader):
+    value = shift = 0
+    while True:
+        byte = reader.byte()
+        value |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return value
+        shift += 7
+
+def _pack_cells(cells):
+    """ cells (each under 16) two to a byte, the first in the low bits """
+    out = bytearray(cells[0::2])
+    for i, cell in enumerate(cells[1::2]):
+        out[i] |= cell << 4
+    return out
+
+def _unpack_cells(reader, count):
+    packed = reader.take((count + 1) // 2)
+    cells = bytearray(count)
+    cells[0::2] = bytes(byte & 0xf for byte in packed)
+    cells[1::2] = bytes(byte >> 4 for byte in packed[:count // 2])
+    return cells
+
+def _encode_mask(row, changed, width):
+    mask = 0
+    for x in changed:
+        mask |= 1 << x
+    out = bytearray([_MASK])
+    out += mask.to_bytes((width + 7) // 8, 'little')
+    out += _pack_cells(bytearray(row[x] for x in changed))
+    return out
+
+def _encode_runs(row, changed):
+    runs = []
+    for x in changed:
+        if runs and runs[-1][1] == x:
+            runs[-1][1] = x + 1
+        else:
+            runs.append([x, x + 1])
+    out = bytearray([_RUNS])
+    _put_varint(out, len(runs))
+    end = 0
+    for start, stop in runs:
+        _put_varint(out, start - end)
+        _put_varint(out, stop - start)
+        out += _pack_cells(row[start:stop])
+        end = stop
+    return out
+
+#-------------------------------------------------------------------------------
+#       Command line
+#-------------------------------------------------------------------------------
+
+def _open_output(args):
+    if args.port is None:
+        return open(args.file, 'wb'), None
+    server = socket.create_server(('127.0.0.1', args.port))
+    connection, address = server.accept()
+    server.close()
+    return connection.makefile('wb'), connection
+
+def _open_input(args):
+    if args.port is None:
+        return open(args.file, 'rb'), None
+    connection = socket.create_connection(('127.0.0.1', args.port))
+    return connection.makefile('rb'), connection
+
+def demo(args):
+    """ A bot game streamed to a file, or to the first viewer to connect """
+    import bots
+    choose = bots.POLICIES[args.policy]
+    rng = random.Random(args.seed)
+    board = TetrisBoard(seed=args.seed, width=args.width, height=args.height)
+    out, connection = _open_output(args)
+    try:
+        broadcaster = Broadcaster(board, out)
+        board.start()
+        broadcaster.tick()
+        for piece in range(args.pieces):
+            if board.game_over:
+                break
+            placement = choose(board, board.enumerate_placements(), rng)
+            for action in placement.path + ['DROP']:
+                board.apply(action)
+                broadcaster.tick()
+    finally:
+        out.close()
+        if connection is not None:
+            connection.close()
+    print('%d bytes for %d ticks' % (broadcaster.bytes_written, broadcaster.ticks))
+
+def view(args):
+    stream, connection = _open_input(args)
+    try:
+        viewer = Viewer(stream)
+        while viewer.read_frame():
+            if args.every:
+                print(viewer.board_to_string('Tick %d, score %d' % (viewer.ticks,
+                                                                   viewer.score)))
+    finally:
+        stream.close()
+        if connection is not None:
+            connection.close()
+    print(viewer.board_to_string('Final board after %d frames, score %d%s' % (
+        viewer.frames, viewer.score, ', game over' if viewer.game_over else '')))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('command', choices=('demo', 'view'))
+    parser.add_argument('file', nargs='?', help='stream file')
+    parser.add_argument('--port', type=int, default=None,
+                        help='stream over a localhost socket instead of a file')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--pieces', type=int, default=100)
+    parser.add_argument('--policy', default='greedy')
+    parser.add_argument('--width', type=int, default=None, help='demo board width')
+    parser.add_argument('--height', type=int, default=None, help='demo board height')
+    parser.add_argument('--every', action='store_true', help='print the board every frame')
+    args = parser.parse_args(argv)
+    if args.file is None and args.port is None:
+        parser.error('give a stream file or --port')
+    if args.command == 'demo':
+        demo(args)
+    else:
+        view(args)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
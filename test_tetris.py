@@ -1,11 +1,78 @@
+import gc
+import os
+import random
+import sys
 import unittest
 
-from tetris_game import *
+import tetrofactory
+from tetris_engine import *
+
+def fill(board, cells, name='O'):
+    """ Put locked squares on the board at the given (x, y) cells """
+    return board.place_locked(cells, name)
+
+def play_random(board, seed, moves=1500):
+    """ Fill the bottom of the board with junk and mash random inputs until
+    the game is lost. Deterministic for a given seed.
+    """
+    rng = random.Random(seed)
+    inputs = [rng.choice(['LEFT', 'LEFT', 'RIGHT', 'RIGHT', 'UP', 'DOWN', 'DROP'])
+              for i in range(moves)]
+    board.generator = tetrofactory.PieceGenerator(seed)
+    fill(board, [(x, y) for y in range(8) for x in range(board.width)
+                 if rng.random() < 0.8])
+    board.start()
+    for direction in inputs:
+        if board.game_over:
+            break
+        board.move_block(direction)
+    return board
+
+def round_robin_collapse(cells, width, height, rows_cleared):
+    """ The original sticky collapse: flood fill the clumps above each cleared
+    row and drop them round robin one row at a time until none can move.
+    """
+    cells = set(cells)
+    clumps = []
+    for y in rows_cleared:
+        for x in range(width):
+            start = (x, y + 1)
+            if start not in cells or any(start in clump for clump in clumps):
+                continue
+            clump, stack = set(), [start]
+            while stack:
+                cx, cy = stack.pop()
+                if (cx, cy) in clump or (cx, cy) not in cells:
+                    continue
+                clump.add((cx, cy))
+                stack.extend([(cx - 1, cy), (cx + 1, cy), (cx, cy - 1), (cx, cy + 1)])
+            clumps.append(clump)
+
+    unmoveable = 0
+    i = 0
+    while clumps and unmoveable < len(clumps):
+        clump = clumps[i % len(clumps)]
+        if all(y > 0 and ((x, y - 1) not in cells or (x, y - 1) in clump)
+               for x, y in clump):
+            cells -= clump
+            clump = {(x, y - 1) for x, y in clump}
+            cells |= clump
+            clumps[i % len(clumps)] = clump
+            unmoveable = 0
+        else:
+            unmoveable += 1
+        i += 1
+    return cells
+
+def occupied(board):
+    return {(x, y) for x in range(board.width) for y in range(board.height)
+            if board.squares_matrix[x][y] is not None}
+
 
 class TestTetrisBoard(unittest.TestCase):
 
     def setUp(self):
-        pass
+        self.board = TetrisBoard(start_block_name='T', seed=0)
 
     def test_collapse(self):
         # After a drop and before the next recursive clear (if there exists new
@@ -13,7 +80,1163 @@ class TestTetrisBoard(unittest.TestCase):
         # If there are new lines, repeat.
         # Else, check that there are no empty rows
         # I could also identify all clumps in the board and make sure they can't move
-        pass
+        board = self.board
+        fill(board, [(x, 0) for x in range(board.width)])
+        # Two clumps resting on the full row. The lone square at (5, 4) isn't
+        # touching the cleared row, so sticky collapse leaves it floating
+        fill(board, [(0, 1), (1, 1), (1, 2)])
+        fill(board, [(9, 1), (9, 2), (8, 3), (9, 3)])
+        fill(board, [(5, 4)])
+
+        self.assertEqual(board._clear_lines(), 1)
+        self.assertEqual(occupied(board),
+                         {(0, 0), (1, 0), (1, 1), (9, 0), (9, 1), (8, 2), (9, 2),
+                          (5, 4)})
+
+    def test_collapse_matches_round_robin(self):
+        import collapse
+        rng = random.Random(1)
+        for trial in range(300):
+            width, height = rng.choice([(10, 22), (6, 40), (20, 12), (70, 16)])
+            density = rng.choice([0.3, 0.5, 0.7])
+            cells = {(x, y) for x in range(width) for y in range(height)
+                     if rng.random() < density}
+            rows_cleared = sorted(rng.sample(range(height - 1), rng.randint(1, 4)))
+            cells = {(x, y) for x, y in cells if y not in rows_cleared}
+
+            rows = [0] * height
+            for x, y in cells:
+                rows[y] |= 1 << x
+            falls = collapse.sticky_collapse(rows, width, rows_cleared)
+            moving = {cell for clump, distance in falls for cell in clump}
+            result = cells - moving
+            for clump, distance in falls:
+                result |= {(x, y - distance) for x, y in clump}
+
+            self.assertEqual(result, round_robin_collapse(cells, width, height, rows_cleared))
+
+    def test_resolve_lock_cascade(self):
+        board = self.board
+        # Clearing row 1 drops the clump on the left into the hole in row 0,
+        # which completes row 0 for a second step of the chain
+        fill(board, [(x, 0) for x in range(1, board.width)])
+        fill(board, [(x, 1) for x in range(board.width)])
+        fill(board, [(0, 2), (0, 3)])
+        result = board.resolve_lock()
+
+        self.assertEqual(result.lines, [1, 1])
+        self.assertEqual(result.total_lines, 2)
+        self.assertEqual(len(result.cleared), 2 * board.width)
+        self.assertEqual(list(result.moves.values()), [((0, 3), (0, 0))])
+        self.assertEqual(result.rows, [1] + [0] * (board.height - 1))
+
+    def test_move_and_drop(self):
+        board = self.board
+        board.start()
+        block = board.current_block
+        self.assertEqual(block.name, 'T')
+        self.assertTrue(board.move_block('LEFT'))
+        self.assertEqual(block.location, (3, 20))
+        self.assertTrue(board.move_block('UP'))
+        board.move_block('DROP')
+        self.assertIsNot(board.current_block, block)
+        self.assertEqual(min(sq.y for sq in block.squares), 0)
+
+    def test_row_counts(self):
+        board = play_random(self.board, seed=18)
+        counts = [sum(1 for x, y in occupied(board) if y == row)
+                  for row in range(board.height)]
+        self.assertEqual(board.row_counts, counts)
+        self.assertNotIn(board.width, counts)
+
+    def test_piece_generator(self):
+        bag = tetrofactory.PieceGenerator(seed=5)
+        names = bag.take(70)
+        for i in range(0, 70, 7):
+            self.assertEqual(sorted(names[i:i + 7]), sorted(tetrofactory.blockmap))
+        self.assertEqual(tetrofactory.PieceGenerator(seed=5).take(70), names)
+
+        generator = tetrofactory.PieceGenerator(seed=5, policy='random')
+        preview = generator.preview(200)
+        self.assertEqual([generator.next() for i in range(200)], preview)
+        self.assertEqual(generator.dealt, 200)
+        self.assertNotEqual(preview, tetrofactory.PieceGenerator(seed=6, policy='random').preview(200))
+        self.assertRaises(ValueError, tetrofactory.PieceGenerator, 1, 'nope')
+
+    def test_board_deals_from_generator(self):
+        board = TetrisBoard(seed=9)
+        expected = tetrofactory.PieceGenerator(seed=9).take(5)
+        self.assertEqual(board.preview(5), expected)
+        board.start()
+        names = [board.current_block.name]
+        for i in range(4):
+            board.move_block('DROP')
+            names.append(board.current_block.name)
+        self.assertEqual(names, expected)
+
+    def test_rotation_table(self):
+        for name, orientations in tetrofactory.rotation_table.items():
+            self.assertEqual(len(orientations), 4)
+            # Four clockwise turns get back to the spawn orientation
+            loc = orientations[3]
+            self.assertEqual([tetrofactory._rotate_clockwise(name, l) for l in loc],
+                             orientations[0])
+        self.assertEqual(set(tetrofactory.rotation_table['O'][1]),
+                         set(tetrofactory.rotation_table['O'][0]))
+
+    def test_rotate_wall_kick(self):
+        board = self.board
+        board.start_block_name = 'I'
+        board.start()
+        block = board.current_block
+        block.rotate('CLOCKWISE')
+        while block.move('LEFT'):
+            pass
+        # Vertical I against the left wall can't rotate in place, so it kicks
+        self.assertEqual(min(sq.x for sq in block.squares), 0)
+        self.assertTrue(block.rotate('CLOCKWISE'))
+        self.assertEqual(block.orientation, 2)
+        self.assertEqual(sorted(sq.x for sq in block.squares), [0, 1, 2, 3])
+        self.assertEqual(occupied(board), {(sq.x, sq.y) for sq in block.squares})
+
+    def test_rotate_blocked(self):
+        board = self.board
+        board.start()
+        block = board.current_block
+        # Box the T in so no kick fits either
+        fill(board, [(x, y) for x in range(board.width) for y in range(board.height)
+                     if board.squares_matrix[x][y] is None])
+        self.assertFalse(block.rotate('CLOCKWISE'))
+        self.assertEqual(block.orientation, 0)
+
+    def test_landing_distance(self):
+        board = self.board
+        fill(board, [(x, 4) for x in range(6)])
+        board.start()
+        block = board.current_block
+        self.assertEqual(board.landing_distance(block), 15)
+
+        # Slide under the roof at y=4 so the skyline can't be used
+        for i in range(3):
+            block.move('RIGHT')
+        block.drop(18)
+        for i in range(3):
+            self.assertTrue(block.move('LEFT'))
+        steps = 0
+        while block.can_move('DOWN', steps):
+            steps += 1
+        self.assertEqual(steps, 2)
+        self.assertEqual(board.landing_distance(block), steps)
+
+    def test_column_heights_after_clear(self):
+        board = self.board
+        fill(board, [(x, 0) for x in range(board.width) if x != 5] + [(0, 1), (0, 2)])
+        board.start_block_name = 'I'
+        board.start()
+        board.move_block('UP')
+        board.move_block('DROP')
+        self.assertEqual(board.score, 1)
+        heights = [board.column_height(x) for x in range(board.width)]
+        self.assertEqual(heights, [2, 0, 0, 0, 0, 3, 0, 0, 0, 0])
+
+    def test_recent_boards_dumped_on_error(self):
+        board = self.board
+        board.start()
+        next_name = board.preview(1)[0]
+        board.move_block('DROP')
+        self.assertEqual([label for label, rows in board.recent_boards],
+                         ['New block: T', 'New block: ' + next_name])
+        # Corrupt the row counters so the next lock tries to clear a hole
+        board.row_counts[0] = board.width
+        board._dirty_rows.add(0)
+        with self.assertLogs('tetris', 'ERROR') as logs:
+            with self.assertRaises(ShouldntHappenError):
+                board.move_block('DROP')
+        self.assertIn('Last 2 boards:', logs.output[0])
+        self.assertIn('New block: ' + next_name, logs.output[0])
+
+    def test_listener_events(self):
+        events = []
+
+        class Listener:
+            def on_block_spawned(self, block):
+                events.append(('spawned', block.name))
+            def on_score_changed(self, score):
+                events.append(('score', score))
+
+        board = self.board
+        board.add_listener(Listener())
+        fill(board, [(x, 0) for x in range(board.width) if x not in (3, 4, 5)])
+        board.start()
+        board.move_block('DROP')
+        self.assertEqual(events[0], ('spawned', 'T'))
+        self.assertIn(('score', 1), events)
+
+    def test_game_over(self):
+        board = self.board
+        fill(board, [(4, 20)])
+        board.start()
+        self.assertTrue(board.game_over)
+        self.assertIsNone(board.current_block)
+        self.assertFalse(board.move_block('LEFT'))
+
+    def test_bitboard_matches_matrix(self):
+        # Play the same random game on both backends and compare the boards
+        boards = [play_random(TetrisBoard(use_bitboard=use_bitboard), seed=18)
+                  for use_bitboard in (True, False)]
+
+        bitboard_board, matrix_board = boards
+        self.assertGreater(bitboard_board.score, 0)
+        self.assertEqual(occupied(bitboard_board), occupied(matrix_board))
+        self.assertEqual(bitboard_board.score, matrix_board.score)
+        rows = [sum(1 << x for x, y in occupied(bitboard_board) if y == row)
+                for row in range(bitboard_board.height)]
+        self.assertEqual(bitboard_board.bitboard.rows, rows)
+        self.assertEqual(list(matrix_board.recent_boards), list(bitboard_board.recent_boards))
+
+        # Restoring keeps the matrix board's rows in step too
+        state = play_random(TetrisBoard(), seed=19, moves=20).snapshot()
+        for board in boards:
+            board.restore(state)
+            for action in ['LEFT', 'UP', 'DROP'] * 3:
+                board.apply(action)
+        self.assertFalse(matrix_board.game_over)
+        self.assertEqual(list(matrix_board.recent_boards), list(bitboard_board.recent_boards))
+
+    def test_board_size(self):
+        self.assertRaises(ValueError, TetrisBoard, width=3)
+        board = TetrisBoard(start_block_name='I', seed=0, width=7, height=12)
+        board.start()
+        self.assertEqual(board.current_block.location, (3, 9))
+        self.assertEqual(sorted(sq.x for sq in board.current_block.squares), [2, 3, 4, 5])
+        self.assertEqual({sq.y for sq in board.current_block.squares}, {10})
+        boards = [play_random(TetrisBoard(use_bitboard=use_bitboard, width=11, height=80),
+                              seed=2, moves=3000)
+                  for use_bitboard in (True, False)]
+        self.assertGreater(boards[0].score, 0)
+        self.assertEqual(occupied(boards[0]), occupied(boards[1]))
+
+    def test_enumerate_placements(self):
+        self.board.start()
+        found = self.board.enumerate_placements()
+        # A T fits 8 columns flat each way up and 9 standing each way round
+        self.assertEqual(len(found), 34)
+        self.assertEqual(len({tuple(p.cells) for p in found}), 34)
+        self.assertEqual(self.board.current_block.location, (4, 20))
+
+    def test_placements_match_play(self):
+        # An overhang at the left and a full bottom row except for a gap
+        # under it, so some placements need a tuck and some clear a line
+        def setup():
+            board = TetrisBoard(start_block_name='T', seed=0)
+            fill(board, [(x, 0) for x in range(3, board.width)] + [(0, 3), (1, 3)])
+            board.start()
+            return board
+
+        found = setup().enumerate_placements()
+        self.assertTrue(any(p.lines for p in found))
+        self.assertTrue(any(p.cells[0][1] < 3 and p.cells[0][0] < 2 for p in found))
+        for placement in found:
+            board = setup()
+            for action in placement.path + ['DROP']:
+                self.assertTrue(board.apply(action))
+            rows = list(board.bitboard.rows)
+            for y, mask in board.current_block.row_masks.items():
+                rows[y] &= ~mask
+            self.assertEqual(rows, placement.rows, placement)
+            self.assertEqual(board.score, sum(placement.lines))
+
+    def test_placements_on_a_tall_board(self):
+        # The same stack under 200 more empty rows: the same landings, each
+        # reached by the same moves after dropping the extra rows
+        def found(height):
+            board = TetrisBoard(height=height, start_block_name='S', seed=0)
+            fill(board, [(x, 0) for x in range(1, board.width)] +
+                 [(x, 1) for x in range(4, 9)] + [(1, 3), (2, 3)])
+            board.start()
+            return {tuple(p.cells): p for p in board.enumerate_placements()}
+
+        short, tall = found(22), found(222)
+        self.assertEqual(set(short), set(tall))
+        for cells, placement in short.items():
+            self.assertEqual(tall[cells].lines, placement.lines)
+            self.assertEqual(tall[cells].rows[:22], placement.rows)
+            self.assertEqual(len(tall[cells].path), len(placement.path) + 200)
+
+
+class TestMemory(unittest.TestCase):
+
+    def play_pieces(self, rng, pieces):
+        """ Headless games of random placements until pieces blocks locked """
+        while pieces > 0:
+            board = TetrisBoard()
+            board.start()
+            while not board.game_over and pieces > 0:
+                for i in range(rng.randrange(4)):
+                    board.move_block('UP')
+                direction = rng.choice(['LEFT', 'RIGHT'])
+                for i in range(rng.randrange(6)):
+                    board.move_block(direction)
+                board.move_block('DROP')
+                pieces -= 1
+
+    def test_memory_stays_flat(self):
+        # 100k pieces in total; after a warm up the memory still held once the
+        # games are gone must not grow
+        rng = random.Random(0)
+        self.play_pieces(rng, 10000)
+        gc.collect()
+        before = sys.getallocatedblocks()
+        self.play_pieces(rng, 90000)
+        gc.collect()
+        after = sys.getallocatedblocks()
+        self.assertLess(after - before, 1000)
+
+
+class TestReplay(unittest.TestCase):
+
+    def record_game(self, seed, actions=400):
+        import replay
+        ticks = iter(range(10 ** 6))
+        board = TetrisBoard(seed=seed)
+        recorder = replay.Recorder(board, clock=lambda: next(ticks) * 0.016)
+        board.start()
+        rng = random.Random(seed)
+        for i in range(actions):
+            board.apply(rng.choice(['LEFT', 'RIGHT', 'UP', 'GRAVITY', 'GRAVITY', 'DROP']))
+        return board, recorder
+
+    def test_round_trip(self):
+        import replay
+        board, recorder = self.record_game(seed=3)
+        data = recorder.to_bytes()
+        self.assertLess(len(data), 3 * len(recorder.events) + 20)
+
+        loaded = replay.Replay.from_bytes(data)
+        self.assertEqual(loaded.seed, board.generator.seed)
+        self.assertEqual([a for t, a in loaded.events], [a for t, a in recorder.events])
+        self.assertAlmostEqual(loaded.events[-1][0], recorder.events[-1][0], places=2)
+
+        replayed = loaded.run()
+        self.assertEqual(occupied(replayed), occupied(board))
+        self.assertEqual(replayed.score, board.score)
+        self.assertEqual(replayed.game_over, board.game_over)
+
+    def test_real_time_player(self):
+        import replay
+        board, recorder = self.record_game(seed=4, actions=50)
+        loaded = replay.Replay.from_bytes(recorder.to_bytes())
+        target = loaded.new_board()
+        target.start()
+        player = replay.ReplayPlayer(loaded, target)
+        self.assertEqual(player.advance(0.0), 0)
+        self.assertEqual(player.advance(0.02), 1)   # one action per 16ms tick
+        while not player.finished:
+            player.advance(0.1)
+        self.assertEqual(occupied(target), occupied(board))
+
+    def test_board_size(self):
+        import replay
+        board = TetrisBoard(seed=6, width=13, height=30)
+        recorder = replay.Recorder(board)
+        board.start()
+        for action in ['LEFT', 'DROP', 'UP', 'RIGHT', 'DROP'] * 20:
+            board.apply(action)
+        loaded = replay.Replay.from_bytes(recorder.to_bytes())
+        self.assertEqual((loaded.width, loaded.height), (13, 30))
+        self.assertEqual(occupied(loaded.run()), occupied(board))
+        # Version 1 replays are always 10x22
+        old = replay._header_v1.pack(replay.MAGIC, 1, 0, 6, 255) + bytes([4 << 3 | 4])
+        loaded = replay.Replay.from_bytes(old)
+        self.assertEqual([a for t, a in loaded.events], ['DROP'])
+        self.assertEqual((loaded.new_board().width, loaded.new_board().height), (10, 22))
+
+    def test_rejects_garbage(self):
+        import replay
+        self.assertRaises(ValueError, replay.Replay.from_bytes, b'nope')
+        self.assertRaises(ValueError, replay.Replay.from_bytes, b'XXXX' + bytes(20))
+        board, recorder = self.record_game(seed=5, actions=5)
+        data = recorder.to_bytes()
+        self.assertRaises(ValueError, replay.Replay.from_bytes, data + b'\x80')
+        # Action codes 6 and 7 aren't used
+        for code in (6, 7):
+            self.assertRaises(ValueError, replay.Replay.from_bytes, data + bytes([code]))
+
+    def test_rejects_seeds_it_cant_save(self):
+        import replay
+        for seed in ('seed', 1 << 63, 1 << 64, -1 - (1 << 63)):
+            self.assertRaises(ValueError, replay.Recorder, TetrisBoard(seed=seed))
+        replay.Recorder(TetrisBoard(seed=(1 << 63) - 1)).to_bytes()
+
+
+class TestSnapshot(unittest.TestCase):
+
+    def play(self, board, seed, actions=150):
+        rng = random.Random(seed)
+        for i in range(actions):
+            board.apply(rng.choice(['LEFT', 'RIGHT', 'UP', 'GRAVITY', 'DROP']))
+
+    def colours(self, board):
+        return {(x, y): square.block.name
+                for x, column in enumerate(board.squares_matrix)
+                for y, square in enumerate(column) if square is not None}
+
+    def assertSameGame(self, board, other):
+        self.assertEqual(self.colours(other), self.colours(board))
+        self.assertEqual(other.bitboard.rows, board.bitboard.rows)
+        self.assertEqual(other.row_counts, board.row_counts)
+        self.assertEqual([other.column_height(x) for x in range(other.width)],
+                         [board.column_height(x) for x in range(board.width)])
+        self.assertEqual(other.score, board.score)
+        self.assertEqual(other.game_over, board.game_over)
+        self.assertEqual(other.preview(10), board.preview(10))
+
+    def test_round_trip(self):
+        import snapshot
+        board = TetrisBoard(seed=6)
+        board.start()
+        fill(board, [(x, 0) for x in range(board.width) if x != 4], 'Z')
+        self.play(board, seed=6, actions=15)
+        self.assertFalse(board.game_over)
+        data = board.snapshot().to_bytes()
+        # The board itself is small; most of it is the random generator's state
+        self.assertLess(len(data), 2500 + 150)
+
+        loaded = snapshot.Snapshot.from_bytes(data).new_board()
+        self.assertSameGame(board, loaded)
+        self.assertEqual(loaded.current_block.name, board.current_block.name)
+        self.assertEqual(loaded.current_block.location, board.current_block.location)
+
+        # Both carry on identically, including clears of the restored squares
+        for game in (board, loaded):
+            for i in range(20):
+                # Most lines, then lowest
+                best = max(game.enumerate_placements(),
+                           key=lambda p: (sum(p.lines), -max(y for x, y in p.cells)))
+                for action in best.path + ['DROP']:
+                    game.apply(action)
+        self.assertGreater(board.score, 0)
+        self.assertSameGame(board, loaded)
+
+    def test_fork(self):
+        board = TetrisBoard(seed=8)
+        board.start()
+        self.play(board, seed=8, actions=30)
+        self.assertFalse(board.game_over)
+        state = board.snapshot()
+        forks = [state.new_board() for i in range(2)]
+        self.play(forks[0], seed=9)
+        self.play(forks[1], seed=10)
+        self.assertNotEqual(self.colours(forks[0]), self.colours(forks[1]))
+
+        forks[0].restore(state)
+        self.assertSameGame(board, forks[0])
+        self.play(board, seed=10)
+        self.assertSameGame(board, forks[1])
+
+    def test_rejects_garbage(self):
+        import snapshot
+        board = TetrisBoard(seed=11)
+        board.start()
+        self.play(board, seed=11, actions=50)
+        data = board.snapshot().to_bytes()
+        self.assertRaises(ValueError, snapshot.Snapshot.from_bytes, b'nope')
+        self.assertRaises(ValueError, snapshot.Snapshot.from_bytes, b'XXXX' + data[4:])
+        self.assertRaises(ValueError, snapshot.Snapshot.from_bytes, data[:-1])
+        self.assertRaises(ValueError, snapshot.Snapshot.from_bytes, data[:100])
+        # A corrupt colour or orientation is caught before restore() starts
+        bad_colour = data[:-1] + bytes([0xff])
+        self.assertRaises(ValueError, snapshot.Snapshot.from_bytes, bad_colour)
+        board = TetrisBoard(seed=11)
+        board.start()
+        data = board.snapshot().to_bytes()
+        at = snapshot._header.size + 1
+        bad_orientation = data[:at] + bytes([4]) + data[at + 1:]
+        self.assertRaises(ValueError, snapshot.Snapshot.from_bytes, bad_orientation)
+
+        # Seeds that don't fit the format can't be saved, but still restore
+        for seed in ('seed', 1 << 63, -1 - (1 << 63)):
+            board = TetrisBoard(seed=seed)
+            board.start()
+            state = board.snapshot()
+            self.assertRaises(ValueError, state.to_bytes)
+            board.restore(state)
+
+
+class TestHistory(unittest.TestCase):
+
+    def state(self, board):
+        block = board.current_block
+        if block is not None:
+            block = (block.name, block.orientation, sorted((sq.x, sq.y) for sq in block.squares))
+        return ({(x, y): square.block.name
+                 for x, column in enumerate(board.squares_matrix)
+                 for y, square in enumerate(column) if square is not None},
+                list(board.bitboard.rows), list(board.row_counts),
+                [board.column_height(x) for x in range(board.width)],
+                block, board.score, board.game_over, board.preview(8))
+
+    def play(self, seed, pieces, size=None):
+        """ Greedy bot game on a junk filled board with a History attached.
+        Returns the board, the history and the state after every step.
+        """
+        import bots
+        import history
+        rng = random.Random(seed)
+        board = TetrisBoard(seed=seed)
+        fill(board, [(x, y) for y in range(6) for x in range(board.width)
+                     if rng.random() < 0.7], 'Z')
+        recorded = history.History(board, size=size)
+        states = [self.state(board)]
+        board.start()
+        recorded.flush()
+        states.append(self.state(board))
+        for i in range(pieces):
+            placement = bots.greedy_policy(board, board.enumerate_placements(), rng)
+            for action in placement.path + ['DROP']:
+                last = recorded.steps[-1]
+                board.apply(action)
+                recorded.flush()
+                if recorded.steps[-1] is not last:
+                    states.append(self.state(board))
+        self.assertFalse(board.game_over)
+        return board, recorded, states
+
+    def test_undo_and_redo(self):
+        board, recorded, states = self.play(seed=1, pieces=60, size=5000)
+        self.assertEqual(len(states), len(recorded.steps) + 1)
+        self.assertTrue(any(step.lines for step in recorded.steps))
+        # Only locks touch locked rows
+        self.assertFalse(any(step.rows for step in recorded.steps if step.action == 'LEFT'))
+
+        for i in range(len(recorded.steps)):
+            self.assertTrue(recorded.undo())
+            self.assertEqual(self.state(board), states[-2 - i])
+        self.assertFalse(recorded.undo())
+        for i in range(len(recorded.steps)):
+            self.assertTrue(recorded.redo())
+            self.assertEqual(self.state(board), states[i + 1])
+        self.assertFalse(recorded.redo())
+
+    def test_branch_and_size(self):
+        board, recorded, states = self.play(seed=2, pieces=30, size=50)
+        self.assertEqual(len(recorded.steps), 50)
+        self.assertEqual(recorded.rewind(100), 50)
+        self.assertEqual(self.state(board), states[-51])
+
+        # Playing on from there forgets the undone steps, and carries on as
+        # the game would have
+        recorded.redo()
+        board.apply('DROP')
+        recorded.flush()
+        self.assertEqual(recorded.position, 2)
+        self.assertFalse(recorded.redo())
+        recorded.undo()
+        self.assertEqual(self.state(board), states[-50])
+
+    def test_cycles_keep_blocks_bounded(self):
+        board, recorded, states = self.play(seed=3, pieces=20, size=5000)
+        bound = 2 * sum(1 for column in board.squares_matrix for square in column
+                        if square is not None) + 2
+        for cycle in range(20):
+            recorded.rewind(len(recorded.steps))
+            while recorded.redo():
+                pass
+            self.assertLessEqual(len(board.existing_blocks), bound)
+        self.assertEqual(self.state(board), states[-1])
+
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+@unittest.skipIf(numpy is None, 'batch.py needs numpy')
+class TestBatch(unittest.TestCase):
+
+    def test_matches_engine(self):
+        # Drive a TetrisBoard per batch board with the same placements, for as
+        # long as the engine can still steer its block there from the spawn
+        import batch
+        count = 6
+        rng = random.Random(2)
+        boards = batch.BatchBoards(count)
+        engines = [TetrisBoard(seed=i) for i in range(count)]
+        for i, board in enumerate(engines):
+            # Rows with one gap each, so placements clear lines
+            gaps = [rng.randrange(board.width) for y in range(6)]
+            fill(board, [(x, y) for y, gap in enumerate(gaps)
+                         for x in range(board.width) if x != gap])
+            boards.set_rows(i, board.bitboard.rows)
+            board.start()
+        compared = [0] * count
+        for turn in range(40):
+            orientations = [rng.randrange(4) for i in range(count)]
+            low, high = boards.x_range(orientations)
+            xs = [rng.randint(lo, hi) for lo, hi in zip(low, high)]
+            names = boards.names
+            boards.place(orientations, xs)
+            for i, board in enumerate(engines):
+                if board is None or board.game_over:
+                    continue
+                self.assertEqual(board.current_block.name, names[i])
+                for j in range(orientations[i]):
+                    board.apply('UP')
+                direction = 'LEFT' if xs[i] < board.current_block.location[0] else 'RIGHT'
+                while board.current_block.location[0] != xs[i]:
+                    if not board.apply(direction):
+                        break
+                block = board.current_block
+                if (block.orientation, block.location[0]) != (orientations[i], xs[i]):
+                    engines[i] = None
+                    continue
+                board.apply('DROP')
+                self.assertEqual(board.game_over, bool(boards.game_over[i]))
+                self.assertEqual(board.score, boards.score[i])
+                rows = list(board.bitboard.rows)
+                if board.current_block is not None:
+                    for y, mask in board.current_block.row_masks.items():
+                        rows[y] &= ~mask
+                self.assertEqual(boards.rows(i), rows)
+                compared[i] += 1
+        self.assertGreater(sum(compared), 60)
+        self.assertGreater(boards.score.sum(), 0)
+
+    def test_naive_gravity(self):
+        import batch
+        for gravity, expected in (('sticky', 3), ('naive', 2)):
+            boards = batch.BatchBoards(2, gravity=gravity)
+            boards.cells[:, 0, 1:] = True
+            boards.cells[:, 3, 5] = True
+            # An I standing in column 0 fills the gap in row 0
+            boards.pieces[:] = tetrofactory.blockmap.index('I')
+            boards.place([1, 1], [-1, -1])
+            self.assertEqual(list(boards.score), [1, 1])
+            self.assertTrue(boards.cells[:, expected, 5].all())
+            self.assertEqual(boards.cells.sum(), 2 * 4)
+
+
+class TestGameClock(unittest.TestCase):
+
+    def setUp(self):
+        import gameloop
+        self.time = 0.0
+        self.board = TetrisBoard(start_block_name='T', seed=0)
+        self.actions = []
+        self.board.add_listener(self)
+        self.clock = gameloop.GameClock(self.board, clock=lambda: self.time)
+        self.clock.start()
+
+    def on_action(self, action):
+        self.actions.append(action)
+
+    def advance(self, to):
+        self.time = to
+        self.clock.advance()
+
+    def test_gravity_levels(self):
+        import gameloop
+        self.assertEqual(gameloop.gravity_interval(1), 1.0)
+        intervals = [gameloop.gravity_interval(level) for level in range(1, 16)]
+        self.assertEqual(intervals, sorted(intervals, reverse=True))
+
+        block = self.board.current_block
+        self.advance(0.99)
+        self.assertEqual(block.location, (4, 20))
+        self.advance(1.01)
+        self.assertEqual(block.location, (4, 19))
+        self.board.score = 20
+        self.assertEqual(self.clock.level, 3)
+
+    def test_das_and_arr(self):
+        block = self.board.current_block
+        self.clock.press('LEFT', at=0.0101)
+        self.advance(0.011)
+        self.assertEqual(block.location[0], 4)     # lands on the next tick
+        self.advance(0.0125)
+        self.assertEqual(block.location[0], 3)
+        # DAS runs from the tick of the press, not from the frame
+        self.advance(0.178)
+        self.assertEqual(block.location[0], 3)
+        self.advance(0.18)
+        self.assertEqual(block.location[0], 2)
+        self.advance(0.22)
+        self.assertEqual(block.location[0], 1)
+        self.clock.release('LEFT', at=0.25)
+        self.clock.press('RIGHT', at=0.25)
+        self.advance(0.3)
+        self.assertEqual(block.location[0], 2)
+
+    def test_soft_drop_and_lock_delay(self):
+        block = self.board.current_block
+        self.clock.press('DOWN', at=0.0)
+        self.advance(0.5)
+        self.assertLess(block.location[1], 12)
+        self.advance(1.3)
+        self.assertEqual(block.location[1], 0)
+        self.assertIs(self.board.current_block, block)
+        # A move while grounded restarts the lock delay
+        self.clock.press('LEFT', at=1.3)
+        self.clock.release('LEFT', at=1.31)
+        self.advance(1.5)
+        self.assertIs(self.board.current_block, block)
+        self.advance(1.9)
+        self.assertIsNot(self.board.current_block, block)
+        self.assertNotIn('DROP', self.actions)
+        self.assertIn('GRAVITY', self.actions)    # the lock
+
+    def test_recording_replays(self):
+        import replay
+        import gameloop
+        board = TetrisBoard(seed=3)
+        now = [0.0]
+        clock = gameloop.GameClock(board, clock=lambda: now[0], das=0.1, arr=0)
+        recorder = replay.Recorder(board, clock=clock.now)
+        clock.start()
+        rng = random.Random(3)
+        for i in range(300):
+            now[0] += rng.random() * 0.05
+            action = rng.choice(['LEFT', 'RIGHT', 'UP', 'DOWN', 'DROP'])
+            if rng.random() < 0.5:
+                clock.press(action)
+            else:
+                clock.release(action)
+            clock.advance()
+        replayed = replay.Replay.from_bytes(recorder.to_bytes()).run()
+        self.assertEqual(occupied(replayed), occupied(board))
+        self.assertEqual(replayed.score, board.score)
+
+
+class TestInstrumentation(unittest.TestCase):
+
+    def setUp(self):
+        import io
+        import instrumentation
+        self.time = 0.0
+        self.out = io.StringIO()
+        self.inst = instrumentation.Instrumentation(out=self.out, clock=lambda: self.time)
+
+    def test_sections_are_exclusive(self):
+        inst = self.inst
+        with inst.section('logic'):
+            self.time += 0.001
+            with inst.section('collapse'):
+                self.time += 0.004
+            with inst.section('render'):
+                self.time += 0.002
+        inst.frame_drawn()
+        frame = inst.frames[-1]
+        self.assertAlmostEqual(frame['logic'], 0.001)
+        self.assertAlmostEqual(frame['collapse'], 0.004)
+        self.assertAlmostEqual(frame['render'], 0.002)
+        self.assertAlmostEqual(inst.frame_times(worst=True)['collapse'], 0.004)
+
+    def test_key_to_frame_latency(self):
+        import json
+        inst = self.inst
+        board = TetrisBoard(start_block_name='T', seed=0)
+        inst.attach(board)
+        board.start()
+
+        inst.key_event('LEFT')
+        self.time += 0.003
+        board.apply('LEFT')
+        self.time += 0.001
+        inst.sprites_committed()
+        # Two more steps to the wall; the last three presses change nothing
+        # and are dropped, even though gravity then moves the block
+        for i in range(5):
+            inst.key_event('LEFT')
+            board.apply('LEFT')
+        board.apply('GRAVITY')
+        inst.sprites_committed()
+        self.time += 0.002
+        inst.frame_drawn()
+
+        self.assertEqual(len(inst.latencies), 3)
+        self.assertAlmostEqual(inst.latencies[0], 0.006)
+        self.assertEqual(inst._pending, [])
+        histogram = dict(inst.latency_histogram())
+        self.assertEqual((histogram[4], histogram[8]), (2, 1))
+        records = [json.loads(line) for line in self.out.getvalue().splitlines()]
+        self.assertEqual([r['type'] for r in records], ['input'] * 3 + ['frame'])
+        self.assertAlmostEqual(records[0]['latency'], 6.0)
+        self.assertLess(records[0]['key'], records[0]['applied'])
+
+    def test_unapplied_presses_expire(self):
+        inst = self.inst
+        board = TetrisBoard(start_block_name='T', seed=0)
+        inst.attach(board)
+        board.start()
+        # Keyed but never applied, eg because the game was paused
+        inst.key_event('LEFT')
+        inst.frame_drawn()
+        self.assertEqual(len(inst._pending), 1)
+        inst.frame_drawn()
+        self.assertEqual(inst._pending, [])
+
+        # so a later LEFT isn't charged with the old key time
+        self.time += 5.0
+        inst.key_event('LEFT')
+        self.time += 0.002
+        board.apply('LEFT')
+        inst.sprites_committed()
+        inst.frame_drawn()
+        self.assertEqual(len(inst.latencies), 1)
+        self.assertAlmostEqual(inst.latencies[0], 0.002)
+
+    def test_collapse_is_timed(self):
+        inst = self.inst
+        board = TetrisBoard(start_block_name='I', seed=0)
+        inst.attach(board)
+        fill(board, [(x, 0) for x in range(4, board.width)])
+        fill(board, [(9, 1)])
+        board.start()
+        for i in range(3):
+            board.apply('LEFT')
+        ticks = iter(range(1000))
+        inst.clock = lambda: next(ticks) * 0.001
+        with inst.section('logic'):
+            board.apply('DROP')
+        inst.frame_drawn()
+        self.assertEqual(board.score, 1)
+        self.assertGreater(inst.frames[-1]['collapse'], 0)
+        self.assertEqual(inst._stack, [])
+        inst.detach()
+        self.assertNotIn(inst, board.listeners)
+
+
+def crash_on_seed_2(board, placements, rng):
+    """ Policy that kills its worker process in game 2 """
+    if board.generator.seed == 2:
+        os._exit(1)
+    return placements[0]
+
+class TestTournament(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'results.jsonl')
+
+    def test_resume(self):
+        import tournament
+        stats = tournament.run_tournament(['lowest'], range(3), self.path, workers=2,
+                                          chunk_size=2, max_pieces=20)
+        self.assertEqual(stats['lowest']['games'], 3)
+        # A run cut short mid-line; the rest of the file is kept and only the
+        # new seeds are played
+        with open(self.path, 'a') as f:
+            f.write('{"policy": "lowe')
+        stats = tournament.run_tournament(['lowest'], range(5), self.path, workers=2,
+                                          chunk_size=2, max_pieces=20)
+        self.assertEqual(stats['lowest']['games'], 5)
+        results = tournament.load_results(self.path)
+        self.assertEqual(sorted(r['seed'] for r in results), list(range(5)))
+        self.assertEqual(set(results[0]), {'policy', 'seed', 'lines', 'pieces',
+                                           'game_over', 'duration'})
+        self.assertEqual(stats['lowest']['max_lines'], max(r['lines'] for r in results))
+
+    def test_survives_worker_crash(self):
+        import multiprocessing
+        if multiprocessing.get_start_method() != 'fork':
+            self.skipTest('workers only see the test policy when forked')
+        import bots
+        import tournament
+        bots.POLICIES['crash'] = crash_on_seed_2
+        self.addCleanup(bots.POLICIES.pop, 'crash')
+        stats = tournament.run_tournament(['crash'], range(6), self.path, workers=2,
+                                          chunk_size=3, max_pieces=5)
+        self.assertEqual(stats['crash']['games'], 5)
+        self.assertEqual(stats['crash']['failed'], 1)
+        results = {r['seed']: r for r in tournament.load_results(self.path)}
+        self.assertEqual(sorted(results), list(range(6)))
+        self.assertTrue(results[2]['crashed'])
+
+
+class TestVersus(unittest.TestCase):
+
+    def test_add_garbage(self):
+        board = TetrisBoard(seed=1)
+        fill(board, [(0, 0), (1, 0), (1, 1)], 'Z')
+        board.start()
+        before = sorted(sq.y for sq in board.current_block.squares)
+        result = board.add_garbage([3, 5])
+        self.assertEqual(result.rows, 2)
+        self.assertEqual(len(result.added), 2 * (board.width - 1))
+        self.assertEqual(board.row_counts[0] - board.width, -1)
+        self.assertIsNone(board.squares_matrix[5][1])
+        self.assertEqual(board.squares_matrix[1][3].block.name, 'Z')
+        self.assertEqual([board.column_height(x) for x in range(3)], [3, 4, 2])
+        # The block only moves if the stack reaches it
+        self.assertEqual(sorted(sq.y for sq in board.current_block.squares), before)
+        self.assertIsNone(board.add_garbage([0] * board.height))
+        self.assertTrue(board.game_over)
+
+    def greedy_turn(self, player, rng):
+        import bots
+        board = player.board
+        placement = bots.greedy_policy(board, board.enumerate_placements(), rng)
+        for action in placement.path + ['DROP']:
+            board.apply(action)
+        player.poll()
+
+    def test_mirrors(self):
+        import versus
+        rng = random.Random(4)
+        players = [versus.VersusPlayer(9, number) for number in (0, 1)]
+        for player in players:
+            player.board.start()
+        for turn in range(150):
+            for player, other in (players, players[::-1]):
+                self.greedy_turn(player, rng)
+                while player.outbox:
+                    other.inbox.append(versus.decode(player.outbox.popleft()))
+        for player, other in (players, players[::-1]):
+            other.poll()
+            mirror, board = other.opponent.snapshot(), player.board.snapshot()
+            self.assertEqual((mirror.rows, mirror.colours, mirror.score),
+                             (board.rows, board.colours, board.score))
+            self.assertEqual(player.sent, other.received + sum(other.pending))
+        self.assertTrue(players[0].sent and players[1].received)
+
+    def test_matches(self):
+        import asyncio
+        import versus
+
+        async def matches():
+            server = versus.VersusServer(seed=1)
+            # An in-process match and a TCP one side by side
+            tcp = await server.start()
+            port = tcp.sockets[0].getsockname()[1]
+            games = [versus.play_bot(server.connect(), 'a', max_pieces=30),
+                     versus.play_bot(server.connect(), 'a', 'lowest', seed=1),
+                     versus.play_bot(await versus.connect('127.0.0.1', port), 'b'),
+                     versus.play_bot(await versus.connect('127.0.0.1', port), 'b',
+                                     max_pieces=10)]
+            players = await asyncio.gather(*games)
+            tcp.close()
+            await tcp.wait_closed()
+            return server, players
+
+        server, players = asyncio.run(matches())
+        self.assertEqual(server.matches, 2)
+        for first, second in (players[:2], players[2:]):
+            self.assertEqual({first.player, second.player}, {0, 1})
+            self.assertEqual(first.winner, second.winner)
+        self.assertEqual(players[3].winner, players[2].player)
+
+    def test_protocol(self):
+        import versus
+        self.assertEqual(versus.garbage_for([1, 2, 4, 6]), 0 + 1 + 4 + 4)
+        message = versus.encode_event(versus.GARBAGE, 7, [0, 9, 9])
+        self.assertEqual(versus.decode(message), (versus.GARBAGE, 7, (0, 9, 9)))
+        self.assertEqual(versus.decode(versus.encode_event(versus.LOCK, 2, 'T', 3, (4, -1))),
+                         (versus.LOCK, 2, 'T', 3, (4, -1)))
+        for bad in (message[:-1], bytes([99]), b''):
+            self.assertRaises(versus.ProtocolError, versus.decode, bad)
+
+
+class TestSpectator(unittest.TestCase):
+
+    def cells(self, board):
+        return [[None if column[y] is None else column[y].block.name
+                 for column in board.squares_matrix] for y in range(board.height)]
+
+    def test_stream(self):
+        import io
+        import bots
+        import spectator
+        rng = random.Random(5)
+        board = TetrisBoard(seed=5)
+        fill(board, [(x, y) for y in range(4) for x in range(board.width)
+                     if rng.random() < 0.6], 'Z')
+        out = io.BytesIO()
+        broadcaster = spectator.Broadcaster(board, out)
+        expected = [self.cells(board)]
+        board.start()
+        broadcaster.tick()
+        expected.append(self.cells(board))
+        for i in range(80):
+            if i % 20 == 19:
+                board.add_garbage([i % board.width])
+            placement = bots.greedy_policy(board, board.enumerate_placements(), rng)
+            for action in placement.path + ['DROP']:
+                board.apply(action)
+                if broadcaster.tick():
+                    expected.append(self.cells(board))
+        self.assertFalse(board.game_over)
+        self.assertTrue(board.score)
+        # A lot less than a board dump per frame
+        self.assertLess(broadcaster.bytes_written, len(expected) * board.width * 3)
+
+        out.seek(0)
+        viewer = spectator.Viewer(out)
+        for cells in expected:
+            self.assertTrue(viewer.read_frame())
+            self.assertEqual([[viewer.cell(x, y) for x in range(board.width)]
+                              for y in range(board.height)], cells)
+        self.assertFalse(viewer.read_frame())
+        self.assertEqual((viewer.ticks, viewer.score), (broadcaster.ticks, board.score))
+        self.assertRaises(ValueError, spectator.Viewer, io.BytesIO(b'TRPL'))
+
+    def test_rejects_cells_outside_the_board(self):
+        import io
+        import spectator
+        board = TetrisBoard(seed=6)
+        fill(board, [(x, 0) for x in range(1, board.width)])
+        out = io.BytesIO()
+        broadcaster = spectator.Broadcaster(board, out)
+        board.start()
+        broadcaster.tick()
+        data = out.getvalue()
+        # The same frame read by viewers told the board is smaller than it is
+        for width, height in ((board.width, 4), (4, board.height)):
+            header = spectator._header.pack(spectator.MAGIC, spectator.VERSION, width, height)
+            viewer = spectator.Viewer(io.BytesIO(header + data[spectator._header.size:]))
+            rows = [[0] * height]
+            with self.assertRaises(ValueError):
+                while viewer.read_frame():
+                    rows.append(viewer.rows())
+            # and the bad frame left the board as the frames before made it
+            self.assertEqual(viewer.rows(), rows[-1])
+            self.assertEqual(viewer.frames, len(rows) - 1)
+
+    def test_wide_board_over_socket(self):
+        import socket
+        import threading
+        import spectator
+
+        class WideBoard(TetrisBoard):
+            width = 600
+
+        board = WideBoard(seed=1)
+        fill(board, [(x, 0) for x in range(0, 600, 3)])
+        writer, reader = socket.socketpair()
+        self.addCleanup(writer.close)
+        self.addCleanup(reader.close)
+        viewers = []
+        thread = threading.Thread(target=lambda: viewers.append(
+            spectator.Viewer(reader.makefile('rb'))) or viewers[0].run())
+        thread.start()
+        out = writer.makefile('wb')
+        broadcaster = spectator.Broadcaster(board, out)
+        board.start()
+        for action in ['LEFT', 'UP', 'RIGHT', 'DROP']:
+            board.apply(action)
+            # Runs, not a 75 byte mask per row
+            self.assertLess(broadcaster.tick(), 40)
+        out.close()
+        writer.shutdown(socket.SHUT_WR)
+        thread.join(10)
+        self.assertEqual(viewers[0].rows(), list(board._occupancy_rows()))
+        self.assertEqual(viewers[0].frames, 5)
+
+
+class TestResources(unittest.TestCase):
+
+    def setUp(self):
+        import shutil
+        import tempfile
+        import resources
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        here = os.path.dirname(os.path.abspath(__file__))
+        for name in ('tetris.xml', 'spritesheet.png'):
+            shutil.copy(os.path.join(here, name), self.directory)
+        self.xmlpath = os.path.join(self.directory, 'tetris.xml')
+        self.parsed = []
+        parse = resources.parse
+
+        def counting_parse(path):
+            self.parsed.append(path)
+            return parse(path)
+        resources.parse = counting_parse
+        self.addCleanup(setattr, resources, 'parse', parse)
+
+    def test_index(self):
+        import resources
+        index = resources.load(self.xmlpath)
+        png = os.path.join(self.directory, 'spritesheet.png')
+        self.assertEqual(index.files, [self.xmlpath, png])
+        self.assertEqual(index.piece_images()['I'], 'i-o_red')
+        self.assertEqual(index.images['i-o_red'], (png, 7, 217, 18, 18))
+        self.assertEqual(len(index.digit_images()), 10)
+        self.assertEqual(index.images[index.digit_images()[0]][3:], (9, 9))
+        self.assertEqual(index.maps['map0']['origin'], [0, 0, 0])
+        self.assertEqual(len(index.maps['map0']['columns']), TetrisBoard.width)
+
+    def test_cache(self):
+        import resources
+        first = resources.load(self.xmlpath)
+        self.assertEqual(len(self.parsed), 1)
+        cached = resources.load(self.xmlpath)
+        self.assertEqual(len(self.parsed), 1)
+        self.assertEqual(cached.to_json(), first.to_json())
+
+        # Touched but unchanged files don't invalidate it
+        for file in first.files:
+            os.utime(file, ns=(0, 0))
+        resources.load(self.xmlpath)
+        self.assertEqual(len(self.parsed), 1)
+
+        # A changed image does
+        with open(first.files[1], 'ab') as f:
+            f.write(b'\0')
+        resources.load(self.xmlpath)
+        self.assertEqual(len(self.parsed), 2)
+
+        # And so does a changed XML file
+        with open(self.xmlpath) as f:
+            xml = f.read()
+        with open(self.xmlpath, 'w') as f:
+            f.write(xml.replace('offset="7,217"', 'offset="8,217"'))
+        index = resources.load(self.xmlpath)
+        self.assertEqual(len(self.parsed), 3)
+        self.assertEqual(index.images['i-o_red'][1], 8)
+
+    def test_missing_image(self):
+        import json
+        import resources
+        png = os.path.join(self.directory, 'spritesheet.png')
+        os.rename(png, png + '.bak')
+        cache_path = resources.default_cache_path(self.xmlpath)
+        resources.load(self.xmlpath)
+        self.assertFalse(os.path.exists(cache_path))
+
+        # Nor does an old cache with null sources break loading
+        os.rename(png + '.bak', png)
+        index = resources.load(self.xmlpath)
+        with open(cache_path) as f:
+            cached = json.load(f)
+        cached['sources'] = None
+        with open(cache_path, 'w') as f:
+            json.dump(cached, f)
+        self.assertEqual(resources.load(self.xmlpath).to_json(), index.to_json())
+        self.assertEqual(len(self.parsed), 3)
+
+
+class TestBenchmarks(unittest.TestCase):
+
+    def test_synthetic_boards(self):
+        import benchmarks
+        for kind in benchmarks.BOARD_KINDS:
+            board = benchmarks.make_board(kind, seed=3)
+            self.assertEqual(board.row_counts[:2], [board.width] * 2)
+            self.assertFalse(board.game_over)
+
+    def test_run_and_compare(self):
+        import benchmarks
+        results = benchmarks.run(repeat=3, pieces=50)
+        self.assertIn('collapse.many_clumps', results)
+        self.assertIn('pieces_per_second', results)
+        self.assertIn('startup.cached', results)
+        self.assertEqual(benchmarks.compare(results, results, 0.1), [])
+        slower = dict(results, **{'block.move': results['block.move'] / 2,
+                                  'pieces_per_second': results['pieces_per_second'] * 2})
+        self.assertEqual(sorted(benchmarks.compare(results, slower, 0.1)),
+                         ['block.move', 'pieces_per_second'])
 
 
 if __name__ == '__main__':
@@ -0,0 +1,907 @@
+""" Headless tetris engine. Holds the board model, the pieces and all of the
+game rules (moving, rotating, dropping, clearing lines, sticky collapse and
+scoring). Nothing in here imports cocos or pyglet, so games can be simulated
+without a window, a director or a texture atlas. Renderers observe a board by
+registering a listener with TetrisBoard.add_listener().
+
+Board dumps go to the 'tetris' logger at DEBUG level and are only formatted
+when that level is enabled.
+"""
+
+import logging
+import sys
+from collections import deque
+
+import collapse
+import placements
+import snapshot
+import tetrofactory
+from bitboard import BitBoard, piece_masks
+
+log = logging.getLogger('tetris')
+
+class Square:
+    """
+    The bounding_coord represents its location in an abstract bounding square
+    centered on the origin 0,0. It is for the purposes of rotation
+    """
+
+    # Debug purposes: set to True to have every new square record each x and y
+    # it is given in x_history and y_history. Off by default since the lists
+    # grow with every move.
+    track_history = False
+
+    __slots__ = (
+        '_block',
+        '_sprite',   # set by whichever renderer is observing the board
+        '_x',    # coordinates on the tetris grid
+        '_y',
+        'x_history',
+        'y_history',
+    )
+
+    def __init__(self, block, loc):
+        self._block = block
+        self._sprite = None
+        if self.track_history:
+            self.x_history = list()
+            self.y_history = list()
+        else:
+            self.x_history = None
+            self.y_history = None
+        self.x = loc[0]
+        self.y = loc[1]
+
+    @property
+    def x(self):
+        return self._x
+    @x.setter
+    def x(self, value):
+        self._x = value
+        if self.x_history is not None:
+            self.x_history.append(value)
+
+    @property
+    def y(self):
+        return self._y
+    @y.setter
+    def y(self, value):
+        self._y = value
+        if self.y_history is not None:
+            self.y_history.append(value)
+        if value < 0:
+            raise ShouldntHappenError("y assigned value < 0")
+            sys.exit()
+
+    @property
+    def sprite(self):
+        return self._sprite
+    @sprite.setter
+    def sprite(self, value):
+        self._sprite = value
+
+    @property
+    def block(self):
+        return self._block
+
+
+class Block:
+    """
+    The abstract bounding square is used to manipulate how a specific block
+    should rotate. Apparently, there ARE standards on how each rotates, which
+    can be found in the tetris wikia. I'm using the most common one, which is
+    what originally defined this abstract bounding square. The bounding
+    locations of all four orientations are looked up in tetrofactory.
+    """
+
+    __slots__ = (
+        'name',
+        'board',     # TetrisBoard model the block lives on
+        'squares_matrix',     # references the board's grid (model)
+        'squares',  # list of all squares for the block
+        # below fields are set by factory
+        '_location',
+        '_bounding_locations_map',  # maps square -> bounding location
+        'orientation',     # index into tetrofactory.rotation_table[name]
+        '_row_masks',   # cached row -> mask of the squares, for the bitboard
+    )
+
+    def __init__(self, block_name, board):
+        self.name = block_name
+        self.board = board
+        self.squares_matrix = board.squares_matrix
+        self.squares = []
+        self._location = None
+        self._bounding_locations_map = dict()
+        self.orientation = 0
+        self._row_masks = None
+
+    #---------------------------------------------------------------------------
+    #       Properties
+    #---------------------------------------------------------------------------
+
+    @property
+    def location(self):
+        return self._location
+    @location.setter
+    def location(self, value):
+        self._location = value
+
+    @property
+    def bounding_locations_map(self):
+        return self._bounding_locations_map
+    @bounding_locations_map.setter
+    def bounding_locations_map(self, value):
+        self._bounding_locations_map = value
+
+    @property
+    def row_masks(self):
+        if self._row_masks is None:
+            self._row_masks = piece_masks((sq.x, sq.y) for sq in self.squares)
+        return self._row_masks
+
+    #---------------------------------------------------------------------------
+    #       Public
+    #---------------------------------------------------------------------------
+
+    def can_move(self, direction, below=0):
+        """ below shifts the test down that many rows, ie can_move('DOWN', 3)
+        asks whether the block could fall a fourth row after falling three.
+        """
+        if below:
+            cells = [(sq.x, sq.y - below - 1) for sq in self.squares]
+            return self._fits(cells)
+
+        bitboard = self.board.bitboard
+        if bitboard is not None:
+            return self._can_move_bitboard(direction, bitboard)
+
+        # TODO refactor lines around for terseness
+        for square in self.squares:
+            if direction == 'LEFT':
+                if square.x <= 0:
+                    return False
+                if (not self._has_square_in_location((square.x - 1, square.y)) and
+                        self.squares_matrix[square.x - 1][square.y] is not None):
+                    # if shifted position of square is not in block and there's
+                    # something in that shifted coordinate, can't move block
+                    return False
+            elif direction == 'RIGHT':
+                if square.x >= self.board.width - 1:
+                    return False
+                if (not self._has_square_in_location((square.x + 1, square.y)) and
+                        self.squares_matrix[square.x + 1][square.y] is not None):
+                    return False
+            elif direction == 'DOWN':
+                if square.y <= 0:
+                    return False
+                if (not self._has_square_in_location((square.x, square.y - 1)) and
+                        self.squares_matrix[square.x][square.y - 1] is not None):
+                    return False
+        return True
+
+    def move(self, direction):
+        if not self.can_move(direction):
+            return False
+
+        # Erase from matrix first
+        for square in self.squares:
+            self.board.erase_square(square)
+
+        # Calculate new location for block
+        prev_x, prev_y = self.location
+        if direction == 'LEFT':
+            self.location = (prev_x - 1, prev_y)
+        elif direction == 'RIGHT':
+            self.location = (prev_x + 1, prev_y)
+        elif direction == 'DOWN':
+            self.location = (prev_x, prev_y - 1)
+
+        # For all of block's squares, update their mappings, fields, and put them
+        # back into the matrix in their new location
+        for square in self.squares:
+            square_bounding_x, square_bounding_y = self.bounding_locations_map[square]
+            square.x = square_bounding_x + self.location[0]
+            square.y = square_bounding_y + self.location[1]
+            self.board.place_square(square)
+        self._row_masks = None
+
+        return True
+
+    def drop(self, rows):
+        """ Move the block straight down rows rows in one step. The caller is
+        responsible for checking that it fits (see TetrisBoard.landing_distance)
+        """
+        for square in self.squares:
+            self.board.erase_square(square)
+        self.location = (self.location[0], self.location[1] - rows)
+        for square in self.squares:
+            square.y = square.y - rows
+            self.board.place_square(square)
+        self._row_masks = None
+
+    def rotate(self, direction):
+        """ Rotate 'CLOCKWISE' or 'COUNTERCLOCKWISE' using the precomputed
+        tetrofactory.rotation_table. If the rotated block doesn't fit where it
+        is, each wall kick offset in tetrofactory.kick_table is tried in order
+        and the first one that fits is used.
+        """
+
+        if direction == 'CLOCKWISE':
+            to_orientation = (self.orientation + 1) % 4
+        elif direction == 'COUNTERCLOCKWISE':
+            to_orientation = (self.orientation - 1) % 4
+        else:
+            return False
+
+        bounding_locations = tetrofactory.rotation_table[self.name][to_orientation]
+        kicks = tetrofactory.kick_table[self.name][(self.orientation, to_orientation)]
+        for kick_x, kick_y in kicks:
+            location = (self.location[0] + kick_x, self.location[1] + kick_y)
+            cells = [(bound_x + location[0], bound_y + location[1])
+                     for bound_x, bound_y in bounding_locations]
+            if self._fits(cells):
+                break
+        else:
+            return False
+
+        # Erase
+        for square in self.squares:
+            self.board.erase_square(square)
+
+        # Update bounding locations in the block's dictionary and square's
+        # location coordinates on the square matrix
+        self.location = location
+        self.orientation = to_orientation
+        for square, bounding_loc, cell in zip(self.squares, bounding_locations, cells):
+            self.bounding_locations_map[square] = bounding_loc
+            square.x, square.y = cell
+            self.board.place_square(square)
+        self._row_masks = None
+
+        return True
+
+    def _fits(self, cells):
+        """ True if the block could occupy cells, treating its own squares as
+        empty space
+        """
+        for x, y in cells:
+            if x < 0 or x >= self.board.width or y < 0 or y >= self.board.height:
+                return False
+
+        bitboard = self.board.bitboard
+        if bitboard is not None:
+            return bitboard.fits(piece_masks(cells), self.row_masks)
+
+        for x, y in cells:
+            square = self.squares_matrix[x][y]
+            if square is not None and square.block is not self:
+                return False
+        return True
+
+    def _can_move_bitboard(self, direction, bitboard):
+        """ can_move() as a few bitwise ops on the board's rows """
+        masks = self.row_masks
+        if direction == 'LEFT':
+            for mask in masks.values():
+                if mask & bitboard.left_wall:
+                    return False
+            shifted = {y: mask >> 1 for y, mask in masks.items()}
+        elif direction == 'RIGHT':
+            for mask in masks.values():
+                if mask & bitboard.right_wall:
+                    return False
+            shifted = {y: mask << 1 for y, mask in masks.items()}
+        elif direction == 'DOWN':
+            if 0 in masks:
+                return False
+            shifted = {y - 1: mask for y, mask in masks.items()}
+        else:
+            return True
+        return bitboard.fits(shifted, masks)
+
+    def _has_square_in_location(self, location):
+        for square in self.squares:
+            if square.x == location[0] and square.y == location[1]:
+                return True
+        return False
+
+
+class TetrisBoard:
+    """ The model. Keeps the squares_matrix, the current block and the score,
+    and applies every game rule to them. Anything that wants to draw the game
+    registers a listener object; the board calls whichever of these methods the
+    listener defines:
+
+      on_action(action)           apply() is about to apply action
+      on_block_spawned(block)     a new current block was placed on the board
+      on_block_moved(block)       the current block moved, rotated or dropped
+      on_collapse_started(rows)   the cleared rows are about to collapse
+      on_collapse_finished(moved) the collapse moved moved, [(square, distance)]
+      on_lock_resolved(result)    a locked block cleared lines; result is a
+                                  LockResult for the whole cascade
+      on_garbage_added(result)    add_garbage() pushed the stack up; result is
+                                  a GarbageResult
+      on_score_changed(score)
+      on_game_over()
+
+    With use_bitboard the board also mirrors the squares_matrix into a
+    bitboard.BitBoard, which then answers every collision and full row query.
+    The squares_matrix is still kept up to date for the renderers. Everything
+    that writes to the squares_matrix must go through place_square() and
+    erase_square() so the two stay in sync.
+    """
+
+    width = 10
+    height = 22
+    actions = ('LEFT', 'RIGHT', 'DOWN', 'UP', 'DROP', 'GRAVITY')
+    start_block_name = None     # first block, instead of the generator's
+    generator = None    # tetrofactory.PieceGenerator dealing the blocks
+    # Logic stuff
+    squares_matrix = None     # MODEL
+    bitboard = None     # optional fast occupancy mirror of squares_matrix
+    _rows = None        # one int per row, kept in place of it without one
+    column_heights = None   # skyline of the locked squares, see column_height()
+    _stale_columns = None
+    row_counts = None   # number of squares in each row
+    _dirty_rows = None  # rows that gained a square since the last line check
+    current_block = None
+    existing_blocks = None  # may briefly hold blocks a clear emptied, see _clear_lines()
+    _emptied_blocks = 0     # how many
+    score = None
+    game_over = False
+    listeners = None
+    recent_boards_size = 32
+    recent_boards = None    # ring buffer of (label, rows), see dump_recent_boards()
+
+    min_size = 4    # smallest width and height every block can spawn in
+
+    def __init__(self, start_block_name=None, use_bitboard=True, seed=None,
+                 generator=None, width=None, height=None):
+        """ Blocks come from generator, or from a 7-bag PieceGenerator seeded
+        with seed if none is given. width and height default to the class's.
+        """
+        # width | [length -------> ]
+        #       | [                ]
+        #       v [                ]
+
+        if width is not None:
+            self.width = width
+        if height is not None:
+            self.height = height
+        if self.width < self.min_size or self.height < self.min_size:
+            raise ValueError('board must be at least %dx%d, not %dx%d' % (
+                self.min_size, self.min_size, self.width, self.height))
+        self.squares_matrix = [[None for y in range(self.height)] for x in range(self.width)]
+        if use_bitboard:
+            self.bitboard = BitBoard(self.width, self.height)
+        else:
+            self._rows = [0] * self.height
+        self.column_heights = [0] * self.width
+        self._stale_columns = set()
+        self.row_counts = [0] * self.height
+        self._dirty_rows = set()
+        self.score = 0
+        self.listeners = []
+        self.recent_boards = deque(maxlen=self.recent_boards_size)
+        self.existing_blocks = []
+        if generator is None:
+            generator = tetrofactory.PieceGenerator(seed)
+        self.generator = generator
+        if start_block_name is not None:
+            self.start_block_name = start_block_name
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    def remove_listener(self, listener):
+        self.listeners.remove(listener)
+
+    def start(self):
+        """ Spawn the first block. Listeners should be added before this """
+        try:
+            self.new_block(self.start_block_name)
+        except ShouldntHappenError:
+            self.dump_recent_boards()
+            raise
+
+    #---------------------------------------------------------------------------
+    #       Public
+    #---------------------------------------------------------------------------
+
+    def move_block(self, direction):
+        """ Apply one input to the current block. direction is one of 'LEFT',
+        'RIGHT', 'DOWN', 'UP' (rotate clockwise) or 'DROP'. Returns True if the
+        board changed. If a ShouldntHappenError comes out of the rules, the
+        recent board snapshots are logged before it is re-raised.
+        """
+        try:
+            return self._move_block(direction)
+        except ShouldntHappenError:
+            self.dump_recent_boards()
+            raise
+
+    def _move_block(self, direction):
+        if self.game_over or self.current_block is None:
+            return False
+
+        if direction in ('LEFT', 'RIGHT', 'DOWN'):
+            # Does the movement in conditionals
+            if self.current_block.move(direction):
+                self._notify('on_block_moved', self.current_block)
+                return True
+            return False
+        elif direction == 'UP':
+            # rotate clockwise only
+            if self.current_block.rotate('CLOCKWISE'):
+                self._notify('on_block_moved', self.current_block)
+                return True
+            return False
+        elif direction == 'DROP':
+            # Land the block in one step and render only its final position
+            block = self.current_block
+            distance = self.landing_distance(block)
+            if distance:
+                block.drop(distance)
+                self._notify('on_block_moved', block)
+
+            # The block is now part of the stack
+            self.current_block = None
+            for square in block.squares:
+                if square.y + 1 > self.column_heights[square.x]:
+                    self.column_heights[square.x] = square.y + 1
+
+            # Clear lines and run every cascade, then report it all at once
+            result = self.resolve_lock()
+            if result.lines:
+                self.score += result.total_lines
+                self._notify('on_lock_resolved', result)
+                self._notify('on_score_changed', self.score)
+
+            self.new_block()
+            return True
+        return False
+
+    def preview(self, count):
+        """ Names of the next count blocks, without dealing them """
+        return self.generator.preview(count)
+
+    def apply(self, action):
+        """ Single entry point for everything that drives a game: the player
+        inputs move_block() takes, and 'GRAVITY' for a timed drop. Listeners
+        get on_action(action) before it is applied, so a recorder sees every
+        action in order. Unknown actions are ignored.
+        """
+        if action not in self.actions or self.game_over:
+            return False
+        self._notify('on_action', action)
+        if action == 'GRAVITY':
+            return self.timed_drop()
+        return self.move_block(action)
+
+    def timed_drop(self):
+        """ One step of gravity """
+        if self.current_block is None:
+            return False
+        if self.current_block.can_move('DOWN'):
+            return self.move_block('DOWN')
+        else:
+            return self.move_block('DROP')
+
+    def new_block(self, blockname=None):
+        """ Note: This should be called when self.current_block == None
+        All conditions:
+          name=None, current exists => nothing happens
+          name=None, no current => next from the generator
+          name=<name>, current exists => nothing happens
+          name=<name>, no current => use supplied
+          tisz
+        If the spawn location is already taken the game is over.
+        """
+
+        if self.current_block:
+            raise ShouldntHappenError("Getting a new block without removing current")
+        block = tetrofactory.make_tetris_block(self, name=blockname)
+
+        # Lose condition: something is already sitting where the block spawns
+        for square in block.squares:
+            if self.squares_matrix[square.x][square.y] is not None:
+                self.game_over = True
+                self._notify('on_game_over')
+                return None
+
+        self.current_block = block
+        for square in block.squares:
+            self.place_square(square)
+        self.existing_blocks.append(self.current_block)
+        self._notify('on_block_spawned', self.current_block)
+
+        self._remember('New block: %s' % block.name)
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug(self.board_to_string('New block: %s' % block.name))
+        return block
+
+    def resolve_lock(self):
+        """ Clear full lines after a block locks. Each collapse can produce new
+        full lines, so this repeats until the board is stable and returns a
+        LockResult covering the whole chain.
+        """
+        result = LockResult()
+        while self._clear_lines(result):
+            pass
+        result.rows = list(self._occupancy_rows())
+        return result
+
+    def landing_distance(self, block):
+        """ How many rows block can fall before it lands. Uses the skyline in
+        column_heights, so it costs one pass over the block's squares. Only if
+        the block has slid under an overhang does it fall back to stepping down
+        one row at a time.
+        """
+        bottoms = {}    # column -> lowest y of the block in that column
+        for square in block.squares:
+            if square.y < bottoms.get(square.x, self.height):
+                bottoms[square.x] = square.y
+
+        distance = self.height
+        for x, bottom in bottoms.items():
+            gap = bottom - self.column_height(x)
+            if gap < 0:
+                break
+            if gap < distance:
+                distance = gap
+        else:
+            return distance
+
+        # Under an overhang, so the skyline doesn't apply
+        distance = 0
+        while block.can_move('DOWN', distance):
+            distance += 1
+        return distance
+
+    def column_height(self, x):
+        """ 1 + the y of the topmost locked square in column x, 0 if empty """
+        if x in self._stale_columns:
+            self._stale_columns.discard(x)
+            height = self.column_heights[x]
+            column = self.squares_matrix[x]
+            # The current block isn't part of the skyline
+            while height > 0 and (column[height - 1] is None or
+                                  column[height - 1].block is self.current_block):
+                height -= 1
+            self.column_heights[x] = height
+        return self.column_heights[x]
+
+    def enumerate_placements(self):
+        """ Every final placement the current block can reach, as a list of
+        placements.Placement, each with the actions that get there and the
+        board it leaves once its lines are resolved. The board itself is not
+        touched. Empty if there is no current block.
+        """
+        block = self.current_block
+        if block is None:
+            return []
+        rows = list(self._occupancy_rows())
+        for y, mask in block.row_masks.items():
+            rows[y] &= ~mask
+        return placements.enumerate_placements(rows, self.width, block.name,
+                                               block.orientation, block.location)
+
+    def add_garbage(self, holes, name=None):
+        """ Push the locked squares up len(holes) rows and fill the rows
+        opened at the bottom with garbage, each full but for one hole at
+        column holes[i], bottom row first. The current block is only moved up
+        as far as it must to stay clear of the stack, and the game is over if
+        it can't be. If the stack would be pushed through the top the game is
+        over and nothing is added. The garbage block is named name, by default
+        tetrofactory.GARBAGE. Returns a GarbageResult, or None if nothing was
+        added.
+        """
+        if name is None:
+            name = tetrofactory.GARBAGE
+        count = len(holes)
+        if not count or self.game_over:
+            return None
+        block = self.current_block
+        top = max(self.column_height(x) for x in range(self.width))
+        if top + count > self.height:
+            self._top_out()
+            return None
+
+        if block is not None:
+            for square in block.squares:
+                self.erase_square(square)
+        result = GarbageResult(holes)
+        matrix = self.squares_matrix
+        locked = [square for column in matrix for square in column[:top]
+                  if square is not None and square.block is not block]
+        for square in locked:
+            self.erase_square(square)
+        for square in locked:
+            from_cell = (square.x, square.y)
+            square.y = square.y + count
+            self.place_square(square)
+            result.moves[square] = (from_cell, (square.x, square.y))
+
+        for y, hole in enumerate(holes):
+            # A block per row, like the rows a clear removes
+            garbage = Block(name, self)
+            for x in range(self.width):
+                if x != hole:
+                    square = Square(garbage, (x, y))
+                    garbage.squares.append(square)
+                    self.place_square(square)
+            self.existing_blocks.append(garbage)
+            result.added.extend(garbage.squares)
+
+        lost = False
+        if block is not None:
+            lift = 0
+            while not all(square.y + lift < self.height and
+                          matrix[square.x][square.y + lift] is None
+                          for square in block.squares):
+                lift += 1
+                if lift >= self.height:
+                    break
+            if lift >= self.height:
+                # Nowhere left to put the block
+                self.current_block = None
+                self.existing_blocks.remove(block)
+                lost = True
+            else:
+                for square in block.squares:
+                    from_cell = (square.x, square.y)
+                    square.y = square.y + lift
+                    self.place_square(square)
+                    if lift:
+                        result.moves[square] = (from_cell, (square.x, square.y))
+                block.location = (block.location[0], block.location[1] + lift)
+                block._row_masks = None
+
+        self._remember('Garbage')
+        self._notify('on_garbage_added', result)
+        if lost:
+            self._top_out()
+        return result
+
+    def snapshot(self):
+        """ The whole game state as an immutable snapshot.Snapshot, to
+        restore() this or another board of the same size to later, or to save
+        with its to_bytes()
+        """
+        return snapshot.take(self)
+
+    def restore(self, state):
+        """ Put the board back in the state of a snapshot.Snapshot. New
+        squares and blocks are made for it, and listeners are not told, so
+        restore before a renderer starts observing the board.
+        """
+        snapshot.restore(self, state)
+
+    def place_locked(self, cells, name='O'):
+        """ Put already locked squares on the board at the given (x, y) cells,
+        eg to set up a position. They share one block named name (which picks
+        their colour). Returns the block. A clear edits every block it takes
+        squares from, so set up a big stack a row or so at a time.
+        """
+        block = Block(name, self)
+        for x, y in cells:
+            square = Square(block, (x, y))
+            block.squares.append(square)
+            self.place_square(square)
+        self.existing_blocks.append(block)
+        return block
+
+    def place_square(self, square):
+        """ Put square into the model at its own x, y """
+        self.squares_matrix[square.x][square.y] = square
+        if self.bitboard is not None:
+            self.bitboard.set(square.x, square.y)
+        else:
+            self._rows[square.y] |= 1 << square.x
+        self.row_counts[square.y] += 1
+        self._dirty_rows.add(square.y)
+        if (square.block is not self.current_block and
+                square.y + 1 > self.column_heights[square.x]):
+            self.column_heights[square.x] = square.y + 1
+
+    def erase_square(self, square):
+        """ Remove square from the model at its own x, y """
+        self.squares_matrix[square.x][square.y] = None
+        if self.bitboard is not None:
+            self.bitboard.unset(square.x, square.y)
+        else:
+            self._rows[square.y] &= ~(1 << square.x)
+        self.row_counts[square.y] -= 1
+        if (square.block is not self.current_block and
+                square.y + 1 == self.column_heights[square.x]):
+            # Recomputed lazily, since a clear erases whole rows at a time
+            self._stale_columns.add(square.x)
+
+    def board_to_string(self, label=None):
+        return rows_to_string(self._occupancy_rows(), self.width, label)
+
+    def dump_recent_boards(self):
+        """ Log the ring buffer of recent board snapshots, oldest first """
+        lines = ['Last %d boards:' % len(self.recent_boards)]
+        for label, rows in self.recent_boards:
+            lines.append(rows_to_string(rows, self.width, label))
+        log.error('\n'.join(lines))
+
+    #---------------------------------------------------------------------------
+    #       Private
+    #---------------------------------------------------------------------------
+
+    def _remember(self, label):
+        """ Keep a compact snapshot (one int per row) in the ring buffer """
+        self.recent_boards.append((label, tuple(self._occupancy_rows())))
+
+    def _top_out(self):
+        self.game_over = True
+        self._notify('on_game_over')
+
+    def _notify(self, event, *args):
+        for listener in self.listeners:
+            handler = getattr(listener, event, None)
+            if handler is not None:
+                handler(*args)
+
+    def _prune_blocks(self):
+        """ Emptied blocks are dropped in one pass once they are half the list,
+        rather than a pass per clear. Whatever empties blocks counts them in
+        _emptied_blocks and calls this.
+        """
+        if self._emptied_blocks * 2 > len(self.existing_blocks):
+            self.existing_blocks = [block for block in self.existing_blocks
+                                    if block.squares]
+            self._emptied_blocks = 0
+
+    def _clear_lines(self, result=None):
+        """ Clear any complete lines and collapse the squares as a result. This
+        is one step of a chain; what happened is added to result if given.
+        """
+
+        # Get list of y coordinates to clear. If there are any holes in a line,
+        # move one.
+        # Only rows that gained a square since the last check can be full
+        rows_to_clear = sorted(y for y in self._dirty_rows
+                               if self.row_counts[y] == self.width)
+        self._dirty_rows = set()
+
+        if not rows_to_clear:
+            return 0
+
+        # Clear lines
+        cleared_squares = []
+        for y in rows_to_clear:
+            for x in range(len(self.squares_matrix)):
+                square = self.squares_matrix[x][y]
+                if square is None:
+                    raise ShouldntHappenError("Square to be cleared is None")
+                cleared_squares.append(square)
+                self.erase_square(square)
+
+        self._remember('clear lines')
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug(self.board_to_string('clear lines'))
+
+        # Clear out "dead" squares from the blocks that held them. Only the
+        # blocks in the cleared rows are visited, so this costs as much as the
+        # clear, however many blocks the board holds.
+        cleared_by_block = {}
+        for square in cleared_squares:
+            cleared_by_block.setdefault(square.block, set()).add(square)
+        for block, squares in cleared_by_block.items():
+            block.squares = [sq for sq in block.squares if sq not in squares]
+            for square in squares:
+                block.bounding_locations_map.pop(square, None)
+            if not block.squares:
+                self._emptied_blocks += 1
+        self._prune_blocks()
+
+        self._notify('on_collapse_started', rows_to_clear)
+        moved = self._collapse(rows_to_clear)
+        self._notify('on_collapse_finished', moved)
+
+        self._remember('After collapse')
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug(self.board_to_string('After collapse'))
+
+        if result is not None:
+            result.add_step(len(rows_to_clear), cleared_squares, moved)
+
+        return len(rows_to_clear)  # numlines
+
+    def _collapse(self, rows_to_clear):
+        """ Sticky method: identify all clumps above each cleared row and drop
+        them independently, each until it rests on something that isn't
+        falling. See collapse.py; the clumps' squares are written back into
+        the matrix once, at their final rows.
+        """
+        falls = collapse.sticky_collapse(self._occupancy_rows(), self.width, rows_to_clear)
+
+        moved = []
+        for cells, distance in falls:
+            for x, y in cells:
+                square = self.squares_matrix[x][y]
+                if square is None:
+                    raise ShouldntHappenError('clump cell has no square')
+                moved.append((square, distance))
+
+        # Erase everything first so clumps can fall into each other's old cells
+        for square, distance in moved:
+            self.erase_square(square)
+        for square, distance in moved:
+            square.y = square.y - distance
+            self.place_square(square)
+
+        return moved
+
+    def _occupancy_rows(self):
+        """ The board as one int per row, bit x set if column x is taken """
+        if self.bitboard is not None:
+            return self.bitboard.rows
+        return self._rows
+
+
+class LockResult:
+    """ Everything a lock did to the board, over every step of the clear and
+    collapse chain. Renderers and scorers apply it once per lock.
+    """
+
+    lines = None    # lines cleared by each step of the chain
+    cleared = None  # squares removed from the board
+    moves = None    # square -> ((x, y) before the lock, (x, y) after)
+    rows = None     # final board, one int per row
+
+    def __init__(self):
+        self.lines = []
+        self.cleared = []
+        self.moves = dict()
+
+    @property
+    def total_lines(self):
+        return sum(self.lines)
+
+    def add_step(self, numlines, cleared_squares, moved):
+        """ Fold one clear + collapse step into the result. moved is a list of
+        (square, rows fallen) with the squares already at their new y.
+        """
+        self.lines.append(numlines)
+        self.cleared.extend(cleared_squares)
+        for square in cleared_squares:
+            self.moves.pop(square, None)
+        for square, distance in moved:
+            to_cell = (square.x, square.y)
+            from_cell = self.moves.get(square, ((square.x, square.y + distance),))[0]
+            self.moves[square] = (from_cell, to_cell)
+
+
+class GarbageResult:
+    """ What add_garbage() did to the board """
+
+    rows = None     # garbage rows added at the bottom
+    holes = None    # hole column of each of them, bottom row first
+    added = None    # the garbage squares
+    moves = None    # square -> ((x, y) before, (x, y) after), for every square pushed up
+
+    def __init__(self, holes):
+        self.rows = len(holes)
+        self.holes = tuple(holes)
+        self.added = []
+        self.moves = dict()
+
+
+def rows_to_string(rows, width, label=None):
+    """ ASCII picture of a board given as one int per row, top row first """
+    lines = []
+    if label is not None:
+        lines.append(label)
+    for row in reversed(rows):
+        lines.append('|' + ''.join('*|' if (row >> x) & 1 else ' |'
+                                   for x in range(width)))
+    return '\n'.join(lines) + '\n'
+
+
+class ShouldntHappenError(UserWarning):
+    pass
@@ -1,61 +1,224 @@
-from random import randrange
+import random
+from collections import deque
+from itertools import islice
 
-import tetris_game
+import tetris_engine
 
 blockmap = ['L', 'J', 'I', 'O', 'S', 'Z', 'T']
 
-def make_tetris_block(board_layer, name=None):
+# Name of the block garbage rows (see TetrisBoard.add_garbage) belong to, and
+# every name a locked square can have
+GARBAGE = 'G'
+colour_names = blockmap + [GARBAGE]
+
+# Index of each block's graphic in the 'sandbox' palette of tetris.xml. Only
+# renderers need this; the engine never touches images.
+image_index = {'I': 0, 'J': 1, 'L': 2, 'O': 3, 'S': 4, 'Z': 5, 'T': 6, GARBAGE: 8}
+
+# Spawn orientation of every block, in bounding square coordinates
+spawn_locations = {
+    'I': [(-1, 1), (0, 1), (1, 1), (2, 1)],
+    'J': [(-1, 1), (-1, 0), (0, 0), (1, 0)],
+    'L': [(-1, 0), (0, 0), (1, 0), (1, 1)],
+    'O': [(0, 1), (0, 0), (1, 1), (1, 0)],
+    'S': [(-1, 0), (0, 0), (0, 1), (1, 1)],
+    'T': [(-1, 0), (0, 1), (0, 0), (1, 0)],
+    'Z': [(-1, 1), (0, 1), (0, 0), (1, 0)],
+}
+
+# Wall kick offsets (SRS) to try, in order, for each (from, to) orientation.
+# Orientations are 0 = spawn, 1 = clockwise, 2 = upside down, 3 = counter
+# clockwise. The first offset is always (0, 0), ie a plain rotation.
+_jlstz_kicks = {
+    (0, 1): [(0, 0), (-1, 0), (-1, 1), (0, -2), (-1, -2)],
+    (1, 0): [(0, 0), (1, 0), (1, -1), (0, 2), (1, 2)],
+    (1, 2): [(0, 0), (1, 0), (1, -1), (0, 2), (1, 2)],
+    (2, 1): [(0, 0), (-1, 0), (-1, 1), (0, -2), (-1, -2)],
+    (2, 3): [(0, 0), (1, 0), (1, 1), (0, -2), (1, -2)],
+    (3, 2): [(0, 0), (-1, 0), (-1, -1), (0, 2), (-1, 2)],
+    (3, 0): [(0, 0), (-1, 0), (-1, -1), (0, 2), (-1, 2)],
+    (0, 3): [(0, 0), (1, 0), (1, 1), (0, -2), (1, -2)],
+}
+_i_kicks = {
+    (0, 1): [(0, 0), (-2, 0), (1, 0), (-2, -1), (1, 2)],
+    (1, 0): [(0, 0), (2, 0), (-1, 0), (2, 1), (-1, -2)],
+    (1, 2): [(0, 0), (-1, 0), (2, 0), (-1, 2), (2, -1)],
+    (2, 1): [(0, 0), (1, 0), (-2, 0), (1, -2), (-2, 1)],
+    (2, 3): [(0, 0), (2, 0), (-1, 0), (2, 1), (-1, -2)],
+    (3, 2): [(0, 0), (-2, 0), (1, 0), (-2, -1), (1, 2)],
+    (3, 0): [(0, 0), (1, 0), (-2, 0), (1, -2), (-2, 1)],
+    (0, 3): [(0, 0), (-1, 0), (2, 0), (-1, 2), (2, -1)],
+}
+_o_kicks = {key: [(0, 0)] for key in _i_kicks}
+
+def _rotate_clockwise(name, bounding_loc):
+    """
+    Formula for I and O blocks (centerX and centerY = 0.5)
+    newXcw  = centerX - centerY + y = y
+    newYcw  = centerX + centerY - x = 1 - x
+    Formula for rest
+    cw  =>   x,y =>  y,-x
+    """
+    bound_x, bound_y = bounding_loc
+    if name == 'I' or name == 'O':
+        return (bound_y, 1 - bound_x)
+    return (bound_y, -bound_x)
+
+def _build_rotation_table():
+    """ name -> list of the four orientations. Each orientation lists the
+    bounding locations in the same order as spawn_locations, so the n-th square
+    of a block always uses the n-th entry.
+    """
+    table = {}
+    for name, bounding_locations in spawn_locations.items():
+        orientations = [list(bounding_locations)]
+        for i in range(3):
+            orientations.append([_rotate_clockwise(name, loc) for loc in orientations[-1]])
+        table[name] = orientations
+    return table
+
+rotation_table = _build_rotation_table()
+kick_table = {name: (_i_kicks if name == 'I' else _o_kicks if name == 'O' else _jlstz_kicks)
+              for name in spawn_locations}
+
+class PieceGenerator:
+    """ Deterministic source of block names. Given the same seed and policy it
+    always deals the same sequence.
+
+    policy 'bag' deals every block once, in a shuffled order, before dealing
+    any again (the 7-bag). 'random' picks each block uniformly.
+
+    Names are made in bulk and queued, so next() is a deque pop and a
+    simulator can pull a long sequence with take() or peek at an N-piece
+    preview with preview() without a call into the RNG per piece.
+    """
+
+    policies = ('bag', 'random')
+    refill_size = 70    # names made per refill (ten bags)
+
+    seed = None
+    policy = None
+    dealt = 0   # names handed out by next() and take() so far
+    last = None     # the name handed out last
+    _rng = None
+    _queue = None
+
+    def __init__(self, seed=None, policy='bag'):
+        """ Without a seed one is picked at random, and kept in self.seed so
+        the game can still be replayed.
+        """
+        if policy not in self.policies:
+            raise ValueError('unknown piece policy %r' % policy)
+        if seed is None:
+            seed = random.randrange(1 << 63)
+        self.seed = seed
+        self.policy = policy
+        self._rng = random.Random(seed)
+        self._queue = deque()
+
+    def next(self):
+        if not self._queue:
+            self._refill(self.refill_size)
+        self.dealt += 1
+        self.last = self._queue.popleft()
+        return self.last
+
+    def take(self, count):
+        """ The next count names, as a list """
+        self._fill_to(count)
+        self.dealt += count
+        queue = self._queue
+        names = [queue.popleft() for i in range(count)]
+        if names:
+            self.last = names[-1]
+        return names
+
+    def put_back(self, name):
+        """ Undo dealing name, the latest name handed out: it is dealt again
+        next
+        """
+        self._queue.appendleft(name)
+        self.dealt -= 1
+        self.last = None
+
+    def preview(self, count):
+        """ The next count names without dealing them """
+        self._fill_to(count)
+        return list(islice(self._queue, count))
+
+    def getstate(self):
+        """ Everything needed to carry on dealing the same sequence, as an
+        immutable tuple for from_state()
+        """
+        return (self.seed, self.policy, self.dealt, self._rng.getstate(),
+                tuple(self._queue))
+
+    @classmethod
+    def from_state(cls, state):
+        seed, policy, dealt, rng_state, queue = state
+        generator = cls.__new__(cls)
+        generator.seed = seed
+        generator.policy = policy
+        generator.dealt = dealt
+        # Skips Random.__init__, which would seed from os.urandom first
+        generator._rng = random.Random.__new__(random.Random)
+        generator._rng.setstate(rng_state)
+        generator._queue = deque(queue)
+        return generator
+
+    def _fill_to(self, count):
+        if len(self._queue) < count:
+            self._refill(max(count - len(self._queue), self.refill_size))
+
+    def _refill(self, count):
+        if self.policy == 'random':
+            self._queue.extend(self._rng.choices(blockmap, k=count))
+            return
+        bags = -(-count // 7)
+        for i in range(bags):
+            bag = list(blockmap)
+            self._rng.shuffle(bag)
+            self._queue.extend(bag)
+
+
+def spawn_point(name, width=10, height=22):
+    """ Block location a new block of the given name starts at, on a board of
+    width x height: centred, with its top row in the board's top row
+    """
+    x = (width - 1) // 2
+    if name == 'I':
+        return (x, height - 3)
+    return (x, height - 2)
+
+def make_tetris_block(board, name=None):
+    """ Build a block and its squares at the spawn location. The squares are
+    not put on the board; TetrisBoard.new_block does that once it has checked
+    that they fit. Without a name, the next one comes from board.generator.
+    """
     if name is None:
-        name = blockmap[randrange(7)]
-    block = tetris_game.Block(name, board_layer)
+        name = board.generator.next()
+    block = tetris_engine.Block(name, board)
 
     # Handle all field settings for the block below
-    # Get block bounding locations for individual squares and the graphic image
-    # for the block
-    img = None
-    bounding_locations = None
-    if name == 'I':
-        img = board_layer.sandbox.cells[0][0].tile.image
-        bounding_locations = [(-1, 1), (0, 1), (1, 1), (2, 1)]
-    elif name == 'J':
-        img = board_layer.sandbox.cells[0][1].tile.image
-        bounding_locations = [(-1, 1), (-1, 0), (0, 0), (1, 0)]
-    elif name == 'L':
-        img = board_layer.sandbox.cells[0][2].tile.image
-        bounding_locations = [(-1, 0), (0, 0), (1, 0), (1, 1)]
-    elif name == 'O':
-        img = board_layer.sandbox.cells[0][3].tile.image
-        bounding_locations = [(0, 1), (0, 0), (1, 1), (1, 0)]
-    elif name == 'S':
-        img = board_layer.sandbox.cells[0][4].tile.image
-        bounding_locations = [(-1, 0), (0, 0), (0, 1), (1, 1)]
-    elif name == 'T':
-        img = board_layer.sandbox.cells[0][6].tile.image
-        bounding_locations = [(-1, 0), (0, 1), (0, 0), (1, 0)]
-    elif name == 'Z':
-        img = board_layer.sandbox.cells[0][5].tile.image
-        bounding_locations = [(-1, 1), (0, 1), (0, 0), (1, 0)]
+    # Get block bounding locations for individual squares
+    bounding_locations = rotation_table[name][0]
 
     # Set block location
-    if name == 'I':
-        block.location = (4, 19)
-    else:
-        block.location = (4, 20)
+    block.location = spawn_point(name, board.width, board.height)
 
     # make squares for each bounding
-    # Add to block's list of squares, the square matrix representing tetris grid
-    # and map the square to its bounding coordinate
+    # Add to block's list of squares and map the square to its bounding
+    # coordinate
     for bounding_loc in bounding_locations:
         # block's location is offset with bounding to get tetris grid location
         square_x = bounding_loc[0] + block.location[0]
         square_y = bounding_loc[1] + block.location[1]
-        square = make_tetris_square(img, block, (square_x, square_y))
+        square = make_tetris_square(block, (square_x, square_y))
         block.squares.append(square)
-        block.squares_matrix[square_x][square_y] = square
         block.bounding_locations_map[square] = bounding_loc
 
     return block
 
-def make_tetris_square(img, block, loc):
-    square = tetris_game.Square(img, block, loc)
+def make_tetris_square(block, loc):
+    square = tetris_engine.Square(block, loc)
     return square
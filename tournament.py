@@ -0,0 +1,240 @@
+""" Headless tournaments and self-play across every core.
+
+    python3 tournament.py --policy greedy --policy random --games 200 \\
+        --out results.jsonl
+
+plays games 0..199 (the game number is the piece seed) for every policy in
+bots.POLICIES given, on a process pool. Every finished game is appended to
+the results file as one JSON line as soon as it comes back, so an interrupted
+run loses nothing: run the same command again and the games already in the
+file are skipped. Statistics over the whole file are printed at the end.
+
+Games go to the workers in chunks to keep the dispatch overhead down. If a
+worker dies, the pool is gone with it; the chunks that hadn't come back are
+then re-run each in its own process, split into single games if they crash
+again, and a game that crashes on its own is recorded with "crashed": true.
+"""
+
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, as_completed, wait
+from concurrent.futures.process import BrokenProcessPool
+
+import bots
+from tetris_engine import TetrisBoard
+
+#-------------------------------------------------------------------------------
+#       Games
+#-------------------------------------------------------------------------------
+
+def play_game(policy, seed, max_pieces=500):
+    """ One headless game of policy on a board seeded with seed. Returns the
+    result as a dict.
+    """
+    choose = bots.POLICIES[policy]
+    rng = random.Random(seed)
+    start = time.perf_counter()
+    board = TetrisBoard(seed=seed)
+    board.start()
+    pieces = 0
+    while not board.game_over and pieces < max_pieces:
+        placements = board.enumerate_placements()
+        if not placements:
+            break
+        placement = choose(board, placements, rng)
+        for action in placement.path:
+            board.apply(action)
+        board.apply('DROP')
+        pieces += 1
+    # The board scores one point per cleared line
+    return {'policy': policy, 'seed': seed, 'lines': board.score,
+            'pieces': pieces, 'game_over': board.game_over,
+            'duration': time.perf_counter() - start}
+
+def _play_chunk(games, max_pieces):
+    """ Worker entry point: play every (policy, seed) in games """
+    results = []
+    for policy, seed in games:
+        try:
+            results.append(play_game(policy, seed, max_pieces))
+        except Exception as e:
+            results.append({'policy': policy, 'seed': seed, 'error': repr(e)})
+    return results
+
+#-------------------------------------------------------------------------------
+#       Results file
+#-------------------------------------------------------------------------------
+
+def load_results(path):
+    """ Every result in the JSON lines file at path. A last line cut short by
+    a crash of the runner itself is ignored.
+    """
+    results = []
+    if not os.path.exists(path):
+        return results
+    with open(path) as f:
+        for line in f:
+            try:
+                results.append(json.loads(line))
+            except ValueError:
+                continue
+    return results
+
+class _ResultsFile:
+    """ Appends results to a JSON lines file, one flush per game """
+
+    def __init__(self, path):
+        needs_newline = False
+        if os.path.exists(path) and os.path.getsize(path):
+            with open(path, 'rb') as f:
+                f.seek(-1, os.SEEK_END)
+                needs_newline = f.read(1) != b'\n'
+        self.file = open(path, 'a')
+        if needs_newline:
+            self.file.write('\n')
+
+    def write(self, results):
+        for result in results:
+            self.file.write(json.dumps(result, sort_keys=True) + '\n')
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+#-------------------------------------------------------------------------------
+#       Dispatch
+#-------------------------------------------------------------------------------
+
+def run_tournament(policies, seeds, path, workers=None, chunk_size=8, max_pieces=500):
+    """ Play every policy against every seed, appending to the results file
+    at path and skipping games already in it. Returns the statistics of
+    aggregate() over the file.
+    """
+    for policy in policies:
+        if policy not in bots.POLICIES:
+            raise ValueError('unknown policy %r' % policy)
+    done = {(r['policy'], r['seed']) for r in load_results(path)}
+    games = [(policy, seed) for policy in policies for seed in seeds
+             if (policy, seed) not in done]
+    chunks = [games[i:i + chunk_size] for i in range(0, len(games), chunk_size)]
+    workers = workers or os.cpu_count() or 1
+
+    out = _ResultsFile(path)
+    try:
+        leftover = _run_pooled(chunks, workers, max_pieces, out.write)
+        if leftover:
+            _run_isolated(leftover, workers, max_pieces, out.write)
+    finally:
+        out.close()
+    return aggregate(r for r in load_results(path) if r['policy'] in policies)
+
+def _run_pooled(chunks, workers, max_pieces, record):
+    """ Play chunks on one shared pool. Returns the chunks that didn't come
+    back because the pool broke.
+    """
+    with ProcessPoolExecutor(workers) as pool:
+        futures = {pool.submit(_play_chunk, chunk, max_pieces): chunk for chunk in chunks}
+        recorded = set()
+        try:
+            for future in as_completed(futures):
+                record(future.result())
+                recorded.add(future)
+        except BrokenProcessPool:
+            pass
+
+    leftover = []
+    for future, chunk in futures.items():
+        if future in recorded:
+            continue
+        if future.exception() is None:
+            record(future.result())
+        else:
+            leftover.append(chunk)
+    return leftover
+
+def _run_isolated(chunks, workers, max_pieces, record):
+    """ Play every chunk in a process of its own, workers at a time, so a
+    crash only takes its own chunk down. A crashed chunk is retried one game
+    at a time, and a game that crashes alone is recorded as crashed.
+    """
+    queue = deque(chunks)
+    running = {}    # future -> (executor, chunk)
+    while queue or running:
+        while queue and len(running) < workers:
+            chunk = queue.popleft()
+            executor = ProcessPoolExecutor(1)
+            running[executor.submit(_play_chunk, chunk, max_pieces)] = (executor, chunk)
+        finished, _ = wait(running, return_when=FIRST_COMPLETED)
+        for future in finished:
+            executor, chunk = running.pop(future)
+            executor.shutdown()
+            try:
+                record(future.result())
+            except BrokenProcessPool:
+                if len(chunk) > 1:
+                    queue.extend([game] for game in chunk)
+                else:
+                    policy, seed = chunk[0]
+                    record([{'policy': policy, 'seed': seed, 'crashed': True}])
+
+#-------------------------------------------------------------------------------
+#       Statistics
+#-------------------------------------------------------------------------------
+
+def aggregate(results):
+    """ policy -> statistics over its results """
+    by_policy = {}
+    for result in results:
+        by_policy.setdefault(result['policy'], []).append(result)
+
+    stats = {}
+    for policy, games in sorted(by_policy.items()):
+        played = [g for g in games if 'lines' in g]
+        lines = [g['lines'] for g in played]
+        pieces = sum(g['pieces'] for g in played)
+        duration = sum(g['duration'] for g in played)
+        stats[policy] = {
+            'games': len(played),
+            'failed': len(games) - len(played),
+            'mean_lines': statistics.mean(lines) if lines else 0,
+            'median_lines': statistics.median(lines) if lines else 0,
+            'max_lines': max(lines, default=0),
+            'mean_pieces': pieces / len(played) if played else 0,
+            'pieces_per_second': pieces / duration if duration else 0,
+        }
+    return stats
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--policy', action='append', choices=sorted(bots.POLICIES),
+                        help='policy to play, can be given more than once')
+    parser.add_argument('--games', type=int, default=100, help='games per policy')
+    parser.add_argument('--first-seed', type=int, default=0)
+    parser.add_argument('--max-pieces', type=int, default=500)
+    parser.add_argument('--workers', type=int, default=None, help='default: every core')
+    parser.add_argument('--chunk-size', type=int, default=8)
+    parser.add_argument('--out', default='results.jsonl', help='JSON lines results file')
+    args = parser.parse_args(argv)
+
+    policies = args.policy or ['greedy']
+    seeds = range(args.first_seed, args.first_seed + args.games)
+    stats = run_tournament(policies, seeds, args.out, args.workers, args.chunk_size,
+                           args.max_pieces)
+
+    print('%-10s %6s %6s %10s %10s %8s %10s %10s' % (
+        'policy', 'games', 'failed', 'mean', 'median', 'max', 'pieces', 'pieces/s'))
+    for policy, s in stats.items():
+        print('%-10s %6d %6d %10.1f %10.1f %8d %10.1f %10.1f' % (
+            policy, s['games'], s['failed'], s['mean_lines'], s['median_lines'],
+            s['max_lines'], s['mean_pieces'], s['pieces_per_second']))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
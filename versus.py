@@ -0,0 +1,577 @@
+""" Two player versus over the network.
+
+    python3 versus.py serve --port 7777
+    python3 versus.py play --host HOST --port 7777 --match final --policy greedy
+
+Each player runs their own TetrisBoard, and both boards deal the same pieces
+(the match seed). Clearing lines sends garbage rows to the opponent,
+GARBAGE_TABLE rows per step of the clear and collapse chain. A clear first
+cancels garbage that is waiting to go under the sender's own stack. Garbage
+that is still waiting when a block locks without clearing is pushed in under
+the stack (see TetrisBoard.add_garbage) before the next block moves.
+
+Boards are never sent whole. Each player streams numbered events:
+
+    LOCK     a block locked: name, orientation, location
+    ATTACK   rows of garbage sent to the opponent
+    GARBAGE  garbage rows added under the player's own stack, with their holes
+    TOPOUT   the player lost
+
+and the opponent replays them on a mirror board (VersusPlayer.opponent) that
+the engine's determinism keeps identical to the real one. The server only
+pairs players by match id and relays frames, so one process can run many
+matches.
+
+Wire format: every frame is a little endian H byte count followed by the
+message, which starts with a B kind:
+
+    JOIN     match id, utf-8                        client -> server
+    START    q seed, B player number (0 or 1)       server -> client
+    LOCK     I seq, B blockmap index, B orientation, h x, h y
+    ATTACK   I seq, B rows
+    GARBAGE  I seq, H rows, then H hole column per row
+    TOPOUT   I seq
+    END      B winner's player number               server -> client
+
+Each player numbers its events from 1. A receiver drops repeats and treats a
+gap as a broken stream.
+
+VersusPlayer never touches the network. Its board listener methods only
+append frames to an outbox, and incoming events wait in an inbox until the
+game loop calls poll(), so input handling never waits on a socket.
+VersusClient runs the asyncio side for it, over TCP (connect()) or over an
+in-process pipe to a VersusServer (VersusServer.connect()), which is what the
+tests use.
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import struct
+import sys
+from collections import deque
+
+import bots
+import tetrofactory
+from tetris_engine import TetrisBoard
+
+GARBAGE_TABLE = (0, 0, 1, 2, 4)     # rows sent for clearing 0, 1, 2, 3 and 4 lines
+
+JOIN, START, LOCK, ATTACK, GARBAGE, TOPOUT, END = range(7)
+_events = (LOCK, ATTACK, GARBAGE, TOPOUT)
+
+_length = struct.Struct('<H')
+_start = struct.Struct('<BqB')
+_event = struct.Struct('<BI')
+_lock = struct.Struct('<BBhh')
+_count = struct.Struct('<B')
+_rows = struct.Struct('<H')
+_end = struct.Struct('<BB')
+
+class ProtocolError(ValueError):
+    pass
+
+
+def garbage_for(lines):
+    """ Garbage rows sent for a lock whose chain cleared lines[i] lines at
+    step i
+    """
+    return sum(GARBAGE_TABLE[min(n, 4)] for n in lines)
+
+#-------------------------------------------------------------------------------
+#       Messages
+#-------------------------------------------------------------------------------
+
+def encode_join(match):
+    return bytes([JOIN]) + match.encode('utf-8')
+
+def encode_start(seed, player):
+    return _start.pack(START, seed, player)
+
+def encode_end(winner):
+    return _end.pack(END, winner)
+
+def encode_event(kind, seq, *args):
+    out = bytearray(_event.pack(kind, seq))
+    if kind == LOCK:
+        name, orientation, (x, y) = args
+        out += _lock.pack(tetrofactory.blockmap.index(name), orientation, x, y)
+    elif kind == ATTACK:
+        out += _count.pack(min(args[0], 255))
+    elif kind == GARBAGE:
+        holes = args[0]
+        out += _rows.pack(len(holes))
+        out += struct.pack('<%dH' % len(holes), *holes)
+    return bytes(out)
+
+def decode(message):
+    """ A message as a tuple: (JOIN, match), (START, seed, player),
+    (LOCK, seq, name, orientation, location), (ATTACK, seq, rows),
+    (GARBAGE, seq, holes), (TOPOUT, seq) or (END, winner)
+    """
+    try:
+        kind = message[0]
+        if kind == JOIN:
+            return (JOIN, bytes(message[1:]).decode('utf-8'))
+        if kind == START:
+            return _start.unpack(message)
+        if kind == END:
+            return _end.unpack(message)
+        if kind not in _events:
+            raise ProtocolError('unknown message kind %d' % kind)
+        kind, seq = _event.unpack_from(message)
+        offset = _event.size
+        if kind == LOCK:
+            name, orientation, x, y = _lock.unpack_from(message, offset)
+            return (LOCK, seq, tetrofactory.blockmap[name], orientation, (x, y))
+        if kind == ATTACK:
+            return (ATTACK, seq, _count.unpack_from(message, offset)[0])
+        if kind == GARBAGE:
+            count, = _rows.unpack_from(message, offset)
+            holes = struct.unpack_from('<%dH' % count, message, offset + _rows.size)
+            return (GARBAGE, seq, holes)
+        return (TOPOUT, seq)
+    except (struct.error, IndexError, UnicodeDecodeError):
+        raise ProtocolError('malformed message')
+
+#-------------------------------------------------------------------------------
+#       Connections
+#-------------------------------------------------------------------------------
+
+class StreamConnection:
+    """ Frames over an asyncio stream pair. send() only buffers. """
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+
+    async def receive(self):
+        """ The next message, or None once the other end has gone """
+        try:
+            length, = _length.unpack(await self.reader.readexactly(_length.size))
+            return await self.reader.readexactly(length)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            return None
+
+    def send(self, message):
+        if not self.writer.is_closing():
+            self.writer.write(_length.pack(len(message)) + message)
+
+    async def drain(self):
+        try:
+            await self.writer.drain()
+        except ConnectionError:
+            pass
+
+    def close(self):
+        self.writer.close()
+
+
+class PipeConnection:
+    """ One end of an in-process connection, see pipe() """
+
+    peer = None
+    _queue = None
+
+    def __init__(self):
+        self._queue = asyncio.Queue()
+
+    async def receive(self):
+        return await self._queue.get()
+
+    def send(self, message):
+        if self.peer is not None:
+            self.peer._queue.put_nowait(bytes(message))
+
+    async def drain(self):
+        pass
+
+    def close(self):
+        if self.peer is not None:
+            self.peer._queue.put_nowait(None)
+            self.peer.peer = None
+            self.peer = None
+
+
+def pipe():
+    """ Two connected PipeConnections """
+    a, b = PipeConnection(), PipeConnection()
+    a.peer, b.peer = b, a
+    return a, b
+
+async def connect(host, port):
+    reader, writer = await asyncio.open_connection(host, port)
+    return StreamConnection(reader, writer)
+
+#-------------------------------------------------------------------------------
+#       Server
+#-------------------------------------------------------------------------------
+
+class _Match:
+
+    def __init__(self, connections):
+        self.connections = connections
+        self.winner = None
+
+
+class VersusServer:
+    """ Pairs connections that JOIN with the same match id, deals them a seed
+    and relays their events to each other until one tops out or leaves. It
+    keeps no boards, so a match costs two coroutines and a relay per event.
+    """
+
+    matches = 0     # matches started
+    _rng = None
+    _waiting = None     # match id -> (connection, future of the _Match)
+    _tasks = None
+
+    def __init__(self, seed=None):
+        self._rng = random.Random(seed)
+        self._waiting = dict()
+        self._tasks = set()
+
+    async def start(self, host='127.0.0.1', port=0):
+        """ Listen for TCP clients. Returns the asyncio server. """
+        return await asyncio.start_server(self._accept, host, port)
+
+    def connect(self):
+        """ A client connection to this server that stays in process """
+        client, server = pipe()
+        task = asyncio.ensure_future(self.serve(server))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return client
+
+    async def serve(self, connection):
+        """ Run one client's side of a match """
+        message = await connection.receive()
+        try:
+            kind, match_id = decode(message) if message else (None, None)
+        except ProtocolError:
+            kind = None
+        if kind != JOIN:
+            connection.close()
+            return
+
+        waiting = self._waiting.pop(match_id, None)
+        if waiting is None:
+            paired = asyncio.get_running_loop().create_future()
+            self._waiting[match_id] = (connection, paired)
+            # Notice a client leaving before anyone pairs with it
+            first = asyncio.ensure_future(connection.receive())
+            await asyncio.wait((paired, first), return_when=asyncio.FIRST_COMPLETED)
+            if not paired.done():
+                del self._waiting[match_id]
+                connection.close()
+                return
+            await self._relay(paired.result(), 0, first)
+        else:
+            partner, paired = waiting
+            match = _Match((partner, connection))
+            self.matches += 1
+            seed = self._rng.randrange(1 << 63)
+            # Both starts go out before either side can send an event
+            partner.send(encode_start(seed, 0))
+            connection.send(encode_start(seed, 1))
+            paired.set_result(match)
+            await self._relay(match, 1)
+
+    async def _relay(self, match, player, first=None):
+        """ Pass player's events on to the other player. first is a receive
+        already under way.
+        """
+        connection = match.connections[player]
+        partner = match.connections[1 - player]
+        while match.winner is None:
+            if first is not None:
+                message, first = await first, None
+            else:
+                message = await connection.receive()
+            if match.winner is not None:
+                break
+            if message is None:
+                self._end(match, 1 - player)
+                break
+            if message[0] in _events:
+                partner.send(message)
+                await partner.drain()
+            if message[0] == TOPOUT:
+                self._end(match, 1 - player)
+        connection.close()
+
+    def _end(self, match, winner):
+        match.winner = winner
+        for connection in match.connections:
+            connection.send(encode_end(winner))
+
+    async def _accept(self, reader, writer):
+        await self.serve(StreamConnection(reader, writer))
+
+#-------------------------------------------------------------------------------
+#       Players
+#-------------------------------------------------------------------------------
+
+class VersusPlayer:
+    """ Board listener linking the local board to the opponent's. Call poll()
+    from the game loop, eg once per frame.
+    """
+
+    board = None
+    opponent = None     # mirror of the opponent's board, built from their events
+    player = None       # 0 or 1
+    outbox = None       # frames waiting to be sent
+    inbox = None        # decoded messages waiting for poll()
+    pending = None      # batches of garbage rows waiting to go under the stack
+    sent = 0            # garbage rows sent
+    received = 0        # garbage rows added to the board
+    winner = None       # the winner's player number once the match is over
+    wake = None         # called after a frame is queued, eg to wake a writer task
+    _seq = 0
+    _opponent_seq = 0   # seq of the latest opponent event applied
+    _block = None       # (name, orientation, location) of the current block as last seen
+    _locked = False     # a block locked without clearing since the last poll()
+    _holes = None       # random.Random picking garbage holes
+
+    def __init__(self, seed, player, board=None):
+        """ Without a board, a fresh one dealing the match seed's pieces is
+        made. Start it once the player is created.
+        """
+        if board is None:
+            board = TetrisBoard(seed=seed)
+        self.board = board
+        self.opponent = TetrisBoard(seed=seed, width=board.width, height=board.height)
+        self.player = player
+        self.outbox = deque()
+        self.inbox = deque()
+        self.pending = deque()
+        self._holes = random.Random('%d/%d' % (seed, player))
+        board.add_listener(self)
+
+    def poll(self):
+        """ Apply the opponent's events, then put waiting garbage under the
+        stack if a block locked without clearing since the last poll
+        """
+        inbox = self.inbox
+        while inbox:
+            self._receive(inbox.popleft())
+        if self._locked and self.pending and not self.board.game_over:
+            holes = []
+            for rows in self.pending:
+                # Each batch lines up its holes, like a cleared stack would
+                holes.extend([self._holes.randrange(self.board.width)] * rows)
+            self.pending.clear()
+            self.board.add_garbage(holes)
+        self._locked = False
+
+    def resign(self):
+        if not self.board.game_over and self.winner is None:
+            self._send(TOPOUT)
+
+    #---------------------------------------------------------------------------
+    #       Board listener
+    #---------------------------------------------------------------------------
+
+    def on_block_spawned(self, block):
+        if self._block is not None:
+            # The last block locked without clearing anything
+            self._send_lock()
+            self._locked = True
+        self._block = (block.name, block.orientation, block.location)
+
+    def on_block_moved(self, block):
+        self._block = (block.name, block.orientation, block.location)
+
+    def on_garbage_added(self, result):
+        self.received += result.rows
+        self._send(GARBAGE, result.holes)
+        block = self.board.current_block
+        self._block = None if block is None else (block.name, block.orientation,
+                                                  block.location)
+
+    def on_lock_resolved(self, result):
+        self._send_lock()
+        attack = garbage_for(result.lines)
+        while attack and self.pending:
+            cancelled = min(attack, self.pending[0])
+            attack -= cancelled
+            if cancelled == self.pending[0]:
+                self.pending.popleft()
+            else:
+                self.pending[0] -= cancelled
+        if attack:
+            self.sent += attack
+            self._send(ATTACK, attack)
+
+    def on_game_over(self):
+        if self._block is not None and self.board.current_block is None:
+            self._send_lock()
+        self._send(TOPOUT)
+
+    #---------------------------------------------------------------------------
+    #       Private
+    #---------------------------------------------------------------------------
+
+    def _send_lock(self):
+        self._send(LOCK, *self._block)
+        self._block = None
+
+    def _send(self, kind, *args):
+        self._seq += 1
+        self.outbox.append(encode_event(kind, self._seq, *args))
+        if self.wake is not None:
+            self.wake()
+
+    def _receive(self, message):
+        kind = message[0]
+        if kind == END:
+            self.winner = message[1]
+            return
+        seq = message[1]
+        if seq <= self._opponent_seq:
+            return
+        if seq != self._opponent_seq + 1:
+            raise ProtocolError('opponent event %d missing' % (self._opponent_seq + 1))
+        self._opponent_seq = seq
+
+        opponent = self.opponent
+        if kind == LOCK:
+            name, orientation, location = message[2:]
+            cells = [(x + location[0], y + location[1])
+                     for x, y in tetrofactory.rotation_table[name][orientation]]
+            if not all(0 <= x < opponent.width and 0 <= y < opponent.height and
+                       opponent.squares_matrix[x][y] is None for x, y in cells):
+                raise ProtocolError('opponent locked a block over their stack')
+            opponent.place_locked(cells, name)
+            opponent.score += opponent.resolve_lock().total_lines
+        elif kind == ATTACK:
+            self.pending.append(message[2])
+        elif kind == GARBAGE:
+            opponent.add_garbage(message[2])
+        elif kind == TOPOUT:
+            opponent.game_over = True
+
+
+class VersusClient:
+    """ The network side of a VersusPlayer: a writer task sending its outbox
+    as soon as anything is queued, and a reader task filling its inbox
+    """
+
+    connection = None
+    player = None       # VersusPlayer, once joined
+    _wakeup = None      # asyncio.Event set when the outbox has frames
+    _tasks = None
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    async def join(self, match, board=None):
+        """ Wait for an opponent in match. Returns the VersusPlayer, whose
+        board is ready to start, and starts the network tasks.
+        """
+        self.connection.send(encode_join(match))
+        message = await self.connection.receive()
+        if message is None:
+            raise ProtocolError('server closed the connection')
+        kind, seed, number = decode(message)
+        if kind != START:
+            raise ProtocolError('expected START')
+        self.player = VersusPlayer(seed, number, board)
+
+        loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        # Safe to call from a renderer thread as well as from the loop
+        self.player.wake = lambda: loop.call_soon_threadsafe(self._wakeup.set)
+        self._tasks = [asyncio.ensure_future(self._write()),
+                       asyncio.ensure_future(self._read())]
+        return self.player
+
+    async def wait_closed(self):
+        """ Wait until the match is over (or the server is gone) """
+        await self._tasks[1]
+        self._tasks[0].cancel()
+        self.connection.close()
+
+    async def _write(self):
+        outbox = self.player.outbox
+        while True:
+            while outbox:
+                self.connection.send(outbox.popleft())
+            await self.connection.drain()
+            if not outbox:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+
+    async def _read(self):
+        inbox = self.player.inbox
+        while True:
+            message = await self.connection.receive()
+            if message is None:
+                break
+            inbox.append(decode(message))
+            if message[0] == END:
+                break
+
+#-------------------------------------------------------------------------------
+#       Bots
+#-------------------------------------------------------------------------------
+
+async def play_bot(connection, match, policy='greedy', max_pieces=None, seed=0):
+    """ Play one match with a bots.POLICIES policy, placing a block per event
+    loop iteration. Resigns after max_pieces. Returns the VersusPlayer.
+    """
+    choose = bots.POLICIES[policy]
+    rng = random.Random(seed)
+    client = VersusClient(connection)
+    player = await client.join(match)
+    board = player.board
+    board.start()
+    pieces = 0
+    while player.winner is None and not board.game_over:
+        if max_pieces is not None and pieces >= max_pieces:
+            player.resign()
+            break
+        placement = choose(board, board.enumerate_placements(), rng)
+        for action in placement.path + ['DROP']:
+            board.apply(action)
+        pieces += 1
+        player.poll()
+        await asyncio.sleep(0)
+    await client.wait_closed()
+    player.poll()
+    return player
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('command', choices=('serve', 'play'))
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=7777)
+    parser.add_argument('--match', default='default', help='match id to join')
+    parser.add_argument('--policy', default='greedy', choices=sorted(bots.POLICIES))
+    parser.add_argument('--max-pieces', type=int, default=None,
+                        help='resign after this many pieces')
+    args = parser.parse_args(argv)
+
+    if args.command == 'serve':
+        async def serve():
+            server = await VersusServer().start(args.host, args.port)
+            async with server:
+                await server.serve_forever()
+        try:
+            asyncio.run(serve())
+        except KeyboardInterrupt:
+            pass
+        return 0
+
+    async def play():
+        connection = await connect(args.host, args.port)
+        return await play_bot(connection, args.match, args.policy, args.max_pieces)
+    player = asyncio.run(play())
+    print(json.dumps({'match': args.match, 'player': player.player, 'winner': player.winner,
+                      'lines': player.board.score, 'sent': player.sent,
+                      'received': player.received}, sort_keys=True))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())